@@ -31,6 +31,8 @@ import time
 
 OVIRT_VARS = defaults.NodeConfigFile().get_dict()
 
+logger = logging.getLogger(__name__)
+
 
 class PrepareInstallation(Transaction.Element):
     title = "Prepare installation"
@@ -39,6 +41,27 @@ class PrepareInstallation(Transaction.Element):
         defaults.ConfigVersion().set_to_current()
 
 
+class ConfigureSection(Transaction.Element):
+    """Base for elements updating and applying a defaults section
+    """
+    warning = None
+
+    def update(self):
+        """Update the section and return it
+        """
+        raise NotImplementedError
+
+    def commit(self):
+        try:
+            model = self.update()
+            # Sections which are unchanged and were already applied during
+            # this boot get an empty transaction
+            tx = model.pending_transaction()
+            tx()
+        except:
+            logger.warning(self.warning)
+
+
 class ConfigureNetworking(Transaction.Element):
     title = "Configuring network"
 
@@ -78,63 +101,63 @@ class EnableSshPasswordAuthentication(Transaction.Element):
             aug.set("/files/etc/ssh/sshd_config/PasswordAuthentication",
                     "no")
         Config().persist("/etc/ssh/sshd_config")
-        process.call("service sshd restart &> /dev/null", shell=True)
+        self.request_service("sshd", "reload", do_raise=False)
 
 
-class SetKeyboardLayout(Transaction.Element):
+class SetKeyboardLayout(ConfigureSection):
     title = "Setting Keyboard Layout"
 
-    def commit(self):
-        try:
-            model = defaults.Keyboard()
-            model.update(layout=OVIRT_VARS["OVIRT_KEYBOARD_LAYOUT"])
-            tx = model.transaction()
-            tx()
-        except:
-            logger.warning("Unknown keyboard layout: %s" %
-                           OVIRT_VARS["OVIRT_KEYBOARD_LAYOUT"])
+    @property
+    def warning(self):
+        return ("Unknown keyboard layout: %s" %
+                OVIRT_VARS["OVIRT_KEYBOARD_LAYOUT"])
+
+    def update(self):
+        model = defaults.Keyboard()
+        model.update(layout=OVIRT_VARS["OVIRT_KEYBOARD_LAYOUT"])
+        return model
 
 
-class ConfigureStrongRNG(Transaction.Element):
+class ConfigureStrongRNG(ConfigureSection):
     title = "Configuring SSH strong RNG"
 
-    def commit(self):
-        try:
-            model = defaults.SSH()
-            model.update(num_bytes=OVIRT_VARS["OVIRT_USE_STRONG_RNG"])
-            tx = model.transaction()
-            tx()
-        except:
-            logger.warning("Unknown ssh strong RNG: %s" %
-                           OVIRT_VARS["OVIRT_USE_STRONG_RNG"])
+    @property
+    def warning(self):
+        return ("Unknown ssh strong RNG: %s" %
+                OVIRT_VARS["OVIRT_USE_STRONG_RNG"])
 
+    def update(self):
+        model = defaults.SSH()
+        model.update(num_bytes=OVIRT_VARS["OVIRT_USE_STRONG_RNG"])
+        return model
 
-class ConfigureAESNI(Transaction.Element):
+
+class ConfigureAESNI(ConfigureSection):
     title = "Configuring SSH AES NI"
 
-    def commit(self):
-        try:
-            model = defaults.SSH()
-            model.update(disable_aesni=True)
-            tx = model.transaction()
-            tx()
-        except:
-            logger.warning("Unknown ssh AES NI: %s" %
-                           OVIRT_VARS["OVIRT_DISABLE_AES_NI"])
+    @property
+    def warning(self):
+        return ("Unknown ssh AES NI: %s" %
+                OVIRT_VARS["OVIRT_DISABLE_AES_NI"])
 
+    def update(self):
+        model = defaults.SSH()
+        model.update(disable_aesni=True)
+        return model
 
-class ConfigureNfsv4(Transaction.Element):
+
+class ConfigureNfsv4(ConfigureSection):
     title = "Setting NFSv4 domain"
 
-    def commit(self):
-        try:
-            model = defaults.NFSv4()
-            model.update(domain=OVIRT_VARS["OVIRT_NFSV4_DOMAIN"])
-            tx = model.transaction()
-            tx()
-        except:
-            logger.warning("Unknown NFSv4 domain: %s" %
-                           OVIRT_VARS["OVIRT_NFSV4_DOMAIN"])
+    @property
+    def warning(self):
+        return ("Unknown NFSv4 domain: %s" %
+                OVIRT_VARS["OVIRT_NFSV4_DOMAIN"])
+
+    def update(self):
+        model = defaults.NFSv4()
+        model.update(domain=OVIRT_VARS["OVIRT_NFSV4_DOMAIN"])
+        return model
 
 
 class ConfigureLogging(Transaction.Element):
@@ -164,33 +187,31 @@ class PerformInstallation(Transaction.Element):
         Install()
 
 
-class ConfigureKdump(Transaction.Element):
+class ConfigureKdump(ConfigureSection):
     title = "Configuring KDump"
 
-    def commit(self):
-        try:
-            model = defaults.KDump()
-
-            if "OVIRT_KDUMP_SSH" in OVIRT_VARS and \
-                    "OVIRT_KDUMP_SSH_KEY" in OVIRT_VARS:
-                model.configure_ssh(OVIRT_VARS["OVIRT_KDUMP_SSH"],
-                                    OVIRT_VARS["OVIRT_KDUMP_SSH_KEY"])
-            elif "OVIRT_KDUMP_NFS" in OVIRT_VARS:
-                model.configure_nfs(OVIRT_VARS["OVIRT_KDUMP_NFS"])
-            elif "OVIRT_DISABLE_KDUMP" in OVIRT_VARS:
-                model.configure_disable()
-            else:
-                model.configure_local()
-
-            tx = model.transaction()
-            tx()
+    @property
+    def warning(self):
+        kdump_args = ["OVIRT_KDUMP_SSH", "OVIRT_KDUMP_SSH_KEY",
+                      "OVIRT_KDUMP_NFS", "OVIRT_KDUMP_LOCAL"]
+        return ("Unknown kdump configuration: %s" %
+                " ".join([x for x in kdump_args if x in OVIRT_VARS]))
+
+    def update(self):
+        model = defaults.KDump()
+
+        if "OVIRT_KDUMP_SSH" in OVIRT_VARS and \
+                "OVIRT_KDUMP_SSH_KEY" in OVIRT_VARS:
+            model.configure_ssh(OVIRT_VARS["OVIRT_KDUMP_SSH"],
+                                OVIRT_VARS["OVIRT_KDUMP_SSH_KEY"])
+        elif "OVIRT_KDUMP_NFS" in OVIRT_VARS:
+            model.configure_nfs(OVIRT_VARS["OVIRT_KDUMP_NFS"])
+        elif "OVIRT_DISABLE_KDUMP" in OVIRT_VARS:
+            model.configure_disable()
+        else:
+            model.configure_local()
 
-        except:
-            kdump_args = ["OVIRT_KDUMP_SSH", "OVIRT_KDUMP_SSH_KEY",
-                          "OVIRT_KDUMP_NFS", "OVIRT_KDUMP_LOCAL"]
-            logger.warning("Unknown kdump configuration: %s" %
-                           " ".join([x for x in kdump_args if
-                                     x in OVIRT_VARS]))
+        return model
 
 
 class InstallBootloader(Transaction.Element):
@@ -207,7 +228,8 @@ class InstallBootloader(Transaction.Element):
         install = Install()
         if not install.ovirt_boot_setup():
             raise RuntimeError("Bootloader Installation Failed")
-        cfgfile.write(cfg)
+        # Replay it right away, not just the keys changed by the batch
+        cfgfile.write(cfg, batch=False)
 
 
 class RunHooks(Transaction.Element):
@@ -241,6 +263,8 @@ if __name__ == "__main__":
     if "--debug" in sys.argv:
         logging.basicConfig(level=logging.DEBUG)
 
+    process.install_accounting_handler()
+
     tx = Transaction("Automatic Installation")
 
     tx.append(PrepareInstallation())
@@ -293,7 +317,20 @@ if __name__ == "__main__":
 
     tx.append(RunHooks())
 
-    TransactionProgress(tx, is_dry=False).run()
+    trace_mark = Transaction.Trace.mark()
+    try:
+        # The defaults updates of all steps are written once at the end,
+        # also if a step failed
+        with defaults.batch(discard_on_error=False) as batch:
+            TransactionProgress(tx, is_dry=False).run()
+        logger.debug("Batched defaults updates saved %s writes" %
+                     batch.saved_writes)
+    finally:
+        print Transaction.Trace.summary(trace_mark)
+        try:
+            process.accounting_dump(process.ACCOUNTING_DUMP)
+        except IOError:
+            logging.debug("Failed to dump the spawned processes")
     print "Installation and Configuration Completed"
 
     reboot_delay = kernel_cmdline_arguments().get("reboot_delay", None)
@@ -222,7 +222,9 @@ class UpgradeTool(Base):
         sys.path.insert(0, self._python_lib + "/site-packages/")
         self._tmp_python_path = "%s/site-packages/ovirtnode" \
             % self._python_lib
-        shutil.copytree(self._tmp_python_path, self._ovirtnode_dir)
+        # use the copy engine of the new image, it preserves all attributes
+        from ovirt.node.utils.fs import fastcopy
+        fastcopy.copytree(self._tmp_python_path, self._ovirtnode_dir)
         # import install and ovirtfunctions modules from new image
         f, filename, description = imp.find_module(
             'install',
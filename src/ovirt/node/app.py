@@ -22,7 +22,7 @@ from optparse import OptionParser
 from ovirt.node import base, utils, plugins, ui, loader
 from ovirt.node.config import defaults
 from ovirt.node.ui import urwid_builder
-from ovirt.node.utils import system, Timer, console
+from ovirt.node.utils import system, Timer, console, process
 import signal as sys_signal
 import os
 import sys
@@ -299,6 +299,9 @@ class Application(base.Base):
                 self.logger.debug("CTRL+C pressed")
             sys_signal.signal(sys_signal.SIGINT, _handler)
 
+        # Allow to profile the spawned processes, see tools/subprocesses.py
+        process.install_accounting_handler()
+
         if system.is_rescue_mode():
             self.logger.error("The TUI cannot be used in rescue mode. "
                               "Please reboot without rescue to "
@@ -27,8 +27,11 @@ from ovirt.node.utils.fs import Config, ShellVarFile, File
 from ovirt.node.utils.network import NIC, Bridges, Bonds
 from ovirt.node.utils.system import Bootloader
 import glob
+import json
 import logging
 import os
+import re
+import threading
 
 """
 Classes and functions related to model of the configuration of oVirt Node.
@@ -57,10 +60,168 @@ def exists():
     return os.path.exists(OVIRT_NODE_DEFAULTS_FILENAME)
 
 
+def batch(persist=False, discard_on_error=True):
+    """Collect the updates of any number of sections and write them at once
+
+    See ConfigBatch for details.
+
+    >>> from ovirt.node.utils import fs
+    >>> f = fs.FakeFs.File("batch-dst")
+    >>> with batch(persist=False) as b:
+    ...     _ = Nameservers(f).update(["10.0.0.1"])
+    ...     _ = Timeservers(f).update(["ntp.example.com"])
+    ...     _ = Nameservers(f).update(["10.0.0.2"])
+    ...     f.read()
+    ''
+    >>> print(f.read())
+    OVIRT_DNS="10.0.0.2"
+    OVIRT_NTP="ntp.example.com"
+    <BLANKLINE>
+    >>> b.saved_writes
+    2
+    >>> f.delete()
+    """
+    return ConfigBatch(persist, discard_on_error)
+
+
+class ConfigBatch(base.Base):
+    """Context manager deferring all writes to NodeConfigFiles
+
+    Within the context the pending contents of a file are seen by all
+    readers (e.g. the retrieve() method of all sections), but only one
+    write per file happens when the context is left. The file is also
+    persisted if persist is set.
+    Only the keys which were changed within the batch are written, they are
+    merged with the contents of the file at that time. So keys written by
+    others meanwhile (e.g. the legacy shell functions) are kept.
+    If the context is left with an exception, the pending changes are
+    dropped, unless discard_on_error is unset.
+    Batches are per-thread, nested batches are merged into the outer one.
+
+    >>> import tempfile
+    >>> fn = tempfile.mktemp()
+    >>> cfgfile = NodeConfigFile(fn)
+    >>> cfgfile.write({"OVIRT_A": "a", "OVIRT_B": "b"})
+    True
+    >>> with batch():
+    ...     _ = cfgfile.update({"OVIRT_A": "x", "OVIRT_B": None}, True)
+    ...     with open(fn, "a") as f:
+    ...         f.write("OVIRT_C=c\\n")
+    >>> sorted(NodeConfigFile(fn).get_dict().items())
+    [('OVIRT_A', 'x'), ('OVIRT_C', 'c')]
+    >>> os.unlink(fn)
+    """
+    _local = threading.local()
+    total_saved_writes = 0
+
+    persist = False
+    discard_on_error = True
+    deferred_writes = 0
+    _pending = None
+
+    def __init__(self, persist=False, discard_on_error=True):
+        super(ConfigBatch, self).__init__()
+        self.persist = persist
+        self.discard_on_error = discard_on_error
+        self._pending = {}
+        self._base = {}
+        self._outer = None
+
+    @classmethod
+    def current(cls):
+        """Returns the batch active in this thread or None
+        """
+        return getattr(cls._local, "batch", None)
+
+    def __enter__(self):
+        self._outer = self.current()
+        if not self._outer:
+            self._local.batch = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._outer:
+            # The outer batch is writing everything
+            return
+        self._local.batch = None
+        if exc_type and self.discard_on_error:
+            self.logger.debug("Dropping pending changes of %s files" %
+                              len(self._pending))
+            self._pending = {}
+            return
+        self.flush()
+
+    @property
+    def saved_writes(self):
+        return max(0, self.deferred_writes - len(self._pending))
+
+    def pending(self, cfgfile):
+        """Returns a copy of the pending contents of cfgfile or None
+        """
+        if cfgfile.path in self._pending:
+            return dict(self._pending[cfgfile.path][1])
+
+    def defer(self, cfgfile, cfg):
+        """Keep the sanitized cfg as the pending contents of cfgfile
+        """
+        if cfgfile.path not in self._pending:
+            # The contents the changes are computed against
+            self._base[cfgfile.path] = cfgfile.get_dict()
+        self._pending[cfgfile.path] = (cfgfile, dict(cfg))
+        self.deferred_writes += 1
+
+    def flush(self):
+        for path, (cfgfile, cfg) in self._pending.items():
+            base = self._base[path]
+            changes = dict((k, v) for k, v in cfg.items()
+                           if k not in base or base[k] != v)
+            changes.update((k, None) for k in base if k not in cfg)
+            changed = cfgfile.update(changes, remove_empty=True)
+            if changed and self.persist and \
+               cfgfile.fingerprint() is not None:
+                Config().persist(cfgfile.path)
+        ConfigBatch.total_saved_writes += self.saved_writes
+        self.logger.debug("Batch wrote %s files, saved %s writes" %
+                          (len(self._pending), self.saved_writes))
+
+
 class NodeConfigFile(ShellVarFile):
     """NodeConfigFile is a specififc interface to some configuration file
     with a specififc syntax
+
+    The parsed contents are kept in a process-wide snapshot, which is
+    shared by all instances (and thus all sections) and is validated
+    against the fingerprint (inode, size, mtime) of the file on each
+    access. Our own writes drop the snapshot.
+
+    >>> import tempfile
+    >>> fn = tempfile.mktemp()
+    >>> cfgfile = NodeConfigFile(fn)
+    >>> cfgfile.write({"OVIRT_A": "a"})
+    True
+    >>> NodeConfigFile.reset_snapshot_stats()
+    >>> cfgfile.get_dict()
+    {'OVIRT_A': 'a'}
+    >>> NodeConfigFile(fn).get_dict()
+    {'OVIRT_A': 'a'}
+    >>> NodeConfigFile.snapshot_stats()
+    {'hits': 1, 'misses': 1}
+
+    >>> cfgfile.update({"OVIRT_B": "b"}, True)
+    True
+    >>> sorted(NodeConfigFile(fn).get_dict().items())
+    [('OVIRT_A', 'a'), ('OVIRT_B', 'b')]
+    >>> NodeConfigFile.snapshot_stats()
+    {'hits': 3, 'misses': 2}
+    >>> os.unlink(fn)
     """
+    # filename -> (fingerprint, parsed dict)
+    _snapshots = {}
+    _snapshots_lock = threading.Lock()
+    _snapshot_stats = {"hits": 0, "misses": 0}
+    # Serializes the read-modify-write cycles of update()
+    _update_lock = threading.RLock()
+
     def __init__(self, filename=None):
         filename = filename or OVIRT_NODE_DEFAULTS_FILENAME
         if filename == OVIRT_NODE_DEFAULTS_FILENAME \
@@ -69,11 +230,211 @@ class NodeConfigFile(ShellVarFile):
                                filename)
         super(NodeConfigFile, self).__init__(filename, create=True)
 
+    @property
+    def path(self):
+        return self._fileobj.filename
+
+    def fingerprint(self):
+        return self._fileobj.fingerprint()
+
+    def get_dict(self):
+        """Returns a dict of (key, value) pairs
+
+        The dict is a copy of the pending batch contents or of the shared
+        snapshot, so callers can modify it
+        """
+        current_batch = ConfigBatch.current()
+        pending = current_batch.pending(self) if current_batch else None
+        if pending is not None:
+            return pending
+
+        fingerprint = self.fingerprint()
+        if fingerprint is None:
+            # Can not validate a snapshot (e.g. FakeFs), always parse
+            return super(NodeConfigFile, self).get_dict()
+
+        with self._snapshots_lock:
+            snapshot = self._snapshots.get(self.path)
+            if snapshot and snapshot[0] == fingerprint:
+                self._snapshot_stats["hits"] += 1
+                return dict(snapshot[1])
+            self._snapshot_stats["misses"] += 1
+
+        cfg = super(NodeConfigFile, self).get_dict()
+        with self._snapshots_lock:
+            self._snapshots[self.path] = (fingerprint, cfg)
+        return dict(cfg)
+
+    def write(self, cfg, remove_empty=True, batch=True):
+        """Write a dictinory as a key-val file
+
+        Args:
+            batch: If the write can be deferred to the active ConfigBatch
+        """
+        current_batch = ConfigBatch.current() if batch else None
+        if current_batch:
+            cfg = self._sanitize(cfg, remove_empty)
+            if self.is_unchanged(cfg):
+                return False
+            current_batch.defer(self, cfg)
+            return True
+        return super(NodeConfigFile, self).write(cfg, remove_empty)
+
+    def update(self, new_dict, remove_empty):
+        with self._update_lock:
+            return super(NodeConfigFile, self).update(new_dict, remove_empty)
+
+    def _write_contents(self, data):
+        self.invalidate_snapshot()
+        try:
+            super(NodeConfigFile, self)._write_contents(data)
+        finally:
+            self.invalidate_snapshot()
+
+    def invalidate_snapshot(self):
+        """Drop the shared snapshot of this file
+        """
+        with self._snapshots_lock:
+            self._snapshots.pop(self.path, None)
+
+    @classmethod
+    def snapshot_stats(cls):
+        """Returns the hit and miss counters of the shared snapshots
+        """
+        with cls._snapshots_lock:
+            return dict(cls._snapshot_stats)
+
+    @classmethod
+    def reset_snapshot_stats(cls):
+        with cls._snapshots_lock:
+            cls._snapshot_stats.update(hits=0, misses=0)
+
+
+class SectionSchema(object):
+    """The mapping between the arguments of a section's update() method and
+    the keys of the section
+
+    It is created once for each section class when it gets defined.
+
+    >>> class Foo(object):
+    ...     keys = ("OVIRT_A", "OVIRT_B")
+    ...     @NodeConfigFileSection.map_and_update_defaults_decorator
+    ...     def update(self, a, b="bee"):
+    ...         pass
+    >>> schema = SectionSchema.for_section(Foo)
+    >>> schema.args
+    ('a', 'b')
+    >>> schema.key_to_arg["OVIRT_B"]
+    'b'
+    >>> schema.arg_to_key["a"]
+    'OVIRT_A'
+    >>> schema.defaults
+    {'b': 'bee'}
+
+    The number of keys and arguments must match:
+
+    >>> Foo.keys = ("OVIRT_A", )
+    >>> SectionSchema.for_section(Foo)  #doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    ...
+    InvalidData: "Foo: update() arguments ... do not match keys ..."
+    """
+    keys = None
+    args = None
+    key_to_arg = None
+    arg_to_key = None
+    defaults = None
+
+    def __init__(self, keys, args, defaults=None):
+        self.keys = tuple(keys)
+        self.args = tuple(args)
+        self.key_to_arg = dict(zip(self.keys, self.args))
+        self.arg_to_key = dict(zip(self.args, self.keys))
+        defaults = defaults or ()
+        self.defaults = dict(zip(self.args[len(self.args) - len(defaults):],
+                                 defaults))
+
+    @staticmethod
+    def for_section(section):
+        """Build and validate the schema of a section class
+
+        Returns:
+            The schema or None if the update() method of the section is not
+            decorated by map_and_update_defaults_decorator
+        """
+        func = getattr(section.update, "wrapped_func", None)
+        if func is None:
+            return None
+        name = section.__name__
+        keys = section.keys
+        if type(keys) not in [tuple, list] or \
+           not all(type(k) is str for k in keys):
+            raise exceptions.InvalidData("%s: keys must be a tuple of "
+                                         "strings: %r" % (name, keys))
+        if len(set(keys)) != len(keys):
+            raise exceptions.InvalidData("%s: keys are not unique: %s" %
+                                         (name, keys))
+        # co_varnames contains all args within the func, the args are kept
+        # at the beginning of the list, that's why we slice the varnames list
+        # (start after self until the number of args)
+        code = func.func_code
+        args = code.co_varnames[1:code.co_argcount]
+        if len(args) != len(keys):
+            raise exceptions.InvalidData("%s: update() arguments %s do not "
+                                         "match keys %s" % (name, args,
+                                                            tuple(keys)))
+        return SectionSchema(keys, args, func.func_defaults)
+
+
+class NodeConfigFileSectionType(type):
+    """Computes the schema of each section class when it gets defined and
+    keeps a registry of all sections
+    """
+    registry = {}
+
+    def __init__(cls, name, bases, attrs):
+        super(NodeConfigFileSectionType, cls).__init__(name, bases, attrs)
+        cls.schema = SectionSchema.for_section(cls)
+        if cls.schema:
+            path = "%s.%s" % (cls.__module__, name)
+            NodeConfigFileSectionType.registry[path] = cls
+
+
+def sections():
+    """Returns all section classes which were defined (imported) so far
+
+    >>> Keyboard in sections()
+    True
+    """
+    registry = NodeConfigFileSectionType.registry
+    return [registry[path] for path in sorted(registry)]
+
+
+def all_keys():
+    """Returns a dict mapping all known config keys to their section class
+
+    >>> all_keys()["OVIRT_KEYBOARD_LAYOUT"]
+    <class 'ovirt.node.config.defaults.Keyboard'>
+    """
+    return dict((key, section) for section in sections()
+                for key in section.schema.keys)
+
 
 class NodeConfigFileSection(base.Base):
+    __metaclass__ = NodeConfigFileSectionType
+
     none_value = None
     keys = []
     raw_file = None
+    schema = None
+
+    # If the last update() or clear() changed the defaults file
+    changed = None
+
+    # The configuration of the sections applied during this boot, see
+    # pending_transaction()
+    applied_filename = "/run/ovirt-node/applied-sections.json"
+    _applied_lock = threading.Lock()
 
     def __init__(self, filename=None):
         super(NodeConfigFileSection, self).__init__()
@@ -95,6 +456,113 @@ class NodeConfigFileSection(base.Base):
         """
         raise NotImplementedError
 
+    def pending_transaction(self):
+        """The transaction() of this section, or an empty transaction if
+        the last update() did not change the configuration and the current
+        configuration was already applied during this boot
+
+        >>> import tempfile
+        >>> class Step(utils.Transaction.Element):
+        ...     def commit(self):
+        ...         print "Applied"
+        >>> class Section(NodeConfigFileSection):
+        ...     keys = ("OVIRT_A",)
+        ...     applied_filename = tempfile.mktemp()
+        ...     @NodeConfigFileSection.map_and_update_defaults_decorator
+        ...     def update(self, a):
+        ...         pass
+        ...     def transaction(self):
+        ...         return utils.Transaction("Apply", [Step()])
+
+        >>> fd, fn = tempfile.mkstemp()
+        >>> os.close(fd)
+        >>> section = Section(fn)
+        >>> _ = section.update("a")
+        >>> section.pending_transaction()()
+        Applied
+        True
+
+        An unchanged update does not apply the section again:
+
+        >>> _ = section.update("a")
+        >>> section.changed, len(section.pending_transaction())
+        (False, 0)
+
+        But it is applied if it was not applied before, e.g. if the
+        configuration was written by someone else:
+
+        >>> section.raw_file.write({"OVIRT_A": "b"})
+        True
+        >>> _ = section.update("b")
+        >>> section.changed, len(section.pending_transaction())
+        (False, 2)
+
+        >>> os.unlink(fn)
+        >>> os.unlink(Section.applied_filename)
+        """
+        if not self.changed and self._is_applied():
+            self.logger.debug("%s is unchanged and already applied" %
+                              self.__class__.__name__)
+            return utils.Transaction("%s is already applied" %
+                                     self.__class__.__name__)
+        tx = self.transaction()
+        if tx is not None:
+            tx.append(NodeConfigFileSection._MarkApplied(self))
+        return tx
+
+    class _MarkApplied(utils.Transaction.Element):
+        """Record the configuration of a section once it was applied
+        """
+        def __init__(self, section):
+            super(NodeConfigFileSection._MarkApplied, self).__init__()
+            self.section = section
+            self.title = "Recording the configuration"
+
+        def commit(self):
+            self.section._mark_applied()
+
+    @staticmethod
+    def _boot_id():
+        """The random id of the current boot, the applied configuration of
+        previous boots is ignored
+        """
+        try:
+            with open("/proc/sys/kernel/random/boot_id") as src:
+                return src.read().strip()
+        except IOError:
+            return ""
+
+    def _load_applied(self):
+        try:
+            with open(self.applied_filename) as src:
+                data = json.load(src)
+            if data.get("boot_id") == self._boot_id():
+                return data.get("sections", {})
+        except (IOError, ValueError, AttributeError):
+            pass
+        return {}
+
+    def _is_applied(self):
+        with self._applied_lock:
+            applied = self._load_applied()
+        return applied.get(self.__class__.__name__) == self.retrieve()
+
+    def _mark_applied(self):
+        with self._applied_lock:
+            applied = self._load_applied()
+            applied[self.__class__.__name__] = self.retrieve()
+            data = {"boot_id": self._boot_id(), "sections": applied}
+            try:
+                dirname = os.path.dirname(self.applied_filename)
+                if not os.path.isdir(dirname):
+                    os.makedirs(dirname, 0755)
+                with fs.AtomicFile(self.applied_filename, "w",
+                                   fsync="none") as dst:
+                    json.dump(data, dst)
+            except EnvironmentError:
+                self.logger.debug("Failed to record the applied "
+                                  "configuration", exc_info=True)
+
     def commit(self, *args, **kwargs):
         """Shotcut to run the transaction associtated with the class
 
@@ -111,16 +579,8 @@ class NodeConfigFileSection(base.Base):
         Returns:
             A dict mapping an argname to it's cfg key (or vice versa)
         """
-        func = self.update.wrapped_func
-        # co_varnames contains all args within the func, the args are kept
-        # at the beginning of the list, that's why we slice the varnames list
-        # (start after self until the number of args)
-        argnames = func.func_code.co_varnames[1:func.func_code.co_argcount]
-        assert len(argnames) == len(self.keys), "argnames (%s) != keys (%s)" %\
-            (argnames, self.keys)
-        mapping = zip(self.keys, argnames) if keys_to_args else zip(argnames,
-                                                                    self.keys)
-        return dict(mapping)
+        schema = self.schema
+        return schema.key_to_arg if keys_to_args else schema.arg_to_key
 
     def retrieve(self):
         """Returns the config keys of the current component
@@ -130,30 +590,27 @@ class NodeConfigFileSection(base.Base):
             arg corresponds to the named arguments of the subclass's
             configure() method.
         """
-        keys_to_args = self._args_to_keys_mapping(keys_to_args=True)
+        keys_to_args = self.schema.key_to_arg
         cfg = self.raw_file.get_dict()
-        model = {}
-        for key in self.keys:
-            value = cfg[key] if key in cfg else self.none_value
-            model[keys_to_args[key]] = value
-        assert len(keys_to_args) == len(model)
-        return model
+        none_value = self.none_value
+        return dict((arg, cfg.get(key, none_value))
+                    for key, arg in keys_to_args.iteritems())
 
     def clear(self, keys=None):
         """Remove the configuration for this item
         """
         keys = keys or self.keys
-        cfg = self.raw_file.get_dict()
+        # update() merges with the current contents under the update lock,
+        # so concurrent updates of other keys are kept
         to_be_deleted = dict((k, None) for k in keys)
-        cfg.update(to_be_deleted)
-        self.raw_file.update(cfg, remove_empty=True)
+        self.changed = self.raw_file.update(to_be_deleted, remove_empty=True)
 
     def _map_config_and_update_defaults(self, *args, **kwargs):
         assert len(args) == 0
         assert (set(self.keys) ^ set(kwargs.keys())) == set(), \
             "Keys: %s, Args: %s" % (self.keys, kwargs)
         new_dict = dict((k.upper(), v) for k, v in kwargs.items())
-        self.raw_file.update(new_dict, remove_empty=True)
+        self.changed = self.raw_file.update(new_dict, remove_empty=True)
 
         # Returning self allows chaining for decorated functions
         return self
@@ -287,6 +744,7 @@ class Network(NodeConfigFileSection):
             with console.CaptureOutput():
                 for name in services:
                     system.service(name, cmd, False)
+            process.invalidate(process.NETWORK)
 
         class StopNetworkServices(utils.Transaction.Element):
             title = "Stop network services"
@@ -926,9 +1384,11 @@ class Timeservers(NodeConfigFileSection):
             title = "Restarting time services"
 
             def commit(self):
-                system.service("ntpd", "stop", False)
-                if not disable:
-                    system.service("ntpd", "start", False)
+                if disable:
+                    system.service("ntpd", "stop", False)
+                else:
+                    # ntpd has no reload, it only reads ntp.conf on start
+                    self.request_service("ntpd", "restart", do_raise=False)
 
         tx = utils.Transaction("Configuring timeservers")
         tx.append(WriteConfiguration())
@@ -978,15 +1438,18 @@ class Syslog(NodeConfigFileSection):
 
             def commit(self):
                 rsyslog.configure(server, port or "514")
-                try:
-                    system.service("rsyslog", "restart")
-                    Config().persist("/etc/rsyslog.conf")
-                except:
-                    rsyslog.clear_config()
-                    self.logger.debug("Failed to configure syslog",
-                                      exc_info=True)
-                    raise RuntimeError("Failed to restart rsyslog, please "
-                                       "check the options passed")
+                Config().persist("/etc/rsyslog.conf")
+                # rsyslog only re-opens it's files on a HUP, a restart is
+                # needed to pick up the new forwarding rule
+                self.request_service("rsyslog", "restart", self.on_failure)
+
+            def on_failure(self):
+                rsyslog.clear_config()
+                Config().persist("/etc/rsyslog.conf")
+                self.logger.debug("Failed to configure syslog",
+                                  exc_info=True)
+                raise RuntimeError("Failed to restart rsyslog, please "
+                                   "check the options passed")
 
         tx = utils.Transaction("Configuring syslog")
         tx.append(CreateRsyslogConfig())
@@ -1176,8 +1639,8 @@ class KDump(NodeConfigFileSection):
             def commit(self):
                 try:
                     system.Mount(nfs_path).umount()
-                    File("/etc/fstab").sed(r'\#.*{dir}#d'.format(
-                        dir=nfs_path))
+                    File("/etc/fstab").edit(fs.Editor().delete(
+                        re.escape(nfs_path)))
                 except utils.process.CalledProcessError:
                     self.logger.warning("Failed to umount %s" % nfs,
                                         exc_info=True)
@@ -1454,8 +1917,12 @@ class Netconsole(NodeConfigFileSection):
         def _clear_config():
             self.logger.info("Disabling netconsole")
             f = File("/etc/sysconfig/netconsole")
-            f.sed("/SYSLOGADDR/d")
-            f.sed("/SYSLOGPORT/d")
+            f.edit(fs.Editor().delete("SYSLOGADDR").delete("SYSLOGPORT"))
+
+        def on_failure():
+            _clear_config()
+            raise RuntimeError("Failed to restart netconsole "
+                               "service. Is the host resolvable?")
 
         def configure_netconsole(server, port):
             aug = utils.AugeasWrapper()
@@ -1464,12 +1931,8 @@ class Netconsole(NodeConfigFileSection):
                         server)
                 aug.set("/files/etc/sysconfig/netconsole/SYSLOGPORT",
                         port)
-                try:
-                    system.service("netconsole", "restart")
-                except:
-                    _clear_config()
-                    raise RuntimeError("Failed to restart netconsole "
-                                       "service. Is the host resolvable?")
+                utils.Transaction.ServicePlan.request("netconsole",
+                                                      "restart", on_failure)
             else:
                 _clear_config()
             fs.Config().persist("/etc/sysconfig/netconsole")
@@ -1883,7 +2346,7 @@ class Management(NodeConfigFileSection):
 class RuntimeImageState(NodeConfigFileSection):
     """Track informations about the image state
     """
-    keys = ("RUNTIME_IMAGE_FINGERPRINT_LAST"
+    keys = ("RUNTIME_IMAGE_FINGERPRINT_LAST",
             )
 
     product_nvr = str(system.ProductInformation())
@@ -146,10 +146,11 @@ class NicConfig(base.Base):
             for k in self.cfg._keys:
                 data[k.upper()] = self.cfg.__dict__.get(k)
 
-            ShellVarFile.write(self, data, True)
+            changed = ShellVarFile.write(self, data, True)
 
             pcfg = fs.Config()
-            if pcfg.is_enabled():
+            if pcfg.is_enabled() and \
+               (changed or not pcfg.exists(self.filename, False)):
                 pcfg.persist(self.filename)
 
             return data
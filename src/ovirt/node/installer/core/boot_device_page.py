@@ -85,6 +85,8 @@ class Plugin(plugins.NodePlugin):
                         ui.SaveButton("button.next", _("Continue"))]
 
         self.widgets.add(page)
+        # Hotplugged devices are added to the table
+        self.storage_discovery.follow(self, "boot.device")
         return page
 
     def on_change(self, changes):
@@ -161,11 +163,45 @@ class StorageDiscovery(threading.Thread):
         super(StorageDiscovery, self).__init__()
         self.do_fake = do_fake
         self.refresh = refresh
+        self._followers = {}
 
     def run(self):
         self.devices = utils.storage.Devices(fake=self.do_fake,
                                              refresh=self.refresh)
         self._all_devices = self.devices.get_all()
+        if not self.do_fake:
+            table = utils.storage.BlockDeviceTable.shared()
+            table.on_change.connect(self._on_devices_change)
+
+    def follow(self, plugin, path):
+        """Update the rows of the ui.Table at path of the plugin when
+        devices appear, change or vanish
+        """
+        self._followers[path] = (plugin,
+                                 plugin.application.ui.thread_connection())
+
+    def _on_devices_change(self, table, changes):
+        live_disk = self.devices.live_disk_name()
+        rows = []
+        for name, device in changes.items():
+            if name == live_disk:
+                continue
+            if device:
+                self._all_devices[name] = device
+                rows.append((name, self._tbl_row(device)))
+            else:
+                self._all_devices.pop(name, None)
+                rows.append((name, None))
+
+        for path, (plugin, ui_thread) in self._followers.items():
+            def update(plugin=plugin, path=path):
+                if path in plugin.widgets:
+                    plugin.widgets[path].update_items(rows)
+            ui_thread.call(update)
+
+    def _tbl_row(self, device):
+        return self.tbl_tpl.format(bus=device.bus, name=device.name,
+                                   size=device.size)
 
     def all_devices(self):
         """Return a list of all devices
@@ -185,8 +221,7 @@ class StorageDiscovery(threading.Thread):
             A list of strings to be used with ui.Table
         """
         all_devices = self.all_devices().items()
-        devices = sorted([(name, self.tbl_tpl.format(bus=d.bus, name=d.name,
-                                                     size=d.size))
+        devices = sorted([(name, self._tbl_row(d))
                           for name, d in all_devices], key=lambda t: t[0])
 
         return devices
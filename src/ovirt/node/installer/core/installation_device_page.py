@@ -113,6 +113,8 @@ class Plugin(plugins.NodePlugin):
         # when the highlighted entry is changed.
         table = self.widgets["installation.device.current"]
         table.on_change.connect(self.__update_details)
+        # Hotplugged devices are added to the table
+        self.storage_discovery.follow(self, "installation.device.current")
 
         return page
 
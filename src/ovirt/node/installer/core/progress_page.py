@@ -109,6 +109,7 @@ class InstallerThread(threading.Thread):
 
             transaction = self.__build_transaction()
             txlen = len(transaction)
+            trace_mark = utils.Transaction.Trace.mark()
 
             for idx, tx_element in transaction.step():
                 idx += 1
@@ -135,6 +136,12 @@ class InstallerThread(threading.Thread):
                     log.text("\n".join(log_lines))
                 self.ui_thread.call(update_ui)
 
+            trace = utils.Transaction.Trace
+            self.logger.info("Installation trace:\n%s" %
+                             trace.summary(trace_mark, top=20))
+            log_lines.extend(trace.summary(trace_mark, top=3).splitlines())
+            self.ui_thread.call(lambda: log.text("\n".join(log_lines)))
+
         except Exception as e:
             self.logger.exception("Installer transaction failed")
             msg = "Exception: %s" % repr(e)
@@ -174,7 +174,7 @@ class Plugin(plugins.NodePlugin):
                 model.configure_local()
             else:
                 model.configure_disable()
-            txs += model.transaction()
+            txs += model.pending_transaction()
 
         try:
             with self.application.ui.suspended():
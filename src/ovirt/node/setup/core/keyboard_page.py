@@ -86,7 +86,7 @@ class Plugin(plugins.NodePlugin):
         if changes.contains_any(layout_keys):
             model = defaults.Keyboard()
             model.update(*effective_model.values_for(layout_keys))
-            txs += model.transaction()
+            txs += model.pending_transaction()
 
         progress_dialog = ui.TransactionProgressDialog("dialog.txs", txs, self)
         progress_dialog.run()
@@ -135,19 +135,19 @@ class Plugin(plugins.NodePlugin):
             model = defaults.Logrotate()
             # And update the defaults
             model.update(*effective_model.values_for(logrotate_keys))
-            txs += model.transaction()
+            txs += model.pending_transaction()
 
         rsyslog_keys = ["rsyslog.address", "rsyslog.port"]
         if changes.contains_any(rsyslog_keys):
             model = defaults.Syslog()
             model.update(*effective_model.values_for(rsyslog_keys))
-            txs += model.transaction()
+            txs += model.pending_transaction()
 
         netconsole_keys = ["netconsole.address", "netconsole.port"]
         if changes.contains_any(netconsole_keys):
             model = defaults.Netconsole()
             model.update(*effective_model.values_for(netconsole_keys))
-            txs += model.transaction()
+            txs += model.pending_transaction()
 
         progress_dialog = ui.TransactionProgressDialog("dialog.txs", txs, self)
         progress_dialog.run()
@@ -81,7 +81,7 @@ class Plugin(plugins.NodePlugin):
         if changes.contains_any(collectd_keys):
             model = defaults.Collectd()
             model.update(*effective_model.values_for(collectd_keys))
-            txs += model.transaction()
+            txs += model.pending_transaction()
 
         progress_dialog = ui.TransactionProgressDialog("dialog.txs", txs, self)
         progress_dialog.run()
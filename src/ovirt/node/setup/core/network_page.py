@@ -372,7 +372,7 @@ class Plugin(plugins.NodePlugin):
             self.logger.info("Setting new nameservers: %s" % nameservers)
             model = defaults.Nameservers()
             model.update(nameservers)
-            txs += model.transaction()
+            txs += model.pending_transaction()
 
         timeservers = []
         ntp_keys = ["ntp[0]", "ntp[1]"]
@@ -382,7 +382,7 @@ class Plugin(plugins.NodePlugin):
             self.logger.info("Setting new timeservers: %s" % timeservers)
             model = defaults.Timeservers()
             model.update(timeservers)
-            txs += model.transaction()
+            txs += model.pending_transaction()
 
         hostname_keys = ["hostname"]
         if effective_changes.contains_any(hostname_keys):
@@ -390,7 +390,7 @@ class Plugin(plugins.NodePlugin):
             self.logger.info("Setting new hostname: %s" % value)
             model = defaults.Hostname()
             model.update(*value)
-            txs += model.transaction()
+            txs += model.pending_transaction()
 
         # For the NIC details dialog:
         if effective_changes.contains_any(self._nic_details_group):
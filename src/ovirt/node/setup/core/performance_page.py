@@ -81,7 +81,7 @@ class Plugin(plugins.NodePlugin):
             model.update(effective_model["tuned.profile"])
 
             # Get transaction for keys:
-            txs = model.transaction()
+            txs = model.pending_transaction()
 
             # Run transaction in nice UI:
             ui.TransactionProgressDialog("dialog.txs", txs, self).run()
@@ -113,7 +113,7 @@ class Plugin(plugins.NodePlugin):
             if valid.IPv6Address().validate(addr):
                 cmd = "ping6"
 
-            cmd = "%s -c %s %s" % (cmd, count, addr)
+            cmd = [cmd, "-c", count, addr]
 
             ping = PingThread(self, cmd, count)
             ping.start()
@@ -133,8 +133,14 @@ class PingThread(threading.Thread):
 
             self.p.widgets["ping.do_ping"].enabled(False)
             ui_thread.call(lambda: stdoutdump.text("Pinging ..."))
-            out = process.pipe(self.cmd, shell=True)
-            ui_thread.call(lambda: stdoutdump.text(out))
+            # Show the replies as they arrive
+            out = ""
+            for line in process.stream(self.cmd,
+                                       timeout=int(self.count) * 2 + 10):
+                out += line
+                ui_thread.call(lambda text=out: stdoutdump.text(text))
+        except process.TimeoutExpired:
+            ui_thread.call(lambda: stdoutdump.text(out + "\nTimed out"))
         except:
             self.p.logger.exception("Exception while pinging")
         finally:
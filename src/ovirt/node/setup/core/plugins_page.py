@@ -167,20 +167,34 @@ class Plugin(NodePlugin):
             self.logger.debug("SET NO")
             return False
 
+    def __rpm_query(self, cmd):
+        """Returns the output of the rpm query, or None if it failed
+        """
+        # The rpm database is only changed by (un)installing packages,
+        # so the results can be kept for a while
+        if process.cached_call(cmd, ttl=300,
+                               invalidate_on=[process.PACKAGES]) != 0:
+            return None
+        return process.cached_output(cmd, ttl=300,
+                                     invalidate_on=[process.PACKAGES]
+                                     ).strip()
+
     def __parse_regex(self, plugin_dir, f, plugin_dict):
         try:
-            cmd = '/bin/rpm -qf %s/%s --qf %%{name}' % \
-                (plugin_dir, f)
-            package = process.check_output(cmd.split(' ')
-                                           ).strip()
-            cmd = "rpm -q %s --qf 'NAME: %s DATE: " \
-                  "%%{version}-%%{release}.%%{arch} INST: " \
-                  "%%{INSTALLTIME:date}\\n'" %\
-                (package, package)
+            cmd = ["/bin/rpm", "-qf", "%s/%s" % (plugin_dir, f),
+                   "--qf", "%{name}"]
+            package = self.__rpm_query(cmd)
+            if not package:
+                self.logger.debug("SET NO")
+                return False
+            cmd = ["rpm", "-q", package, "--qf",
+                   "NAME: %s DATE: %%{version}-%%{release}.%%{arch} "
+                   "INST: %%{INSTALLTIME:date}\\n" % package]
             name, ver, install_date = re.match(
                 r'NAME: (.*?) DATE: (.*?) INST: (.*)',
-                process.check_output(cmd, shell=True
-                                     ).strip()).groups()
+                process.cached_output(cmd, ttl=300,
+                                      invalidate_on=[process.PACKAGES]
+                                      ).strip()).groups()
             plugin_dict[name] = (ver.strip(), install_date)
             return True
 
@@ -190,17 +204,19 @@ class Plugin(NodePlugin):
 
     def __parse_rpmlist(self, plugin_dir, f, plugin_dict):
         try:
-            cmd = 'rpm -q --qf %%{name} %s' % f
-            package = process.check_output(cmd.split(' ')
-                                           ).strip()
-            cmd = "rpm -q %s --qf 'NAME: %s DATE: " \
-                  "%%{version}-%%{release}.%%{arch} INST: " \
-                  "%%{INSTALLTIME:date}\\n'" %\
-                (package, package)
+            cmd = ["rpm", "-q", "--qf", "%{name}", f]
+            package = self.__rpm_query(cmd)
+            if not package:
+                self.logger.debug("SET NO")
+                return False
+            cmd = ["rpm", "-q", package, "--qf",
+                   "NAME: %s DATE: %%{version}-%%{release}.%%{arch} "
+                   "INST: %%{INSTALLTIME:date}\\n" % package]
             name, ver, install_date = re.match(
                 r'NAME: (.*?) DATE: (.*?) INST: (.*)',
-                process.check_output(cmd, shell=True
-                                     ).strip()).groups()
+                process.cached_output(cmd, ttl=300,
+                                      invalidate_on=[process.PACKAGES]
+                                      ).strip()).groups()
             plugin_dict[name] = (ver.strip(), install_date)
             return True
 
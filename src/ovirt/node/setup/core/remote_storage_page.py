@@ -100,21 +100,21 @@ class Plugin(plugins.NodePlugin):
             args = effective_model.values_for(iscsi_keys)
             args += [None, None, None]  # No target config
             model.update(*args)
-            txs += model.transaction()
+            txs += model.pending_transaction()
 
         nfsv4_keys = ["nfsv4.domain"]
         if changes.contains_any(nfsv4_keys):
             model = defaults.NFSv4()
             args = effective_model.values_for(nfsv4_keys)
             model.update(*args)
-            txs += model.transaction()
+            txs += model.pending_transaction()
 
         scsi_keys = ["scsi.dh_alua"]
         if changes.contains_any(scsi_keys):
             model = defaults.SCSIDhAlua()
             args = effective_model.values_for(scsi_keys)
             model.update(*args)
-            txs += model.transaction()
+            txs += model.pending_transaction()
 
         progress_dialog = ui.TransactionProgressDialog("dialog.txs", txs, self)
         progress_dialog.run()
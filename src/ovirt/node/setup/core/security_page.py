@@ -108,7 +108,7 @@ class Plugin(plugins.NodePlugin):
         if changes.contains_any(ssh_keys):
             model = defaults.SSH()
             model.update(*effective_model.values_for(ssh_keys))
-            txs += model.transaction()
+            txs += model.pending_transaction()
 
         if changes.contains_any(["passwd.admin.password"]):
             pw = effective_model["passwd.admin.password"]
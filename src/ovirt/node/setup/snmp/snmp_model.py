@@ -65,8 +65,7 @@ def disable_snmpd():
     system.service("snmpd", "stop")
     # copy to /tmp for enable/disable toggles w/o reboot
     process.check_call(["cp", "/etc/snmp/snmpd.conf", "/tmp"])
-    process.check_call("sed -c -ie '/^createUser root/d' %s" % snmp_conf,
-                       shell=True)
+    fs.File(snmp_conf).edit(fs.Editor().delete("^createUser root"))
     configs = [snmp_conf, snmp_dir]
     [fs.Config().unpersist(c) for c in configs if fs.Config().exists(c)]
 
@@ -0,0 +1,76 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# subprocesses.py - Copyright (C) 2014 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.  A copy of the GNU General Public License is
+# also available at http://www.gnu.org/copyleft/gpl.html.
+from ovirt.node.utils import process
+import json
+import optparse
+import os
+import signal
+import sys
+import time
+
+
+"""
+Show which spawned processes took the most time in the TUI or installer
+
+The running process is asked to dump it's accounting (see
+process.install_accounting_handler) and the dump is shown as a table:
+
+python -m ovirt.node.tools.subprocesses --pid $(pgrep -f ovirt.node.setup)
+"""
+
+
+def request_dump(pid, filename, timeout=5):
+    """Signal pid to dump it's accounting and wait until it was written
+    """
+    mtime = os.path.getmtime(filename) if os.path.exists(filename) else None
+    os.kill(pid, signal.SIGUSR2)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if os.path.exists(filename) and \
+           os.path.getmtime(filename) != mtime:
+            return True
+        time.sleep(0.1)
+    return False
+
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser(usage="%prog [options] [DUMPFILE]",
+                                   description="Node Subprocess Accounting")
+    parser.add_option("-p", "--pid", type="int",
+                      help="Ask this process for a fresh dump first")
+    parser.add_option("-j", "--json", action="store_true",
+                      help="Print the raw records instead of the table")
+    parser.add_option("-n", "--limit", type="int", default=20,
+                      help="Number of commands in the table")
+    namespace, rest = parser.parse_args()
+
+    filename = rest[0] if rest else process.ACCOUNTING_DUMP
+
+    if namespace.pid and not request_dump(namespace.pid, filename):
+        sys.exit("Process %d did not dump to '%s'" %
+                 (namespace.pid, filename))
+
+    with open(filename) as src:
+        entries = json.load(src)
+
+    if namespace.json:
+        print json.dumps(entries, indent=2)
+    else:
+        print "\n".join(process.accounting_top(entries, namespace.limit))
@@ -568,6 +568,7 @@ class Table(InputElement):
     """
     _selected = None
     on_activate = None
+    on_items_change = None
 
     def __init__(self, path, label, header, items, selected_item=None,
                  height=5, enabled=True, multi=False):
@@ -596,6 +597,7 @@ class Table(InputElement):
         self.height = height
         self.multi = multi
         self.on_activate = self.new_signal()
+        self.on_items_change = self.new_signal()
         if multi:
             self.selection(selected_item or [])
             self.on_activate.connect(ChangeAction())
@@ -606,6 +608,26 @@ class Table(InputElement):
             self.on_activate.connect(ChangeAction())
             self.on_activate.connect(SaveAction())
 
+    def update_items(self, items):
+        """Update some items, without rebuilding the whole table
+
+        Args:
+            items: A list of tuples (key, label), items with a new key are
+                   appended, items with a label of None are removed
+        """
+        new_items = list(self.items)
+        for key, label in items:
+            keys = [k for k, _ in new_items]
+            if key in keys:
+                if label is None:
+                    del new_items[keys.index(key)]
+                else:
+                    new_items[keys.index(key)] = (key, label)
+            elif label is not None:
+                new_items.append((key, label))
+        self.items = new_items
+        self.on_items_change(items)
+
     def selection(self, selected=None):
         """Get/Select the given item (key) or multiple items if multi
 
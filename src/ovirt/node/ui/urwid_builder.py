@@ -270,6 +270,18 @@ class UrwidUIBuilder(ui.AbstractUIBuilder):
 
         ui_table.on_value_change.connect(on_item_value_change_cb)
 
+        def on_items_change_cb(t, items):
+            children = []
+            for key, label in items:
+                c = None
+                if label is not None:
+                    c = self._build_tableitem(ui_table, key, label)
+                    c._table = widget
+                children.append((key, c))
+            widget.update_items(children)
+
+        ui_table.on_items_change.connect(on_items_change_cb)
+
         return widget
 
     def _build_tableitem(self, ui_table, key, label):
@@ -175,6 +175,9 @@ class TableWidget(NoticeDecoration):
         def __on_item_change():
             widget, self._position = self.__list.get_focus()
             self._update_scrollbar()
+            if widget is None:
+                # All items were removed
+                return
             urwid.emit_signal(self, "changed", widget)
         urwid.connect_signal(self.__walker, 'modified', __on_item_change)
 
@@ -217,6 +220,22 @@ class TableWidget(NoticeDecoration):
             if c._key == key:
                     self.set_focus(self.__items.index(c))
 
+    def update_items(self, items):
+        """Replace, append or remove (if the widget is None) the items
+        given as a list of (key, widget) tuples
+        """
+        for key, widget in items:
+            keys = [c._key for c in self.__walker]
+            if key in keys:
+                if widget is None:
+                    del self.__walker[keys.index(key)]
+                else:
+                    self.__walker[keys.index(key)] = widget
+            elif widget is not None:
+                self.__walker.append(widget)
+        self.__items[:] = list(self.__walker)
+        self._update_scrollbar()
+
     def selection(self, selection=None):
         if selection:
             for c in self.__items:
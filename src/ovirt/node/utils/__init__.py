@@ -19,8 +19,16 @@
 # MA  02110-1301, USA.  A copy of the GNU General Public License is
 # also available at http://www.gnu.org/copyleft/gpl.html.
 from ovirt.node import base, exceptions
+import Queue
 import augeas as _augeas
+import contextlib
+import functools
+import json
 import lockfile
+import logging
+import os
+import sys
+import threading
 import time
 import traceback
 
@@ -42,44 +50,58 @@ And this package contains reliable functions to common operating system tasks.
 
 
 class AugeasWrapper(base.Base):
+    """Access to the Augeas handle shared by all instances
+
+    The handle is not thread-safe, so all calls are serialized by _lock.
+    Use the lock directly to do several calls atomically.
+    """
     _aug = _augeas.Augeas()
+    _lock = threading.RLock()
 
     def __init__(self):
         super(AugeasWrapper, self).__init__()
 #        self._aug = _augeas.Augeas() # Is broken
-        self._aug.set("/augeas/save/copy_if_rename_fails", "")
+        with self._lock:
+            self._aug.set("/augeas/save/copy_if_rename_fails", "")
 
     @staticmethod
     def force_reload():
         """Needs to be called when files were changed on-disk without using Aug
         """
-        AugeasWrapper._aug.load()
+        with AugeasWrapper._lock:
+            AugeasWrapper._aug.load()
 
     def get(self, p, strip_quotes=False):
-        v = self._aug.get(p)
+        with self._lock:
+            v = self._aug.get(p)
         # v can be many types str, bool, ...
         if type(v) in [str, unicode] and strip_quotes:
             v = unicode(v).strip("'\"")
         return v
 
     def set(self, p, v, do_save=True):
-        self._aug.set(p, v)
-        if do_save:
-            self.save()
+        with self._lock:
+            self._aug.set(p, v)
+            if do_save:
+                self.save()
 
     def remove(self, p, do_save=True):
-        self._aug.remove(p)
-        if do_save:
-            self.save()
+        with self._lock:
+            self._aug.remove(p)
+            if do_save:
+                self.save()
 
     def save(self):
-        return self._aug.save()
+        with self._lock:
+            return self._aug.save()
 
     def match(self, p):
-        return self._aug.match(p)
+        with self._lock:
+            return self._aug.match(p)
 
     def load(self):
-        return self._aug.load()
+        with self._lock:
+            return self._aug.load()
 
     def set_many(self, new_dict, basepath=""):
         """Set's many augpaths at once
@@ -88,10 +110,11 @@ class AugeasWrapper(base.Base):
             new_dict: A dict with a mapping (path, value)
             basepath: An optional prefix for each path of new_dict
         """
-        for key, value in new_dict.items():
-            path = basepath + key
-            self.set(path, value)
-        return self.save()
+        with self._lock:
+            for key, value in new_dict.items():
+                path = basepath + key
+                self.set(path, value)
+            return self.save()
 
     def remove_many(self, paths, basepath=""):
         """Removes many keys at once
@@ -100,10 +123,11 @@ class AugeasWrapper(base.Base):
             paths: The paths to be removed
             basepath: An optional prefix for each path of new_dict
         """
-        for key in paths:
-            path = basepath + key
-            self.remove(path, False)
-        return self.save()
+        with self._lock:
+            for key in paths:
+                path = basepath + key
+                self.remove(path, False)
+            return self.save()
 
     def get_many(self, paths, strip_basepath="", basepath=""):
         """Get all values for all the paths
@@ -113,12 +137,13 @@ class AugeasWrapper(base.Base):
             strip_basepath: Prefix to be stripped from all paths
         """
         values = {}
-        for path in paths:
-            if strip_basepath:
-                path = path[len(strip_basepath):]
-            if basepath:
-                path = basepath + path
-            values[path] = self.get(path)
+        with self._lock:
+            for path in paths:
+                if strip_basepath:
+                    path = path[len(strip_basepath):]
+                if basepath:
+                    path = basepath + path
+                values[path] = self.get(path)
         return values
 
 
@@ -150,6 +175,177 @@ def parse_bool(txt):
     return False
 
 
+class TransactionTrace(base.Base):
+    """Times the prepare, commit and abort calls of all transaction elements
+    and the commands they run.
+
+    Each call is kept in memory and appended as a JSON line to filename.
+    Once filename grows beyond max_size it is moved to filename.1, so at
+    most two files are kept.
+
+    >>> from ovirt.node.utils import process
+    >>> class Step(Transaction.Element):
+    ...     title = "Run true"
+    ...     def commit(self):
+    ...         process.call(["true"])
+
+    >>> TransactionTrace.filename = None
+    >>> mark = TransactionTrace.mark()
+    >>> Step().commit()
+    >>> record = TransactionTrace.records(mark)[0]
+    >>> record["element"], record["phase"], record["failed"]
+    ('Step', 'commit', False)
+    >>> [c["cmd"] for c in record["subprocesses"]]
+    [['true']]
+    >>> print(TransactionTrace.summary(mark))  #doctest: +ELLIPSIS
+    Slowest steps:
+      ...s commit Run true (1 commands, ...s)
+    Slowest commands:
+      ...s true
+
+    A command is only attributed to the innermost element running it:
+
+    >>> class Outer(Transaction.Element):
+    ...     title = "Run false"
+    ...     def commit(self):
+    ...         Step().commit()
+    ...         process.call(["false"])
+    >>> mark = TransactionTrace.mark()
+    >>> Outer().commit()
+    >>> [(r["element"], [c["cmd"] for c in r["subprocesses"]])
+    ...  for r in TransactionTrace.records(mark)]
+    [('Step', [['true']]), ('Outer', [['false']])]
+
+    The file is rotated once it exceeds max_size:
+
+    >>> import tempfile
+    >>> TransactionTrace.filename = tempfile.mktemp()
+    >>> TransactionTrace.max_size = 1
+    >>> Step().commit()
+    >>> Step().commit()
+    >>> len(open(TransactionTrace.filename).readlines())
+    1
+    >>> len(open(TransactionTrace.filename + ".1").readlines())
+    1
+    >>> os.unlink(TransactionTrace.filename)
+    >>> os.unlink(TransactionTrace.filename + ".1")
+    >>> TransactionTrace.filename, TransactionTrace.max_size = None, 1 << 20
+    """
+    filename = "/var/log/ovirt-node-trace.jsonl"
+    max_size = 1 << 20
+
+    _records = []
+    _lock = threading.Lock()
+    _local = threading.local()
+
+    @staticmethod
+    def traced(phase, func):
+        """Decorate an element method to be traced
+        """
+        @functools.wraps(func)
+        def wrapper(element, *args, **kwargs):
+            return TransactionTrace.call(element, phase, func, args, kwargs)
+        return wrapper
+
+    @classmethod
+    def call(cls, element, phase, func, args, kwargs):
+        """Call and trace func (the phase method of element)
+        """
+        from ovirt.node.utils import process
+        key = (id(element), phase)
+        active = cls._local.__dict__.setdefault("active", set())
+        if key in active:
+            # Don't trace super() calls of the same element twice
+            return func(element, *args, **kwargs)
+
+        active.add(key)
+        recorder = process.recording()
+        record = {"element": element.__class__.__name__,
+                  "title": element.title,
+                  "phase": phase,
+                  "thread": threading.current_thread().name,
+                  "started": time.time(),
+                  "failed": True}
+        try:
+            with recorder:
+                retval = func(element, *args, **kwargs)
+            record["failed"] = False
+            return retval
+        finally:
+            active.discard(key)
+            record["duration"] = time.time() - record["started"]
+            record["subprocesses"] = recorder.calls
+            cls.add(record)
+
+    @classmethod
+    def add(cls, record):
+        with cls._lock:
+            cls._records.append(record)
+            if not cls.filename:
+                return
+            try:
+                cls._rotate()
+                with open(cls.filename, "a") as dst:
+                    dst.write(json.dumps(record, default=repr) + "\n")
+            except EnvironmentError:
+                cls.filename = None
+                logging.getLogger(__name__).debug("Failed to write trace",
+                                                  exc_info=True)
+
+    @classmethod
+    def _rotate(cls):
+        try:
+            size = os.path.getsize(cls.filename)
+        except OSError:
+            return
+        if size >= cls.max_size:
+            os.rename(cls.filename, cls.filename + ".1")
+
+    @classmethod
+    def mark(cls):
+        """Returns a marker which can be used to retrieve the records
+        added after this call
+        """
+        with cls._lock:
+            return len(cls._records)
+
+    @classmethod
+    def records(cls, since=0):
+        with cls._lock:
+            return list(cls._records[since:])
+
+    @classmethod
+    def summary(cls, since=0, top=5):
+        """A human readable summary of the slowest steps and commands
+        """
+        records = cls.records(since)
+        lines = ["Slowest steps:"]
+        for r in sorted(records, key=lambda r: -r["duration"])[:top]:
+            lines.append("  %.2fs %s %s (%d commands, %.2fs)" %
+                         (r["duration"], r["phase"], r["title"],
+                          len(r["subprocesses"]),
+                          sum(c["duration"] for c in r["subprocesses"])))
+        calls = [c for r in records for c in r["subprocesses"]]
+        lines.append("Slowest commands:")
+        for c in sorted(calls, key=lambda c: -c["duration"])[:top]:
+            cmd = c["cmd"]
+            if type(cmd) is list:
+                cmd = " ".join(cmd)
+            lines.append("  %.2fs %s" % (c["duration"], cmd))
+        return "\n".join(lines)
+
+
+class TransactionElementType(type):
+    """Wraps the prepare, commit and abort methods of all transaction
+    elements to trace them, see TransactionTrace
+    """
+    def __new__(mcs, name, bases, attrs):
+        for phase in ["prepare", "commit", "abort"]:
+            if phase in attrs:
+                attrs[phase] = TransactionTrace.traced(phase, attrs[phase])
+        return type.__new__(mcs, name, bases, attrs)
+
+
 class Transaction(base.Base):
     """A very simple transaction mechanism.
 
@@ -237,13 +433,43 @@ title='First' at 0x...>
     >>> txs  #doctest: +ELLIPSIS
     [<Transaction elements='[<StepA 'None'>]' title='Step A' at 0x...>, \
 <Transaction elements='[<StepB 'None'>]' title='Step B' at 0x...>]
+
+    Elements which are marked as parallel can be committed concurrently, if
+    max_workers is larger than 1. Elements sharing a resource, elements
+    which require each other, and elements which are not parallel are
+    still committed in the order of the transaction.
+
+    >>> class Sleep(Transaction.Element):
+    ...     parallel = True
+    ...     def __init__(self, title, resources=()):
+    ...         super(Sleep, self).__init__()
+    ...         self.title = title
+    ...         self.resources = resources
+    ...     def commit(self):
+    ...         time.sleep(0.1)
+
+    >>> tx = Transaction("Parallel", [Sleep("a"), Sleep("b"), Sleep("c"),
+    ...                               Sleep("d", ["x"]), Sleep("e", ["x"])])
+    >>> tx.max_workers = 4
+    >>> with Timer() as t:
+    ...     [e.title for idx, e in tx.commit_steps()]
+    ['a', 'b', 'c', 'd', 'e']
+    >>> t.duration() < 0.3
+    True
+
+    >>> tx.dependencies()
+    [set([]), set([]), set([]), set([]), set([3])]
     """
     title = None
     _lockfilename = "/tmp/transaction-in-progress"
     _prepared_elements = None
+    _local = threading.local()
 
     elements = None
 
+    # Up to how many elements are committed at the same time
+    max_workers = 1
+
     def __init__(self, title, elements=None):
         super(Transaction, self).__init__()
         self.title = title
@@ -263,10 +489,122 @@ title='First' at 0x...>
         return True
 
     def commit(self):
-        for element in self.elements:
+        for idx, element in self.commit_steps():
+            pass
+        return True
+
+    def commit_steps(self):
+        """Commit all elements
+
+        Independent elements are committed concurrently if max_workers is
+        larger than 1.
+
+        Returns:
+            A generator yielding (idx, element) in the order of the
+            transaction, each after the element was committed
+        """
+        if self.max_workers > 1:
+            return self._commit_parallel()
+        return self._commit_sequential()
+
+    def _commit_sequential(self):
+        for idx, element in enumerate(self.elements):
             self.logger.debug("Committing element '%s'" % element)
             element.commit()
-        return True
+            yield (idx, element)
+
+    def dependencies(self):
+        """Returns for each element the set of indexes of the elements which
+        need to be committed before it
+
+        An element depends on all previous elements, unless both are
+        parallel, do not share a resource and do not require each other.
+        """
+        deps = []
+        for idx, element in enumerate(self.elements):
+            after = set()
+            for pidx, previous in enumerate(self.elements[:idx]):
+                if not (getattr(element, "parallel", False) and
+                        getattr(previous, "parallel", False)):
+                    after.add(pidx)
+                elif set(element.resources) & set(previous.resources):
+                    after.add(pidx)
+                elif isinstance(previous, tuple(element.requires)) or \
+                        isinstance(element, tuple(previous.requires)):
+                    after.add(pidx)
+            deps.append(after)
+        return deps
+
+    def _commit_parallel(self):
+        """Commit the elements on up to max_workers threads
+
+        If an element fails, no further elements are started, the running
+        ones are waited for and the first failure is raised.
+        """
+        deps = self.dependencies()
+        pending = range(len(self.elements))
+        running = set()
+        committed = set()
+        results = Queue.Queue()
+        plan = Transaction.ServicePlan.current()
+        failure = None
+        next_idx = 0
+
+        def commit_element(idx, element):
+            # The committing thread holds the lock and the plan
+            Transaction._local.locked = True
+            Transaction.ServicePlan._local.plan = plan
+            try:
+                self.logger.debug("Committing element '%s'" % element)
+                element.commit()
+                results.put((idx, None))
+            except:
+                results.put((idx, sys.exc_info()))
+
+        try:
+            while next_idx < len(self.elements):
+                for idx in list(pending):
+                    if failure or len(running) >= self.max_workers:
+                        break
+                    if deps[idx] <= committed:
+                        pending.remove(idx)
+                        running.add(idx)
+                        worker = threading.Thread(target=commit_element,
+                                                  args=(idx,
+                                                        self.elements[idx]))
+                        worker.daemon = True
+                        worker.start()
+                if not running:
+                    break
+                idx, exc_info = results.get()
+                running.remove(idx)
+                if exc_info:
+                    self.logger.debug("Element '%s' failed" %
+                                      self.elements[idx])
+                    failure = failure or exc_info
+                else:
+                    committed.add(idx)
+                while next_idx in committed:
+                    yield (next_idx, self.elements[next_idx])
+                    next_idx += 1
+        finally:
+            while running:
+                running.remove(results.get()[0])
+        if failure:
+            raise failure[0], failure[1], failure[2]
+
+    @contextlib.contextmanager
+    def _lock(self):
+        """Acquire the transaction lock
+
+        Threads committing elements of a parallel transaction are using the
+        lock of the thread which runs the transaction.
+        """
+        if getattr(Transaction._local, "locked", False):
+            yield
+        else:
+            with lockfile.FileLock(self._lockfilename):
+                yield
 
     def abort(self):
         for element in self._prepared_elements:
@@ -278,9 +616,10 @@ title='First' at 0x...>
     def run(self):
         self.logger.debug("Running transaction '%s'" % self)
         try:
-            with lockfile.FileLock(self._lockfilename):
-                self.prepare()
-                self.commit()
+            with self._lock():
+                with Transaction.ServicePlan():
+                    self.prepare()
+                    self.commit()
         except Exception as e:
             self.logger.debug("Transaction failed: %s" % e,
                               exc_info=True)
@@ -327,11 +666,12 @@ title='First' at 0x...>
 
     def step(self):
         try:
-            with lockfile.FileLock(self._lockfilename):
-                self.logger.debug("Preparing transaction %s" % self)
-                self.prepare()
-                for idx, e in enumerate(self.elements):
-                    yield (idx, e)
+            with self._lock():
+                with Transaction.ServicePlan():
+                    self.logger.debug("Preparing transaction %s" % self)
+                    self.prepare()
+                    for idx, e in enumerate(self.elements):
+                        yield (idx, e)
         except lockfile.NotLocked:
             self.logger.warning("The lockfile wasn't locked at the end")
         except Exception as e:
@@ -341,9 +681,21 @@ title='First' at 0x...>
             raise
         self.logger.debug("Finished transaction %s successfully" % self)
 
+    Trace = TransactionTrace
+
     class Element(base.Base):
+        __metaclass__ = TransactionElementType
+
         title = None
 
+        # If the element can be committed concurrently with other parallel
+        # elements, see Transaction.dependencies
+        parallel = False
+        # Names of resources the element modifies exclusively
+        resources = ()
+        # Element classes which need to be committed before this one
+        requires = ()
+
         def prepare(self):
             """Is expected to be short running and not changing anything
             """
@@ -359,6 +711,13 @@ title='First' at 0x...>
             """
             pass
 
+        def request_service(self, name, action, on_failure=None,
+                            do_raise=True):
+            """Request a service action, see ServicePlan.request
+            """
+            return Transaction.ServicePlan.request(name, action, on_failure,
+                                                   do_raise)
+
         def __repr__(self):
             return "<%s '%s'>" % (self.__class__.__name__, self.title)
 
@@ -366,6 +725,171 @@ title='First' at 0x...>
             self.prepare()
             self.commit()
 
+    class ServicePlan(base.Base):
+        """Collects the service actions requested by the elements of a
+        running transaction and runs each of them once, when the transaction
+        was committed.
+
+        Requests for the same service are merged: A service is enabled at
+        most once, and restarted once if any element requires a restart,
+        otherwise it is reloaded once.
+        A plan is active per thread, transactions run while a plan is
+        active (e.g. sub-transactions) add their requests to that plan.
+        Without an active plan the action is run immediately.
+
+        >>> def runner(name, action):
+        ...     print "%s %s" % (action, name)
+        >>> with Transaction.ServicePlan(runner) as plan:
+        ...     plan.request("sshd", "restart")
+        ...     plan.request("rsyslog", "reload")
+        ...     plan.request("sshd", "reload")
+        ...     plan.request("collectd", "enable")
+        ...     plan.request("sshd", "restart")
+        ...     print "Committed"
+        True
+        True
+        True
+        True
+        True
+        Committed
+        enable collectd
+        restart sshd
+        reload rsyslog
+
+        Failures can be handled by a callback, which can raise a more
+        specific exception:
+
+        >>> def failing_runner(name, action):
+        ...     raise RuntimeError("%s failed" % name)
+        >>> def fail():
+        ...     raise RuntimeError("Please check the sshd configuration")
+        >>> with Transaction.ServicePlan(failing_runner) as plan:
+        ...     _ = plan.request("sshd", "restart", fail)
+        ...     _ = plan.request("foo", "restart", do_raise=False)
+        Traceback (most recent call last):
+        ...
+        RuntimeError: Please check the sshd configuration
+        """
+        ACTIONS = ["enable", "reload", "restart"]
+
+        _local = threading.local()
+
+        runner = None
+        _outer = None
+
+        def __init__(self, runner=None):
+            super(Transaction.ServicePlan, self).__init__()
+            self.runner = runner or self._run_action
+            self._lock = threading.Lock()
+            self._services = []
+            self._actions = {}
+            self._on_failure = {}
+            self._do_raise = {}
+
+        @classmethod
+        def current(cls):
+            """Returns the plan active in this thread or None
+            """
+            return getattr(cls._local, "plan", None)
+
+        @classmethod
+        def request(cls, name, action, on_failure=None, do_raise=True):
+            """Request a service action
+
+            Args:
+                name: The name of the service
+                action: One of enable, reload, restart
+                on_failure: Callable called if the action failed, it can
+                            raise an exception to replace the original one
+                do_raise: If a failure of the action shall be raised
+            Returns:
+                True if the action was added to the active plan
+            """
+            assert action in cls.ACTIONS, "Unknown action: %s" % action
+            plan = cls.current()
+            if plan:
+                plan.add(name, action, on_failure, do_raise)
+                return True
+            plan = cls()
+            plan.add(name, action, on_failure, do_raise)
+            plan.execute()
+            return False
+
+        def add(self, name, action, on_failure=None, do_raise=True):
+            with self._lock:
+                if name not in self._services:
+                    self._services.append(name)
+                    self._actions[name] = set()
+                    self._on_failure[name] = []
+                    self._do_raise[name] = False
+                self._actions[name].add(action)
+                if on_failure:
+                    self._on_failure[name].append(on_failure)
+                self._do_raise[name] |= do_raise
+
+        def actions(self):
+            """Returns the coalesced list of (name, action) tuples
+            """
+            actions = []
+            for name in self._services:
+                if "enable" in self._actions[name]:
+                    actions.append((name, "enable"))
+            for name in self._services:
+                if "restart" in self._actions[name]:
+                    actions.append((name, "restart"))
+                elif "reload" in self._actions[name]:
+                    actions.append((name, "reload"))
+            return actions
+
+        def execute(self):
+            """Run all coalesced actions, the first failure is raised after
+            all actions were run
+            """
+            error = None
+            for name, action in self.actions():
+                self.logger.debug("Running planned action: %s %s" %
+                                  (action, name))
+                try:
+                    self.runner(name, action)
+                except Exception as e:
+                    self.logger.debug("Action failed: %s %s" %
+                                      (action, name), exc_info=True)
+                    for on_failure in self._on_failure[name]:
+                        try:
+                            on_failure()
+                        except Exception as replacement:
+                            e = replacement
+                    if self._do_raise[name] and error is None:
+                        error = e
+            if error:
+                raise error
+
+        @staticmethod
+        def _run_action(name, action):
+            # Import is inside the function to address circular imports
+            from ovirt.node.utils import system, process
+            if action == "enable":
+                process.check_call(["chkconfig", name, "on"])
+            else:
+                system.service(name, action)
+
+        def __enter__(self):
+            self._outer = self.current()
+            if self._outer:
+                return self._outer
+            self._local.plan = self
+            return self
+
+        def __exit__(self, exc_type, exc_value, traceback):
+            if self._outer:
+                return
+            self._local.plan = None
+            if exc_type:
+                self.logger.debug("Dropping service plan: %s" %
+                                  self.actions())
+                return
+            self.execute()
+
 
 class Timer(base.Base):
     started = 0
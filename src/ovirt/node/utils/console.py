@@ -149,17 +149,15 @@ class TransactionProgress(base.Base):
                               self.transaction)
             self.add_update("Checking pre-conditions ...")
             self.transaction.prepare()  # Just to display something in dry mode
-            for idx, e in enumerate(self.transaction):
-                txt = "(%s/%s) %s" % (idx + 1, len(self.transaction), e.title)
-                self.add_update(txt)
-                with CaptureOutput() as captured:
-                    # Sometimes a tx_element is wrapping some code that
-                    # writes to stdout/stderr which scrambles the screen,
-                    # therefore we are capturing this
-                    if self.is_dry:
-                        self.logger.debug("In dry mode: %s" % e)
-                    else:
-                        e.commit()
+            plan = Transaction.ServicePlan()
+            with plan:
+                if self.transaction.max_workers > 1 and not self.is_dry:
+                    captured = None
+                    self.__commit_parallel()
+                else:
+                    captured = self.__commit_sequential()
+                if plan.actions():
+                    self.add_update("Restarting services ...")
             self.add_update("\nAll changes were applied successfully.")
         except Exception as e:
             self.add_update("\nAn error occurred while applying the changes:")
@@ -169,11 +167,34 @@ class TransactionProgress(base.Base):
                                    e, e.message))
             raise
 
-        if captured.stderr.getvalue():
+        if captured and captured.stderr.getvalue():
             se = captured.stderr.getvalue()
             if se:
                 self.add_update("Stderr: %s" % se)
 
+    def __commit_sequential(self):
+        captured = None
+        for idx, e in enumerate(self.transaction):
+            txt = "(%s/%s) %s" % (idx + 1, len(self.transaction), e.title)
+            self.add_update(txt)
+            with CaptureOutput() as captured:
+                # Sometimes a tx_element is wrapping some code that
+                # writes to stdout/stderr which scrambles the screen,
+                # therefore we are capturing this
+                if self.is_dry:
+                    self.logger.debug("In dry mode: %s" % e)
+                else:
+                    e.commit()
+        return captured
+
+    def __commit_parallel(self):
+        # Elements are committed concurrently, the progress is still
+        # reported in order, once an element was committed.
+        # The output can not be captured per element in this case.
+        for idx, e in self.transaction.commit_steps():
+            txt = "(%s/%s) %s" % (idx + 1, len(self.transaction), e.title)
+            self.add_update(txt)
+
 
 def getch():
     """getch() -> key character
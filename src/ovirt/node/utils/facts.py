@@ -0,0 +1,263 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# facts.py - Copyright (C) 2014 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.  A copy of the GNU General Public License is
+# also available at http://www.gnu.org/copyleft/gpl.html.
+
+"""
+Facts about the host which don't change until the next boot
+
+A fact is computed by it's provider the first time it is needed and is then
+kept in a file below /run, so the TUI, the installer and the boot scripts
+share it. The file is ignored if it was written by a different version of
+this module or during a previous boot.
+
+Providers are registered with the provides decorator:
+
+>>> calls = []
+>>> @provides("answer")
+... def _answer():
+...     calls.append(True)
+...     return {"value": 42}
+
+>>> fn = "/tmp/ovirt-node-facts.json"
+>>> facts = Facts(fn)
+>>> facts.get("answer"), facts.get("answer"), len(calls)
+({'value': 42}, {'value': 42}, 1)
+
+Other processes pick the fact up from the file:
+
+>>> Facts(fn).get("answer"), len(calls)
+({'value': 42}, 1)
+
+>>> Facts(fn).refresh("answer")
+>>> facts.get("answer"), len(calls)
+({'value': 42}, 2)
+
+Facts of a previous boot are computed again:
+
+>>> data = json.load(open(fn))
+>>> data["boot_id"] = "previous"
+>>> json.dump(data, open(fn, "w"))
+>>> Facts(fn).get("answer"), len(calls)
+({'value': 42}, 3)
+
+>>> del _providers["answer"]
+>>> os.unlink(fn)
+>>> os.unlink(fn + ".lock")
+"""
+
+from ovirt.node import base
+from ovirt.node.utils.fs import AtomicFile
+import contextlib
+import errno
+import fcntl
+import json
+import logging
+import os
+import threading
+
+LOGGER = logging.getLogger(__name__)
+
+FACTS_FILE = "/run/ovirt-node/facts.json"
+BOOT_ID_FILE = "/proc/sys/kernel/random/boot_id"
+
+# Bump this if the format of a fact changes
+VERSION = 1
+
+# The modules registering the providers of the known facts
+PROVIDER_MODULES = ["ovirt.node.utils.system", "ovirt.node.utils.storage"]
+
+_providers = {}
+
+
+def provides(name):
+    """Decorator to register the decorated function as the provider of the
+    fact name
+    The function is called without arguments and must return something
+    which can be stored as JSON. None is not kept.
+    """
+    def decorator(func):
+        _providers[name] = func
+        return func
+    return decorator
+
+
+def get(name):
+    """Returns the fact name, see Facts.get
+    """
+    return Facts.of(FACTS_FILE).get(name)
+
+
+def refresh(*names):
+    """Forget the facts names (or all), see Facts.refresh
+    """
+    Facts.of(FACTS_FILE).refresh(*names)
+
+
+def boot_id():
+    """The random id of the current boot
+    """
+    try:
+        with open(BOOT_ID_FILE) as src:
+            return src.read().strip()
+    except IOError:
+        return ""
+
+
+def _to_str(obj):
+    """Convert the unicode strings json returns to str
+
+    >>> _to_str({u"a": [u"b", 1, None]})
+    {'a': ['b', 1, None]}
+    """
+    if isinstance(obj, unicode):
+        return obj.encode("utf-8")
+    if isinstance(obj, list):
+        return [_to_str(v) for v in obj]
+    if isinstance(obj, dict):
+        return dict((_to_str(k), _to_str(v)) for k, v in obj.items())
+    return obj
+
+
+class Facts(base.Base):
+    """The facts kept in filename
+
+    The facts are also kept in memory, they are only read again if the
+    file was replaced. If the file can't be written the facts are only
+    kept in memory.
+    Use Facts.of() to get the shared instance of a file.
+    """
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, filename=FACTS_FILE):
+        super(Facts, self).__init__()
+        self.filename = filename
+        self._lock = threading.RLock()
+        self._facts = {}
+        self._fingerprint = None
+
+    @classmethod
+    def of(cls, filename=FACTS_FILE):
+        """Returns the instance shared by all users of filename
+        """
+        with cls._instances_lock:
+            if filename not in cls._instances:
+                cls._instances[filename] = cls(filename)
+            return cls._instances[filename]
+
+    def get(self, name):
+        """Returns the fact name, it is computed if it is not known yet
+        """
+        with self._lock:
+            self._reload()
+            if name in self._facts:
+                return self._facts[name]
+
+            with self._locked_file():
+                # Another process might have computed it meanwhile
+                self._reload()
+                if name not in self._facts:
+                    value = _to_str(self._provider(name)())
+                    if value is None:
+                        return None
+                    self._facts[name] = value
+                    self._save()
+                return self._facts[name]
+
+    def refresh(self, *names):
+        """Forget the facts names (or all facts if no name is given), they
+        are computed again when they are needed the next time
+        """
+        with self._lock:
+            with self._locked_file():
+                self._reload()
+                for name in names or self._facts.keys():
+                    self._facts.pop(name, None)
+                self._save()
+
+    def _provider(self, name):
+        if name not in _providers:
+            for module in PROVIDER_MODULES:
+                __import__(module)
+        if name not in _providers:
+            raise KeyError("Unknown fact: %s" % name)
+        return _providers[name]
+
+    def _stat(self):
+        try:
+            st = os.stat(self.filename)
+            return (st.st_ino, st.st_size, st.st_mtime)
+        except OSError:
+            return None
+
+    def _reload(self):
+        """Read the file again if it was replaced since it was read
+        """
+        fingerprint = self._stat()
+        if fingerprint is None or fingerprint == self._fingerprint:
+            # Without a file the facts in memory are all we have
+            return
+        facts = {}
+        try:
+            with open(self.filename) as src:
+                data = json.load(src)
+            if data.get("version") == VERSION and \
+               data.get("boot_id") == boot_id():
+                facts = _to_str(data.get("facts", {}))
+        except (IOError, ValueError, AttributeError):
+            self.logger.debug("Failed to read facts from '%s'" %
+                              self.filename, exc_info=True)
+        self._facts = facts
+        self._fingerprint = fingerprint
+
+    def _save(self):
+        data = {"version": VERSION,
+                "boot_id": boot_id(),
+                "facts": self._facts}
+        try:
+            with AtomicFile(self.filename, "w", fsync="none") as dst:
+                json.dump(data, dst)
+            self._fingerprint = self._stat()
+        except EnvironmentError:
+            self.logger.debug("Failed to write facts to '%s'" %
+                              self.filename, exc_info=True)
+
+    @contextlib.contextmanager
+    def _locked_file(self):
+        """Serialize the computation of facts between processes
+        If the lock can't be created (e.g. /run is read-only) every process
+        computes the facts on it's own
+        """
+        lockfd = None
+        try:
+            dirname = os.path.dirname(self.filename)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname, 0755)
+            lockfd = os.open(self.filename + ".lock",
+                             os.O_RDWR | os.O_CREAT, 0644)
+            fcntl.flock(lockfd, fcntl.LOCK_EX)
+        except EnvironmentError as e:
+            if e.errno not in (errno.EACCES, errno.EPERM, errno.EROFS):
+                raise
+            self.logger.debug("Can not lock '%s': %s" % (self.filename, e))
+        try:
+            yield
+        finally:
+            if lockfd is not None:
+                os.close(lockfd)
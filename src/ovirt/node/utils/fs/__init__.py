@@ -25,22 +25,34 @@ Some convenience functions realted to the filesystem
 from __future__ import print_function
 
 import shutil
+import atexit
+import contextlib
+import ctypes
 import errno
 import os
 import stat
 import StringIO
 import re
 import hashlib
+import json
 import logging
+import threading
+import time
 
 
-from . import mount
-from .. import process, parse_varfile
+from . import fastcopy, mount
+from .. import parse_varfile
 from ... import base
 
 LOGGER = logging.getLogger(__name__)
 LOGGER.addHandler(logging.NullHandler())
 
+LIBC = ctypes.CDLL('libc.so.6', use_errno=True)
+
+O_TMPFILE = 020000000 | os.O_DIRECTORY
+AT_FDCWD = -100
+AT_SYMLINK_FOLLOW = 0x400
+
 
 def get_contents(src):
     """Read the contents of a file
@@ -58,27 +70,440 @@ def get_contents(src):
 def copy_contents(src, dst):
     assert all([os.path.isfile(f) for f in [src, dst]]), \
         "Source '%s' and destination '%s' need to exist" % (src, dst)
-    with open(src, "r") as srcf:
-        with open(dst, "wb") as dstf:
-            dstf.write(srcf.read())
+    fastcopy.copyfile(src, dst)
 
 
 def atomic_write(filename, contents, mode="wb"):
-    backup = BackupedFiles([filename], ".temp")
-    backup.create()
-    backup_filename = backup.of(filename)
-
-    with open(backup_filename, mode) as dst:
+    with AtomicFile(filename, mode) as dst:
         dst.write(contents)
 
-    fns = (backup_filename, filename)
-    LOGGER.debug("Moving '%s' to '%s' atomically" % fns)
-    try:
-        os.rename(*fns)
-    except Exception:
-        backup.remove()
-        LOGGER.debug("Error on moving file '%s'" % fns, exc_info=True)
-        raise
+
+class AtomicFile(base.Base):
+    """Atomically replace a file
+
+    The new contents are written to an anonymous (O_TMPFILE) or a temporary
+    file next to filename. When the context is left without an exception,
+    it gets the mode, owner and extended attributes of the existing file
+    and is renamed to filename.
+    The contents can be written in chunks, if the mode is "a" the existing
+    contents are copied first.
+
+    fsync can be "none", "file" (sync the file before renaming it) or "all"
+    (additionally sync the directory after renaming it).
+
+    >>> fn = "/tmp/ovirt-node-atomic"
+    >>> with AtomicFile(fn) as dst:
+    ...     dst.write("Hello")
+    ...     dst.writelines([" ", "World"])
+    >>> os.chmod(fn, 0600)
+    >>> with AtomicFile(fn, "a", fsync="all") as dst:
+    ...     dst.write("!")
+    >>> File(fn).read(), oct(os.stat(fn).st_mode & 0777)
+    ('Hello World!', '0600')
+
+    Nothing is changed if the context is left with an exception:
+
+    >>> with AtomicFile(fn, fsync="none") as dst:
+    ...     dst.write("Bye")
+    ...     raise RuntimeError("Abort")
+    Traceback (most recent call last):
+    RuntimeError: Abort
+    >>> File(fn).read()
+    'Hello World!'
+    >>> [n for n in os.listdir("/tmp") if n.startswith("ovirt-node-atomic")]
+    ['ovirt-node-atomic']
+    >>> File(fn).delete()
+    """
+    FSYNC_POLICIES = ["none", "file", "all"]
+    default_fsync = "file"
+
+    filename = None
+    mode = None
+    fsync = None
+
+    _file = None
+    _tmpname = None
+
+    def __init__(self, filename, mode="wb", fsync=None):
+        super(AtomicFile, self).__init__()
+        fsync = fsync or self.default_fsync
+        assert fsync in self.FSYNC_POLICIES, "Unknown policy: %s" % fsync
+        self.filename = filename
+        self.mode = mode
+        self.fsync = fsync
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.discard()
+
+    def _dirname(self):
+        return os.path.dirname(os.path.abspath(self.filename))
+
+    def _unique_name(self):
+        return "%s.%s.tmp" % (self.filename, os.urandom(4).encode("hex"))
+
+    def open(self):
+        """Create the temporary file
+        """
+        fd = None
+        try:
+            fd = os.open(self._dirname(), O_TMPFILE | os.O_WRONLY, 0666)
+        except OSError as e:
+            # Kernels or filesystems without O_TMPFILE support
+            if e.errno not in (errno.EISDIR, errno.EOPNOTSUPP,
+                               errno.EINVAL):
+                raise
+            self._tmpname = self._unique_name()
+            fd = os.open(self._tmpname,
+                         os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0666)
+        self._file = os.fdopen(fd, "wb")
+
+        if "a" in self.mode and os.path.exists(self.filename):
+            with open(self.filename, "rb") as src:
+                fastcopy.copy_fd(src.fileno(), fd)
+
+    def write(self, data):
+        self._file.write(data)
+
+    def writelines(self, chunks):
+        for chunk in chunks:
+            self._file.write(chunk)
+
+    def commit(self):
+        """Sync and rename the temporary file to filename
+        """
+        try:
+            self._file.flush()
+            if self.fsync in ["file", "all"]:
+                os.fsync(self._file.fileno())
+            if self._tmpname is None:
+                self._tmpname = self._unique_name()
+                self._link_fd(self._file.fileno(), self._tmpname)
+            self._file.close()
+            self._copy_metadata()
+            LOGGER.debug("Moving '%s' to '%s' atomically" %
+                         (self._tmpname, self.filename))
+            os.rename(self._tmpname, self.filename)
+        except Exception:
+            LOGGER.debug("Error on replacing file '%s'" % self.filename,
+                         exc_info=True)
+            self.discard()
+            raise
+
+        self._tmpname = None
+        if self.fsync == "all":
+            dirfd = os.open(self._dirname(), os.O_RDONLY)
+            try:
+                os.fsync(dirfd)
+            finally:
+                os.close(dirfd)
+
+    def discard(self):
+        """Drop the temporary file, filename is left untouched
+        """
+        if self._file and not self._file.closed:
+            self._file.close()
+        if self._tmpname and os.path.exists(self._tmpname):
+            os.unlink(self._tmpname)
+        self._tmpname = None
+
+    def _link_fd(self, fd, path):
+        """Give the anonymous file fd the name path
+        """
+        ret = _linkat(AT_FDCWD, "/proc/self/fd/%d" % fd, AT_FDCWD, path,
+                      AT_SYMLINK_FOLLOW)
+        if ret == -1:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e), path)
+
+    def _copy_metadata(self):
+        """Copy the mode, owner and extended attributes (but not the times)
+        of filename to the temporary file
+        """
+        try:
+            st = os.stat(self.filename)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        os.chmod(self._tmpname, stat.S_IMODE(st.st_mode))
+        try:
+            os.chown(self._tmpname, st.st_uid, st.st_gid)
+        except OSError as e:
+            if e.errno != errno.EPERM:
+                raise
+        fastcopy.copy_xattrs(self.filename, self._tmpname)
+
+
+_compiled_patterns = {}
+_compiled_patterns_lock = threading.Lock()
+
+
+def compiled(pattern, flags=0):
+    """Returns the compiled regular expression, compiled patterns are
+    cached for the lifetime of the process
+
+    >>> compiled("fo+") is compiled("fo+")
+    True
+    """
+    if hasattr(pattern, "pattern"):
+        return pattern
+    key = (pattern, flags)
+    with _compiled_patterns_lock:
+        if key not in _compiled_patterns:
+            _compiled_patterns[key] = re.compile(pattern, flags)
+        return _compiled_patterns[key]
+
+
+class Editor(base.Base):
+    """Edit the lines of a file in one pass, without running sed
+
+    Substitutions and deletions are applied in the order they were added
+    to each line (without the trailing newline), a deleted line is not
+    processed any further. Appended lines are added at the end.
+
+    >>> editor = Editor().delete("^#").sub("o+", "0").append("last")
+    >>> print(editor.apply("# Comment\\nfoo\\nboo"), end="")
+    f0
+    b0
+    last
+
+    Simple sed scripts can be used as well:
+
+    >>> editor = Editor.from_sed(r"/^#/d; s/\\(o\\+\\)/<&>/g")
+    >>> print(editor.apply("# Comment\\nfoo\\nboo"))
+    f<oo>
+    b<oo>
+
+    >>> fn = "/tmp/ovirt-node-edited"
+    >>> File(fn).write("A=1\\nB=2\\n")
+    >>> Editor().delete("^B=").append("C=3").edit(fn)
+    >>> File(fn).read()
+    'A=1\\nC=3\\n'
+    >>> File(fn).delete()
+    """
+    _sed_scripts = {}
+
+    def __init__(self):
+        super(Editor, self).__init__()
+        self.rules = []
+        self.appended = []
+
+    def sub(self, pattern, repl, count=0, flags=0):
+        """Replace pattern with repl (see re.sub) in all lines
+        """
+        self.rules.append(("s", compiled(pattern, flags), repl, count))
+        return self
+
+    def delete(self, pattern, flags=0):
+        """Delete all lines matching pattern
+        """
+        self.rules.append(("d", compiled(pattern, flags)))
+        return self
+
+    def append(self, line):
+        """Append line to the end of the file
+        """
+        self.appended.append(line)
+        return self
+
+    def lines(self, lines):
+        """Generates the edited lines
+        """
+        last = "\n"
+        for line in lines:
+            body = line.rstrip("\n")
+            for rule in self.rules:
+                if rule[0] == "d":
+                    if rule[1].search(body):
+                        body = None
+                        break
+                else:
+                    body = rule[1].sub(rule[2], body, rule[3])
+            if body is not None:
+                last = body + line[len(line.rstrip("\n")):]
+                yield last
+        if self.appended and not last.endswith("\n"):
+            yield "\n"
+        for line in self.appended:
+            yield line + "\n"
+
+    def apply(self, text):
+        """Returns the edited text
+        """
+        return "".join(self.lines(StringIO.StringIO(text)))
+
+    def edit(self, filename, source=None):
+        """Atomically replace filename with the edited contents of source
+        (by default filename itself)
+        """
+        source = source or filename
+        try:
+            with open(source) as src:
+                with AtomicFile(filename) as dst:
+                    dst.writelines(self.lines(src))
+        except OSError as e:
+            if e.errno not in (errno.EBUSY, errno.EXDEV):
+                raise
+            # The file is bind mounted, so edit it in place
+            self.logger.debug("Editing '%s' in place" % filename)
+            with open(source) as src:
+                contents = "".join(self.lines(src))
+            with open(filename, "w") as dst:
+                dst.write(contents)
+
+    @classmethod
+    def from_sed(cls, script):
+        """Build an editor from a sed script
+
+        Only s commands and addresses with d commands, separated by
+        semicolons or newlines, are supported, basic regular expressions
+        are translated to python ones.
+
+        Raises:
+            ValueError if the script is not supported
+        """
+        if script not in cls._sed_scripts:
+            cls._sed_scripts[script] = _parse_sed(script)
+        editor = cls()
+        editor.rules = list(cls._sed_scripts[script])
+        return editor
+
+
+def _parse_sed(script):
+    """Parse a sed script into Editor rules
+    """
+    rules = []
+    pos = 0
+    while pos < len(script):
+        char = script[pos]
+        if char in " \t\n;":
+            pos += 1
+        elif char == "s":
+            delim = script[pos + 1]
+            pattern, pos = _sed_token(script, pos + 2, delim)
+            repl, pos = _sed_token(script, pos, delim)
+            count, flags = 1, 0
+            while pos < len(script) and script[pos] not in " \t\n;":
+                if script[pos] == "g":
+                    count = 0
+                elif script[pos] in "Ii":
+                    flags |= re.IGNORECASE
+                else:
+                    raise ValueError("Unsupported sed flag: %s" % script)
+                pos += 1
+            rules.append(("s", compiled(_bre_to_re(pattern), flags),
+                          _sed_repl(repl), count))
+        elif char in "/\\":
+            if char == "\\":
+                pos += 1
+            pattern, pos = _sed_token(script, pos + 1, script[pos])
+            while pos < len(script) and script[pos] in " \t":
+                pos += 1
+            if script[pos:pos + 1] != "d":
+                raise ValueError("Unsupported sed command: %s" % script)
+            pos += 1
+            rules.append(("d", compiled(_bre_to_re(pattern))))
+        else:
+            raise ValueError("Unsupported sed command: %s" % script)
+    return rules
+
+
+def _sed_token(script, pos, delim):
+    """Read until the unescaped delim, returns the token and the position
+    after the delim
+    """
+    token = ""
+    while pos < len(script):
+        char = script[pos]
+        if char == delim:
+            return token, pos + 1
+        if char == "\\" and pos + 1 < len(script):
+            pos += 1
+            token += script[pos] if script[pos] == delim else \
+                "\\" + script[pos]
+        else:
+            token += char
+        pos += 1
+    raise ValueError("Unterminated sed expression: %s" % script)
+
+
+_POSIX_CLASSES = {"[:space:]": r"\s", "[:blank:]": r" \t",
+                  "[:digit:]": "0-9", "[:alpha:]": "a-zA-Z",
+                  "[:alnum:]": "a-zA-Z0-9", "[:upper:]": "A-Z",
+                  "[:lower:]": "a-z", "[:xdigit:]": "0-9a-fA-F"}
+
+
+def _bre_to_re(pattern):
+    """Translate a (GNU) basic regular expression to a python one
+
+    >>> _bre_to_re(r"^[[:space:]]*#\\(listen_tcp\\)\\>.*(x+)")
+    '^[\\\\s]*#(listen_tcp)\\\\b.*\\\\(x\\\\+\\\\)'
+    """
+    result = ""
+    pos = 0
+    while pos < len(pattern):
+        char = pattern[pos]
+        if char == "\\" and pos + 1 < len(pattern):
+            pos += 1
+            char = pattern[pos]
+            if char in "(){}|+?":
+                result += char
+            elif char in "<>":
+                result += r"\b"
+            else:
+                result += "\\" + char
+        elif char in "(){}|+?":
+            result += "\\" + char
+        elif char == "[":
+            end = pos + 1
+            if pattern[end:end + 1] == "^":
+                end += 1
+            if pattern[end:end + 1] == "]":
+                end += 1
+            while end < len(pattern) and pattern[end] != "]":
+                if pattern[end:end + 2] == "[:":
+                    end = pattern.index(":]", end) + 1
+                end += 1
+            bracket = pattern[pos:end + 1].replace("\\", "\\\\")
+            for posix, python in _POSIX_CLASSES.items():
+                bracket = bracket.replace(posix, python)
+            result += bracket
+            pos = end
+        else:
+            result += char
+        pos += 1
+    return result
+
+
+def _sed_repl(repl):
+    """Translate a sed replacement to a python one
+    """
+    result = ""
+    pos = 0
+    while pos < len(repl):
+        char = repl[pos]
+        if char == "\\" and pos + 1 < len(repl):
+            pos += 1
+            char = repl[pos]
+            if char.isdigit():
+                result += r"\g<%s>" % char
+            elif char == "&":
+                result += "&"
+            else:
+                result += "\\" + char
+        elif char == "&":
+            result += r"\g<0>"
+        else:
+            result += char
+        pos += 1
+    return result
 
 
 def truncate(filename):
@@ -88,13 +513,13 @@ def truncate(filename):
         pass
 
 
-def restorecon(path):
-    """Restore the context of the given path
+def restorecon(*paths):
+    """Restore the context of the given paths
 
     Import is inside the function to address circular imports
     """
     from ...utils import security
-    security.Selinux().restorecon(path)
+    security.Selinux().restorecon_many(paths)
 
 
 class File(base.Base):
@@ -141,8 +566,49 @@ class File(base.Base):
         """
         return os.access(self.filename, mode)
 
+    def fingerprint(self):
+        """A cheap identity of the current file contents
+
+        The fingerprint changes whenever the file is replaced (atomic
+        writes create a new inode) or modified in place.
+
+        >>> f = File("/tmp/afile")
+        >>> f.write("Woot")
+        >>> fp = f.fingerprint()
+        >>> fp == f.fingerprint()
+        True
+        >>> f.write("Wooot")
+        >>> fp == f.fingerprint()
+        False
+        >>> f.delete()
+        >>> f.fingerprint() is None
+        True
+
+        Returns:
+            A tuple (inode, size, mtime_ns) or None if the file can not be
+            stat'ed
+        """
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_size, int(st.st_mtime * 1e9))
+
+    def edit(self, editor, inplace=True):
+        """Apply an Editor to the file
+
+        Args:
+            inplace: If the contents shall be directly replaced
+        Returns:
+            The new value if not inplace
+        """
+        if inplace:
+            editor.edit(self.filename)
+        else:
+            return "".join(editor.lines(self))
+
     def sed(self, expr, inplace=True):
-        """Run a sed expression on the file
+        """Run a sed expression on the file, see Editor.from_sed
 
         >>> f = File("/tmp/afile")
         >>> f.write("Woot")
@@ -150,7 +616,7 @@ class File(base.Base):
         Replacement without inplace modifcation:
 
         >>> f.sed("s/oo/ha/", False)
-        u'What'
+        'What'
 
         Replacement with inplace modifications:
 
@@ -161,16 +627,11 @@ class File(base.Base):
         Chaining of expressions also works:
 
         >>> f.sed("s/alle/oo/ ; s/oo/ha/", False)
-        u'What'
+        'What'
 
         >>> f.delete()
         """
-        cmd = ["sed"]
-        if inplace:
-            cmd.append("-ci")
-        cmd += ["-e", expr, self.filename]
-        stdout = process.check_output(cmd)
-        return None if inplace else stdout
+        return self.edit(Editor.from_sed(expr), inplace)
 
     def sub(self, pat, repl, count=0, inplace=True):
         """Run a regexp subs. on each lien of the file
@@ -180,9 +641,7 @@ class File(base.Base):
         Returns:
             The new value
         """
-        newval = ""
-        for line in self:
-            newval += re.sub(pat, repl, line, count)
+        newval = self.edit(Editor().sub(pat, repl, count), inplace=False)
         if inplace:
             self.write(newval)
         return newval
@@ -286,9 +745,12 @@ class FakeFs(base.Base):
         def access(self, mode):
             return self.filename in FakeFs.filemap
 
-        def sed(self, expr, inplace=True):
-            newval = process.pipe(["sed", "-e", expr],
-                                  stdin=self.read())
+        def fingerprint(self):
+            # Fake files have no stable identity, never cache them
+            return None
+
+        def edit(self, editor, inplace=True):
+            newval = editor.apply(self.read())
             if inplace:
                 self.write(newval)
             return newval
@@ -358,7 +820,7 @@ class BackupedFiles(base.Base):
                 raise RuntimeError(("Backup '%s' for '%s " +
                                     "already exists") % (backup, fn))
             if os.path.exists(fn):
-                shutil.copy(fn, backup)
+                fastcopy.copy(fn, backup)
                 self.backups[fn] = backup
             else:
                 self.logger.debug("Can not backup non-existent " +
@@ -399,11 +861,374 @@ def is_bind_mount(filename, fsprefix="ext"):
     return any(pattern in mountp for mountp in mounts)
 
 
+class PathEntries(base.Base):
+    """The registry of persisted paths, one path per line (/config/files)
+
+    The entries are kept in memory and the file is only read again if it
+    was modified by someone else (see File.fingerprint).
+    New entries are appended with a single write, removing entries
+    compacts the file, which is then replaced atomically.
+    Use PathEntries.of() to get the shared registry of a file.
+
+    >>> fn = "/tmp/ovirt-node-path-entries"
+    >>> File(fn).write("/etc/hosts\\n\\n/etc/hosts\\n/etc/passwd")
+    >>> entries = PathEntries(fn)
+    >>> list(entries)
+    ['/etc/hosts', '/etc/passwd']
+    >>> "/etc/passwd" in entries, "/etc/shadow" in entries
+    (True, False)
+    >>> entries.add("/etc/shadow"), entries.add("/etc/shadow")
+    (True, False)
+    >>> File(fn).read()
+    '/etc/hosts\\n\\n/etc/hosts\\n/etc/passwd\\n/etc/shadow\\n'
+
+    >>> entries.remove("/etc/hosts"), entries.remove("/etc/hosts")
+    (True, False)
+    >>> File(fn).read()
+    '/etc/passwd\\n/etc/shadow\\n'
+
+    Changes by others are picked up:
+
+    >>> with open(fn, "a") as dst:
+    ...     dst.write("/etc/group\\n")
+    >>> len(entries), "/etc/group" in entries
+    (3, True)
+    >>> File(fn).delete()
+    >>> len(entries)
+    0
+
+    Including changes which happen while we append:
+
+    >>> class Racy(PathEntries):
+    ...     def _refresh(self):
+    ...         PathEntries._refresh(self)
+    ...         with open(self.filename, "a") as dst:
+    ...             dst.write("/etc/group\\n")
+    >>> racy = Racy(fn)
+    >>> racy.add("/etc/hosts")
+    True
+    >>> sorted(PathEntries._refresh(racy) or racy._entries)
+    ['/etc/group', '/etc/hosts']
+    >>> File(fn).delete()
+    """
+    _registries = {}
+    _registries_lock = threading.Lock()
+
+    def __init__(self, filename):
+        super(PathEntries, self).__init__()
+        self.filename = filename
+        self._lock = threading.RLock()
+        self._entries = []
+        self._index = set()
+        self._fingerprint = None
+        self._needs_newline = False
+
+    @classmethod
+    def of(cls, filename):
+        """Returns the registry shared by all users of filename
+        """
+        with cls._registries_lock:
+            if filename not in cls._registries:
+                cls._registries[filename] = cls(filename)
+            return cls._registries[filename]
+
+    def _refresh(self):
+        """Read the file again if it was changed since it was read last
+        """
+        fingerprint = File(self.filename).fingerprint()
+        if fingerprint is not None and fingerprint == self._fingerprint:
+            return
+
+        contents = ""
+        if fingerprint is not None:
+            with open(self.filename) as src:
+                contents = src.read()
+        entries = []
+        index = set()
+        for line in contents.splitlines():
+            entry = line.strip()
+            if entry and entry not in index:
+                entries.append(entry)
+                index.add(entry)
+        self._entries = entries
+        self._index = index
+        self._needs_newline = bool(contents) and not contents.endswith("\n")
+        self._fingerprint = fingerprint
+
+    def __contains__(self, path):
+        with self._lock:
+            self._refresh()
+            return path in self._index
+
+    def __iter__(self):
+        with self._lock:
+            self._refresh()
+            return iter(list(self._entries))
+
+    def __len__(self):
+        with self._lock:
+            self._refresh()
+            return len(self._entries)
+
+    def add(self, path):
+        """Append path to the registry
+
+        Returns:
+            True if the entry was added, False if it was already present
+        """
+        return self.update(add=[path]) > 0
+
+    def remove(self, path):
+        """Remove path from the registry
+
+        Returns:
+            True if the entry was removed, False if it was not present
+        """
+        return self.update(remove=[path]) > 0
+
+    def update(self, add=(), remove=()):
+        """Add and remove many entries at once, the additions are appended
+        with a single write, the removals need a single compaction.
+
+        >>> fn = "/tmp/ovirt-node-path-entries"
+        >>> entries = PathEntries(fn)
+        >>> entries.update(add=["/etc/hosts", "/etc/passwd", "/etc/hosts"])
+        2
+        >>> entries.update(add=["/etc/shadow"], remove=["/etc/hosts", "/a"])
+        2
+        >>> File(fn).read()
+        '/etc/passwd\\n/etc/shadow\\n'
+        >>> File(fn).delete()
+
+        Returns:
+            The number of added and removed entries
+        """
+        with self._lock:
+            self._refresh()
+            added = []
+            for path in add:
+                if path not in self._index:
+                    self._index.add(path)
+                    added.append(path)
+            self._entries.extend(added)
+
+            removed = set(path for path in remove if path in self._index)
+            if removed:
+                self._entries = [entry for entry in self._entries
+                                 if entry not in removed]
+                self._index -= removed
+                self._write()
+            elif added:
+                self._append(added)
+            return len(set(added) | removed)
+
+    def compact(self):
+        """Atomically replace the file with the known entries, this also
+        drops duplicate and empty lines
+        """
+        with self._lock:
+            self._refresh()
+            self._write()
+
+    def _append(self, paths):
+        lines = "".join("%s\n" % path for path in paths)
+        if self._needs_newline:
+            lines = "\n" + lines
+        # Others (e.g. ovirt_store_config of the legacy functions) can
+        # append to the file as well, so the fingerprint is only trusted if
+        # the file was unchanged since it was read, and if it only grew by
+        # our write. Otherwise it is read again on the next access.
+        before = File(self.filename).fingerprint()
+        # A single write to a file opened in append mode, so readers
+        # never see a partial line
+        with open(self.filename, "a") as dst:
+            dst.write(lines)
+        self._needs_newline = False
+        after = File(self.filename).fingerprint()
+        expected_size = (before[1] if before else 0) + len(lines)
+        if before == self._fingerprint and after and \
+                after[1] == expected_size:
+            self._fingerprint = after
+        else:
+            self._fingerprint = None
+
+    def _write(self):
+        contents = "".join("%s\n" % entry for entry in self._entries)
+        try:
+            atomic_write(self.filename, contents)
+        except (IOError, OSError):
+            # e.g. if the file is bind mounted, fall back to rewrite it
+            self.logger.debug("Failed to replace '%s' atomically" %
+                              self.filename, exc_info=True)
+            with open(self.filename, "w") as dst:
+                dst.write(contents)
+        self._needs_newline = False
+        self._fingerprint = File(self.filename).fingerprint()
+
+
+class ChecksumCache(base.Base):
+    """Caches the checksums of files
+
+    A checksum is only computed again if the (dev, inode, size, mtime) of
+    the file changed. If a filename is given, the cache is loaded from and
+    saved to it, so it survives reboots.
+    Use ChecksumCache.of() to get the shared cache of a file.
+
+    >>> fn = "/tmp/ovirt-node-checksummed"
+    >>> File(fn).write("Woot")
+    >>> cache = ChecksumCache("/tmp/ovirt-node-checksums")
+    >>> cache.racy_seconds = 0
+    >>> cache.checksum(fn)
+    '7862f8570b6812b5bfd4e3ad4d8da20061fb9aa6'
+    >>> cache.checksum(fn, "md5")
+    'ee79b620a0187d27a8f36c9acb636507'
+    >>> cache.checksum(fn), cache.stats
+    ('7862f8570b6812b5bfd4e3ad4d8da20061fb9aa6', {'hits': 1, 'misses': 2})
+    >>> cache.save()
+
+    The entries are picked up by other instances:
+
+    >>> other = ChecksumCache("/tmp/ovirt-node-checksums")
+    >>> other.checksum(fn, "md5"), other.stats
+    ('ee79b620a0187d27a8f36c9acb636507', {'hits': 1, 'misses': 0})
+
+    Entries can be dropped explicitly, or by a keep predicate when the
+    cache is saved:
+
+    >>> other.forget(fn)
+    >>> other.checksum(fn, "md5"), other.stats
+    ('ee79b620a0187d27a8f36c9acb636507', {'hits': 1, 'misses': 1})
+    >>> other.keep = lambda path: path != fn
+    >>> other.save()
+    >>> json.load(open("/tmp/ovirt-node-checksums"))
+    {}
+
+    >>> File(fn).delete()
+    >>> File("/tmp/ovirt-node-checksums").delete()
+    """
+    # Files modified less than racy_seconds ago are not cached, as a
+    # following modification might not change the mtime
+    racy_seconds = 2
+
+    # Called with the path of each entry when the cache is saved, entries
+    # for which it returns False are dropped
+    keep = None
+
+    _caches = {}
+    _caches_lock = threading.Lock()
+
+    def __init__(self, filename=None):
+        super(ChecksumCache, self).__init__()
+        self.filename = filename
+        self.stats = {"hits": 0, "misses": 0}
+        self._lock = threading.Lock()
+        self._entries = None
+        self._dirty = False
+        if filename:
+            atexit.register(self.save)
+
+    @classmethod
+    def of(cls, filename=None):
+        """Returns the cache shared by all users of filename, None is the
+        in-memory cache
+        """
+        with cls._caches_lock:
+            if filename not in cls._caches:
+                cls._caches[filename] = cls(filename)
+            return cls._caches[filename]
+
+    def _load(self):
+        if self._entries is not None:
+            return
+        self._entries = {}
+        if self.filename and os.path.exists(self.filename):
+            try:
+                with open(self.filename) as src:
+                    self._entries = json.load(src)
+            except (IOError, ValueError):
+                self.logger.debug("Failed to load checksums from '%s'" %
+                                  self.filename, exc_info=True)
+
+    def _key(self, filename, algo):
+        st = os.stat(filename)
+        return ("%d:%d:%s" % (st.st_dev, st.st_ino, algo),
+                [st.st_size, int(st.st_mtime * 1e9)], st.st_mtime)
+
+    def checksum(self, filename, algo="sha1"):
+        """Returns the hexdigest of filename using the hashlib algo
+        """
+        key, meta, mtime = self._key(filename, algo)
+        with self._lock:
+            self._load()
+            entry = self._entries.get(key)
+            if entry and entry[:2] == meta:
+                self.stats["hits"] += 1
+                return str(entry[2])
+            self.stats["misses"] += 1
+
+        m = hashlib.new(algo)
+        with open(filename, "rb") as src:
+            data = src.read(65536)
+            while data:
+                m.update(data)
+                data = src.read(65536)
+        digest = m.hexdigest()
+
+        # Only cache the result if the file did not change while hashing
+        # it and is not modified too recently
+        if self._key(filename, algo)[1] == meta and \
+           time.time() - mtime >= self.racy_seconds:
+            with self._lock:
+                self._entries[key] = meta + [digest,
+                                             os.path.abspath(filename)]
+                self._dirty = True
+        return digest
+
+    def forget(self, path):
+        """Drop the entries of path and of all files below it
+        """
+        path = os.path.abspath(path)
+        with self._lock:
+            self._load()
+            for key, entry in self._entries.items():
+                if len(entry) < 4 or entry[3] == path or \
+                   entry[3].startswith(path + "/"):
+                    del self._entries[key]
+                    self._dirty = True
+
+    def save(self):
+        """Write the cache to filename, if there are new entries
+        """
+        with self._lock:
+            if not self.filename:
+                return
+            if self.keep and self._entries:
+                # Entries of old caches have no path and are dropped too
+                for key, entry in self._entries.items():
+                    if len(entry) < 4 or not self.keep(entry[3]):
+                        del self._entries[key]
+                        self._dirty = True
+            if not self._dirty:
+                return
+            try:
+                with AtomicFile(self.filename, fsync="none") as dst:
+                    json.dump(self._entries, dst)
+                self._dirty = False
+            except (IOError, OSError):
+                self.logger.debug("Failed to save checksums to '%s'" %
+                                  self.filename, exc_info=True)
+
+
 class Config(base.Base):
     """oVirt Node specififc way to persist files
     """
     basedir = '/config'
     path_entries = '/config/files'
+    checksum_cache = '/config/.ovirt-node-checksums'
+
+    # Collects the path entry changes while persisting many paths, see
+    # _bulk_path_entries
+    _path_entry_changes = None
 
     def _config_path(self, fn=""):
         return os.path.join(self.basedir, fn.strip("/"))
@@ -411,31 +1236,55 @@ class Config(base.Base):
     def persist(self, path):
         """Persist path and bind mount it back to its current location
         """
-        # TODO: Abort if it is stateless
-        if not self.is_enabled():
-            return
-
         if path is None:
             return
 
-        abspath = os.path.abspath(path)
-        if os.path.exists(abspath):
-            # Check first for symlinks as os.path file type detection follows
-            # links and will give the type of the target
-            try:
-                if os.path.islink(abspath):
-                    self._persist_symlink(abspath)
-                elif os.path.isdir(abspath):
-                    self._persist_dir(abspath)
-                elif os.path.isfile(abspath):
-                    self._persist_file(abspath)
-            except Exception:
-                self._logger.error('Failed to persist "%s"', path,
-                                   exc_info=True)
-                return -1
-
-            restorecon(abspath)
-            return True
+        return self.persist_many([path])[path]
+
+    def persist_many(self, paths):
+        """Persist many paths and bind mount them back to their current
+        locations
+
+        The paths are persisted one after another, but /config/files is
+        updated and the paths are relabeled only once.
+
+        Returns:
+            A dict mapping each path to its result, like persist(): True if
+            it was persisted, -1 if it failed, None if it was skipped
+        """
+        results = dict((path, None) for path in paths)
+
+        # TODO: Abort if it is stateless
+        if not self.is_enabled():
+            return results
+
+        persisted = []
+        with self._bulk_path_entries():
+            for path in paths:
+                abspath = os.path.abspath(path)
+                if not os.path.exists(abspath):
+                    continue
+                # Check first for symlinks as os.path file type detection
+                # follows links and will give the type of the target
+                try:
+                    if os.path.islink(abspath):
+                        self._persist_symlink(abspath)
+                    elif os.path.isdir(abspath):
+                        self._persist_dir(abspath)
+                    elif os.path.isfile(abspath):
+                        self._persist_file(abspath)
+                except Exception:
+                    self._logger.error('Failed to persist "%s"', path,
+                                       exc_info=True)
+                    results[path] = -1
+                    continue
+                persisted.append(path)
+
+        if persisted:
+            restorecon(*[os.path.abspath(path) for path in persisted])
+        results.update((path, True) for path in persisted)
+        self._checksums().save()
+        return results
 
     def copy_attributes(self, abspath, destpath):
         """Copy the owner/group, selinux context from abspath to destpath"""
@@ -461,20 +1310,38 @@ class Config(base.Base):
                               abspath)
             return
 
-        shutil.copytree(abspath, persisted_path, symlinks=True)
-        self.copy_attributes(abspath, persisted_path)
+        # Preserves the owner and the SELinux context as well
+        fastcopy.copytree(abspath, persisted_path, symlinks=True)
         mount.mount(persisted_path, abspath, flags=mount.MS_BIND)
         self._logger.info('Directory "%s" successfully persisted', abspath)
         self._add_path_entry(abspath)
 
-    def checksum(self, filename):
-        m = hashlib.sha1()
-        with open(filename) as f:
-            data = f.read(4096)
-            while data:
-                m.update(data)
-                data = f.read(4096)
-            return m.hexdigest()
+    def _checksums(self):
+        """The checksum cache, it is only kept in /config if persistence
+        is enabled
+        """
+        if not self.is_enabled():
+            return ChecksumCache.of(None)
+        cache = ChecksumCache.of(self.checksum_cache)
+        # Don't keep the checksums of files which are not persisted
+        cache.keep = self._is_persisted_path
+        return cache
+
+    def _is_persisted_path(self, path):
+        """If path, or the file it is the persisted version of, is an entry
+        of /config/files or below one
+        """
+        if path.startswith(self.basedir + "/"):
+            path = path[len(self.basedir):]
+        entries = self._persisted_path_entries()
+        while path not in ("/", ""):
+            if path in entries:
+                return True
+            path = os.path.dirname(path)
+        return False
+
+    def checksum(self, filename, algo="sha1"):
+        return self._checksums().checksum(filename, algo)
 
     def _persist_file(self, abspath):
         """Persist file and bind mount it back to its current location
@@ -499,8 +1366,8 @@ class Config(base.Base):
                     self._logger.error('Failed to clean up persisted file '
                                        '"%s": %s', abspath, ose.message)
         self._prepare_dir(abspath, persisted_path)
-        shutil.copy2(abspath, persisted_path)
-        self.copy_attributes(abspath, persisted_path)
+        # Preserves the owner and the SELinux context as well
+        fastcopy.copy2(abspath, persisted_path)
         mount.mount(persisted_path, abspath, flags=mount.MS_BIND)
         self._logger.info('File "%s" successfully persisted', abspath)
         self._add_path_entry(abspath)
@@ -548,57 +1415,84 @@ class Config(base.Base):
                 raise
 
     def _persisted_path_entries(self):
-        """Generates the entries in /config/files
+        """The registry of the entries in /config/files
         """
-        with open(self.path_entries) as path_entries:
-            for entry in path_entries:
-                yield entry.strip()
+        return PathEntries.of(self.path_entries)
 
     def _add_path_entry(self, abspath):
         """Adds abspath to /config/files
         """
-        matches = (entry for entry in self._persisted_path_entries() if
-                   entry == abspath)
-        if any(matches):
-            pass  # Entry already present
+        if self._path_entry_changes is not None:
+            self._path_entry_changes["add"].append(abspath)
         else:
-            matches.close()  # Close iterator so that path_entries is closed
-            with open(self.path_entries, 'a') as path_entries:
-                print(abspath, file=path_entries)
+            self._persisted_path_entries().add(abspath)
 
     def _del_path_entry(self, abspath):
-        """Removes a path entry from the /config/files entries
+        """Removes a path entry from the /config/files entries, and the
+        checksums of the file and it's persisted version
+        """
+        checksums = self._checksums()
+        checksums.forget(abspath)
+        checksums.forget(self._config_path(abspath))
+        if self._path_entry_changes is not None:
+            self._path_entry_changes["remove"].append(abspath)
+        else:
+            self._persisted_path_entries().remove(abspath)
+
+    @contextlib.contextmanager
+    def _bulk_path_entries(self):
+        """Collect all path entry changes and apply them at once when
+        leaving the context
         """
-        filtered = '\n'.join(entry for entry in self._persisted_path_entries()
-                             if entry != abspath)
-        with open(self.path_entries, 'w') as path_entries:
-            print(filtered, file=path_entries)
+        self._path_entry_changes = {"add": [], "remove": []}
+        try:
+            yield
+        finally:
+            changes = self._path_entry_changes
+            self._path_entry_changes = None
+            self._persisted_path_entries().update(**changes)
 
     def unpersist(self, path):
         """Remove the persistent version of a file and remove the bind mount
         """
-        if not self.is_enabled():
-            return
-
         if path is None:
             return
 
-        abspath = os.path.abspath(path)
-        if os.path.exists(abspath):
-            # Check first for symlinks as os.path file type detection follows
-            # links and will give the type of the target
-            try:
-                if os.path.islink(abspath):
-                    self._unpersist_symlink(abspath)
-                elif os.path.isdir(abspath):
-                    self._unpersist_dir(abspath)
-                elif os.path.isfile(abspath):
-                    self._unpersist_file(abspath)
-            except Exception:
-                self._logger.error('Failed to unpersist "%s"', path,
-                                   exc_info=True)
-                return -1
-        return True
+        return self.unpersist_many([path])[path]
+
+    def unpersist_many(self, paths):
+        """Remove the persistent versions of many paths and their bind
+        mounts, /config/files is updated only once
+
+        Returns:
+            A dict mapping each path to its result, like unpersist(): True
+            if it was handled, -1 if it failed, None if it was skipped
+        """
+        results = dict((path, None) for path in paths)
+
+        if not self.is_enabled():
+            return results
+
+        with self._bulk_path_entries():
+            for path in paths:
+                abspath = os.path.abspath(path)
+                results[path] = True
+                if not os.path.exists(abspath):
+                    continue
+                # Check first for symlinks as os.path file type detection
+                # follows links and will give the type of the target
+                try:
+                    if os.path.islink(abspath):
+                        self._unpersist_symlink(abspath)
+                    elif os.path.isdir(abspath):
+                        self._unpersist_dir(abspath)
+                    elif os.path.isfile(abspath):
+                        self._unpersist_file(abspath)
+                except Exception:
+                    self._logger.error('Failed to unpersist "%s"', path,
+                                       exc_info=True)
+                    results[path] = -1
+        return results
 
     def _cleanup_tree(self, dirpath):
         """Removes empty directories in the structure. abspath must be a dir"""
@@ -627,7 +1521,7 @@ class Config(base.Base):
         # Remove the original contents and replace them with what was persisted
         # up until now
         shutil.rmtree(abspath)
-        shutil.copytree(persisted_path, abspath, symlinks=True)
+        fastcopy.copytree(persisted_path, abspath, symlinks=True)
         shutil.rmtree(persisted_path)
         self._del_path_entry(abspath)
         self._cleanup_tree(os.path.dirname(persisted_path))
@@ -642,7 +1536,7 @@ class Config(base.Base):
                               abspath)
             return
         mount.umount(abspath)
-        shutil.copy2(persisted_path, abspath)
+        fastcopy.copy2(persisted_path, abspath)
         os.unlink(persisted_path)
         self._del_path_entry(abspath)
         self._cleanup_tree(os.path.dirname(persisted_path))
@@ -713,6 +1607,9 @@ class ShellVarFile(base.Base):
     >>> p.get_dict()
     {}
     >>> p.update(cfg, True)
+    True
+    >>> p.update(cfg, True)
+    False
     >>> p.get_dict() == cfg
     True
     """
@@ -752,8 +1649,8 @@ class ShellVarFile(base.Base):
         data = self._read_contents()
         return self._parse_dict(data)
 
-    def write(self, cfg, remove_empty=True):
-        """Write a dictinory as a key-val file
+    def _sanitize(self, cfg, remove_empty=True):
+        """Check the values of cfg and drop the empty ones if requested
         """
         for key, value in cfg.items():
             if remove_empty and value is None:
@@ -761,12 +1658,43 @@ class ShellVarFile(base.Base):
             if value is not None and type(value) not in [str, unicode]:
                 raise TypeError("The type (%s) of %s is not allowed" %
                                 (type(value), key))
+        return cfg
+
+    def is_unchanged(self, cfg):
+        """Determin if the file already contains exactly the (sanitized) cfg
+        """
+        return self.exists() and self.get_dict() == cfg
+
+    def write(self, cfg, remove_empty=True):
+        """Write a dictinory as a key-val file
+
+        The file is not touched if it already contains the same keys and
+        values.
+
+        >>> p = ShellVarFile(FakeFs.File("dst-file"))
+        >>> p.write({"A": "ah"})
+        True
+        >>> p.write({"A": "ah", "B": None})
+        False
+        >>> p.write({"A": "beh"})
+        True
+        >>> FakeFs.erase()
+
+        Returns:
+            True if the file was changed
+        """
+        self._sanitize(cfg, remove_empty)
+        if self.is_unchanged(cfg):
+            self.logger.debug("Skipping write, no changes: %s" %
+                              self.filename)
+            return False
         lines = []
         # Sort the dict, looks nicer
         for key in sorted(cfg.iterkeys()):
             lines.append("%s=\"%s\"" % (key, cfg[key]))
         contents = "\n".join(lines) + "\n"
         self._write_contents(contents)
+        return True
 
     def update(self, new_dict, remove_empty):
         """Update the file using new_dict
@@ -779,12 +1707,14 @@ class ShellVarFile(base.Base):
                           is None.
                           If False then the keys will be added to the file
                           without any value. (Aka flags)
+        Returns:
+            True if the file was changed
         """
         self.logger.debug("Updating defaults: %s" % new_dict)
         self.logger.debug("Removing empty entries? %s" % remove_empty)
         cfg = self.get_dict()
         cfg.update(new_dict)
-        self.write(cfg, remove_empty)
+        return self.write(cfg, remove_empty)
 
     def _parse_dict(self, txt):
         """Parse a simple shell-var-style lines into a dict:
@@ -800,3 +1730,13 @@ class ShellVarFile(base.Base):
         [('A', 'ah'), ('B', 'beh'), ('C', 'ceh'), ('D', 'more=less')]
         """
         return parse_varfile(txt)
+
+
+_linkat = ctypes.CFUNCTYPE(
+    ctypes.c_int,  # ret
+    ctypes.c_int,  # olddirfd
+    ctypes.c_char_p,  # oldpath
+    ctypes.c_int,  # newdirfd
+    ctypes.c_char_p,  # newpath
+    ctypes.c_int,  # flags
+    use_errno=True)(('linkat', LIBC))
@@ -0,0 +1,368 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+#
+# fastcopy.py - Copyright (C) 2014 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.  A copy of the GNU General Public License is
+# also available at http://www.gnu.org/copyleft/gpl.html.
+
+"""
+Copying files without moving the data through python buffers
+
+The contents are cloned (reflink) if the filesystem supports it, otherwise
+they are copied in the kernel using copy_file_range or sendfile. If none of
+these works, the file is streamed with a bounded buffer.
+
+>>> import tempfile
+>>> tmpdir = tempfile.mkdtemp()
+>>> src = os.path.join(tmpdir, "src")
+>>> with open(src, "w") as f:
+...     f.write("Woot" * 1024)
+>>> os.chmod(src, 0640)
+
+>>> copy2(src, os.path.join(tmpdir, "dst")) in METHODS
+True
+>>> open(os.path.join(tmpdir, "dst")).read() == "Woot" * 1024
+True
+>>> oct(os.stat(os.path.join(tmpdir, "dst")).st_mode & 0777)
+'0640'
+
+>>> os.symlink("src", os.path.join(tmpdir, "link"))
+>>> os.mkfifo(os.path.join(tmpdir, "fifo"))
+>>> copytree(tmpdir, tmpdir + ".copy")
+>>> sorted(os.listdir(tmpdir + ".copy"))
+['dst', 'fifo', 'link', 'src']
+>>> os.readlink(os.path.join(tmpdir + ".copy", "link"))
+'src'
+
+Special files are recreated by copytree, but their contents are never
+read:
+
+>>> stat.S_ISFIFO(os.lstat(os.path.join(tmpdir + ".copy", "fifo")).st_mode)
+True
+>>> fifo = os.path.join(tmpdir, "fifo")
+>>> copy2(fifo, fifo + ".copy")  #doctest: +ELLIPSIS
+Traceback (most recent call last):
+SpecialFileError: `.../fifo` is a named pipe
+
+>>> import shutil
+>>> shutil.rmtree(tmpdir)
+>>> shutil.rmtree(tmpdir + ".copy")
+"""
+
+import ctypes
+import errno
+import fcntl
+import logging
+import os
+import shutil
+import stat
+
+LOGGER = logging.getLogger(__name__)
+
+LIBC = ctypes.CDLL('libc.so.6', use_errno=True)
+
+FICLONE = 0x40049409  # _IOW(0x94, 9, int)
+
+# The largest chunk handed to the kernel at once
+CHUNK_SIZE = 1 << 30
+# The buffer size used when streaming the contents
+BUFFER_SIZE = 64 * 1024
+
+METHODS = ["reflink", "copy_file_range", "sendfile", "stream"]
+
+# Errors indicating that a method is not supported for the given files
+_UNSUPPORTED = (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.ENOTTY,
+                errno.EOPNOTSUPP, errno.EBADF)
+
+
+def copyfile(src, dst):
+    """Copy the contents of src to dst
+
+    Returns:
+        The method which was used to copy the data (see METHODS)
+    """
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        raise shutil.Error("`%s` and `%s` are the same file" % (src, dst))
+    kind = _special_file_kind(os.stat(src).st_mode)
+    if kind:
+        # Opening e.g. a FIFO for reading blocks until a writer appears
+        raise shutil.SpecialFileError("`%s` is a %s" % (src, kind))
+
+    srcfd = os.open(src, os.O_RDONLY)
+    try:
+        dstfd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0666)
+        try:
+            return copy_fd(srcfd, dstfd)
+        finally:
+            os.close(dstfd)
+    finally:
+        os.close(srcfd)
+
+
+def copy(src, dst):
+    """Copy the contents and the mode of src to dst, like shutil.copy
+    """
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    method = copyfile(src, dst)
+    shutil.copymode(src, dst)
+    return method
+
+
+def copy2(src, dst):
+    """Copy the contents, mode, times, owner and xattrs of src to dst,
+    like shutil.copy2 (or cp -a)
+    """
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    method = copyfile(src, dst)
+    copy_attributes(src, dst)
+    return method
+
+
+def copytree(src, dst, symlinks=True):
+    """Recursively copy the directory src to dst (which must not exist),
+    like shutil.copytree, but all attributes are preserved
+    """
+    names = os.listdir(src)
+    os.makedirs(dst)
+    errors = []
+    for name in names:
+        srcname = os.path.join(src, name)
+        dstname = os.path.join(dst, name)
+        try:
+            if symlinks and os.path.islink(srcname):
+                os.symlink(os.readlink(srcname), dstname)
+                copy_attributes(srcname, dstname)
+            elif os.path.isdir(srcname):
+                copytree(srcname, dstname, symlinks)
+            elif _special_file_kind(os.lstat(srcname).st_mode):
+                st = os.lstat(srcname)
+                os.mknod(dstname, st.st_mode, st.st_rdev)
+                copy_attributes(srcname, dstname)
+            else:
+                copy2(srcname, dstname)
+        except shutil.Error as e:
+            errors.extend(e.args[0])
+        except EnvironmentError as e:
+            errors.append((srcname, dstname, str(e)))
+    try:
+        copy_attributes(src, dst)
+    except EnvironmentError as e:
+        errors.append((src, dst, str(e)))
+    if errors:
+        raise shutil.Error(errors)
+
+
+def _special_file_kind(mode):
+    """The kind of special file mode belongs to, or None
+
+    >>> _special_file_kind(stat.S_IFIFO), _special_file_kind(stat.S_IFREG)
+    ('named pipe', None)
+    """
+    for check, kind in [(stat.S_ISFIFO, "named pipe"),
+                        (stat.S_ISSOCK, "socket"),
+                        (stat.S_ISCHR, "character device"),
+                        (stat.S_ISBLK, "block device")]:
+        if check(mode):
+            return kind
+    return None
+
+
+def copy_attributes(src, dst):
+    """Copy the mode, times, owner and extended attributes (including the
+    SELinux context) of src to dst, symlinks are not followed
+    """
+    st = os.lstat(src)
+    if not stat.S_ISLNK(st.st_mode):
+        shutil.copystat(src, dst)
+    try:
+        os.lchown(dst, st.st_uid, st.st_gid)
+    except OSError as e:
+        if e.errno != errno.EPERM:
+            raise
+        LOGGER.debug("Not allowed to change the owner of '%s'" % dst)
+    copy_xattrs(src, dst)
+
+
+def copy_xattrs(src, dst):
+    """Copy the extended attributes of src to dst, attributes which are
+    not supported or may not be set are skipped
+    """
+    for name in listxattr(src):
+        try:
+            setxattr(dst, name, getxattr(src, name))
+        except OSError as e:
+            if e.errno not in (errno.EOPNOTSUPP, errno.EPERM,
+                               errno.EACCES, errno.ENODATA):
+                raise
+            LOGGER.debug("Skipping xattr '%s' of '%s': %s" % (name, dst, e))
+
+
+def listxattr(path):
+    """The names of the extended attributes of path (not following
+    symlinks)
+    """
+    size = _llistxattr(path, None, 0)
+    if size == -1:
+        e = ctypes.get_errno()
+        if e in (errno.EOPNOTSUPP, errno.ENOSYS):
+            return []
+        raise OSError(e, os.strerror(e), path)
+    buf = ctypes.create_string_buffer(size)
+    size = _llistxattr(path, buf, size)
+    if size == -1:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e), path)
+    return [name for name in buf.raw[:size].split("\0") if name]
+
+
+def getxattr(path, name):
+    size = _lgetxattr(path, name, None, 0)
+    if size == -1:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e), path)
+    buf = ctypes.create_string_buffer(size)
+    size = _lgetxattr(path, name, buf, size)
+    if size == -1:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e), path)
+    return buf.raw[:size]
+
+
+def setxattr(path, name, value):
+    if _lsetxattr(path, name, value, len(value), 0) == -1:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e), path)
+
+
+def copy_fd(srcfd, dstfd):
+    """Copy all data from srcfd to dstfd, starting at their current
+    offsets, with the fastest working method
+    """
+    # Whole files can only be cloned from the start
+    if os.lseek(srcfd, 0, os.SEEK_CUR) == 0 and \
+       os.lseek(dstfd, 0, os.SEEK_CUR) == 0:
+        try:
+            fcntl.ioctl(dstfd, FICLONE, srcfd)
+            os.lseek(srcfd, 0, os.SEEK_END)
+            os.lseek(dstfd, 0, os.SEEK_END)
+            return "reflink"
+        except IOError as e:
+            if e.errno not in _UNSUPPORTED:
+                raise
+
+    # The kernel based methods advance the file offsets, so the next
+    # method can just continue where a previous one gave up
+    if _copy_file_range and _copy_kernel(_copy_file_range_chunk, srcfd,
+                                         dstfd):
+        return "copy_file_range"
+    if _copy_kernel(_sendfile_chunk, srcfd, dstfd):
+        return "sendfile"
+
+    while True:
+        data = os.read(srcfd, BUFFER_SIZE)
+        if not data:
+            break
+        while data:
+            data = data[os.write(dstfd, data):]
+    return "stream"
+
+
+def _copy_kernel(chunk_func, srcfd, dstfd):
+    """Copy using chunk_func until the end of the file
+
+    Returns:
+        True if all data was copied, False if the method is not supported
+    """
+    while True:
+        copied = chunk_func(srcfd, dstfd, CHUNK_SIZE)
+        if copied == 0:
+            return True
+        if copied == -1:
+            e = ctypes.get_errno()
+            if e == errno.EINTR:
+                continue
+            if e in _UNSUPPORTED:
+                return False
+            raise OSError(e, os.strerror(e))
+
+
+def _copy_file_range_chunk(srcfd, dstfd, count):
+    return _copy_file_range(srcfd, None, dstfd, None, count, 0)
+
+
+def _sendfile_chunk(srcfd, dstfd, count):
+    return _sendfile(dstfd, srcfd, None, count)
+
+
+def _libc_func(name, restype, *argtypes):
+    """Returns the libc function name, or None if it is not available
+    """
+    try:
+        func = getattr(LIBC, name)
+    except AttributeError:
+        return None
+    func.restype = restype
+    func.argtypes = argtypes
+    return func
+
+
+_copy_file_range = _libc_func(
+    'copy_file_range',
+    ctypes.c_ssize_t,  # ret
+    ctypes.c_int,  # fd_in
+    ctypes.c_void_p,  # off_in
+    ctypes.c_int,  # fd_out
+    ctypes.c_void_p,  # off_out
+    ctypes.c_size_t,  # len
+    ctypes.c_uint)  # flags
+
+
+_sendfile = _libc_func(
+    'sendfile',
+    ctypes.c_ssize_t,  # ret
+    ctypes.c_int,  # out_fd
+    ctypes.c_int,  # in_fd
+    ctypes.c_void_p,  # offset
+    ctypes.c_size_t)  # count
+
+
+_llistxattr = _libc_func(
+    'llistxattr',
+    ctypes.c_ssize_t,  # ret
+    ctypes.c_char_p,  # path
+    ctypes.c_char_p,  # list
+    ctypes.c_size_t)  # size
+
+
+_lgetxattr = _libc_func(
+    'lgetxattr',
+    ctypes.c_ssize_t,  # ret
+    ctypes.c_char_p,  # path
+    ctypes.c_char_p,  # name
+    ctypes.c_char_p,  # value
+    ctypes.c_size_t)  # size
+
+
+_lsetxattr = _libc_func(
+    'lsetxattr',
+    ctypes.c_int,  # ret
+    ctypes.c_char_p,  # path
+    ctypes.c_char_p,  # name
+    ctypes.c_char_p,  # value
+    ctypes.c_size_t,  # size
+    ctypes.c_int)  # flags
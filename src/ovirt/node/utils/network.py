@@ -262,6 +262,7 @@ class NIC(base.Base):
 
         # Fallback
         process.call(["ip", "link", "set", "dev", self.ifname, "up"])
+        process.invalidate(process.NETWORK)
 
         content = File("/sys/class/net/%s/carrier" % self.ifname).read()
         has_carrier = "1" in content
@@ -306,8 +307,11 @@ class NIC(base.Base):
             return addresses
 
         # Fallback
-        cmd = "ip -o addr show {ifname}".format(ifname=self.ifname)
-        for line in process.pipe(cmd, shell=True).split("\n"):
+        cmd = ["ip", "-o", "addr", "show", self.ifname]
+        for line in process.cached_output(cmd,
+                                          invalidate_on=[process.NETWORK],
+                                          check=False,
+                                          stderr=process.STDOUT).split("\n"):
             matches = re.search("\s(inet[6]?)\s(.+)/([^\s]+)"
                                 ".*scope ([^\s]+).*", line)
             if matches and matches.groups():
@@ -681,7 +685,10 @@ class Routes(base.Base):
         # Fallback
         gw = None
         cmd = ["ip", "route", "list"]
-        for line in process.pipe(cmd).split("\n"):
+        for line in process.cached_output(cmd,
+                                          invalidate_on=[process.NETWORK],
+                                          check=False,
+                                          stderr=process.STDOUT).split("\n"):
             token = re.split("\s+", line)
             if line.startswith("default via"):
                 gw = token[2]
@@ -867,6 +874,7 @@ class Vlans(base.Base):
             raise RuntimeError("Can no delete '%s', is no vlan device" %
                                ifname)
         process.call(["ip", "link", "del", ifname])
+        process.invalidate(process.NETWORK)
 
 
 class Bridges(base.Base):
@@ -882,6 +890,7 @@ class Bridges(base.Base):
             raise RuntimeError("Can no delete '%s', is no bridge" % ifname)
         process.call(["ip", "link", "set", "dev", ifname, "down"])
         process.call(["brctl", "delbr", ifname])
+        process.invalidate(process.NETWORK)
 
     def slave_for_bridge(self, nic):
         try:
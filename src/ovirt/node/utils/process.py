@@ -20,8 +20,17 @@
 # also available at http://www.gnu.org/copyleft/gpl.html.
 from subprocess import STDOUT, PIPE
 from ovirt.node import log
+import codecs
+import collections
+import json
+import os
+import re
+import select
+import signal
 import subprocess
 import sys
+import threading
+import time
 
 """
 Some convenience functions related to processes
@@ -73,6 +82,317 @@ def masked(masks):
     return MaskedLog()
 
 
+_recorders = threading.local()
+
+
+class recording(object):
+    """A context manager collecting the commands run by the current thread
+
+    >>> with recording() as calls:
+    ...     _ = call(["true"])
+    ...     _ = call("exit 3", shell=True)
+    >>> [(c["cmd"], c["returncode"]) for c in calls]
+    [(['true'], 0), ('exit 3', 3)]
+    >>> all(c["duration"] >= 0 for c in calls)
+    True
+
+    Recordings can be nested, a command is only collected by the innermost
+    one:
+
+    >>> with recording() as outer:
+    ...     with recording() as inner:
+    ...         pass
+    ...     with recording() as empty:
+    ...         _ = call(["true"])
+    ...     _ = call(["false"])
+    >>> [c["cmd"] for c in outer], inner, [c["cmd"] for c in empty]
+    ([['false']], [], [['true']])
+    >>> _recorders.stack
+    []
+    """
+    def __init__(self):
+        self.calls = []
+
+    def __enter__(self):
+        if not hasattr(_recorders, "stack"):
+            _recorders.stack = []
+        _recorders.stack.append(self.calls)
+        return self.calls
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        top = _recorders.stack.pop()
+        assert top is self.calls, "Recordings must be left in order"
+
+
+# The most recent spawns of this process, see accounting_top()
+ACCOUNTING_SIZE = 1024
+ACCOUNTING_DUMP = "/var/log/ovirt-node-subprocesses.json"
+
+_accounting = collections.deque(maxlen=ACCOUNTING_SIZE)
+_accounting_wrappers = set()
+
+
+def accounting_wrapper(func):
+    """Decorate functions wrapping the spawning of processes, so that the
+    caller of the wrapper is accounted instead of the wrapper itself
+    """
+    _accounting_wrappers.add(func.func_code)
+    return func
+
+
+def _caller():
+    """The first frame outside of this module and the process wrappers
+    """
+    frame = sys._getframe(1)
+    while frame and (frame.f_globals.get("__name__") in (__name__,
+                                                         "subprocess") or
+                     frame.f_code in _accounting_wrappers):
+        frame = frame.f_back
+    if not frame:
+        return None
+    return "%s:%d %s" % (frame.f_code.co_filename, frame.f_lineno,
+                         frame.f_code.co_name)
+
+
+def _record_call(cmd, started, returncode, output_size=None, caller=None):
+    entry = {"cmd": cmd,
+             "caller": caller or _caller(),
+             "started": started,
+             "duration": time.time() - started,
+             "returncode": returncode,
+             "output_size": output_size}
+    _accounting.append(entry)
+    stack = getattr(_recorders, "stack", None)
+    if stack:
+        stack[-1].append(entry)
+
+
+def accounting():
+    """The recorded spawns, oldest first
+
+    >>> _ = call(["true"])
+    >>> entry = accounting()[-1]
+    >>> entry["cmd"], entry["returncode"], entry["caller"] is not None
+    (['true'], 0, True)
+    >>> _ = pipe(["echo", "-n", "42"])
+    >>> accounting()[-1]["output_size"]
+    2
+    """
+    return list(_accounting)
+
+
+def accounting_dump(filename=None):
+    """Dump the recorded spawns as JSON, into filename if given
+
+    Returns:
+        The JSON document
+    """
+    data = json.dumps(accounting(), indent=2)
+    if filename:
+        with open(filename, "w") as dst:
+            dst.write(data)
+    return data
+
+
+def _command_name(cmd):
+    """The program of a command, to aggregate calls
+
+    >>> _command_name(["/usr/bin/lvm", "vgs"])
+    'lvm'
+    >>> _command_name("udevadm settle 2>/dev/null")
+    'udevadm'
+    """
+    if type(cmd) in [str, unicode]:
+        cmd = cmd.split()
+    return os.path.basename(cmd[0]) if cmd else str(cmd)
+
+
+def accounting_top(entries=None, limit=10):
+    """Aggregate spawns by program, ordered by their total time
+
+    >>> entries = [{"cmd": ["lvm", "vgs"], "duration": 0.5},
+    ...            {"cmd": "blkid -L Root", "duration": 0.2},
+    ...            {"cmd": ["lvm", "lvs"], "duration": 0.25}]
+    >>> for line in accounting_top(entries):
+    ...     print line
+    Total (s)    Calls  Max (s)  Command
+        0.750        2    0.500  lvm
+        0.200        1    0.200  blkid
+
+    Returns:
+        A list of lines
+    """
+    if entries is None:
+        entries = accounting()
+    totals = {}
+    for entry in entries:
+        name = _command_name(entry["cmd"])
+        total, count, longest = totals.get(name, (0, 0, 0))
+        totals[name] = (total + entry["duration"], count + 1,
+                        max(longest, entry["duration"]))
+    ranking = sorted(totals.items(), key=lambda i: i[1][0], reverse=True)
+    lines = ["Total (s)    Calls  Max (s)  Command"]
+    for name, (total, count, longest) in ranking[:limit]:
+        lines.append("%9.3f  %7d  %7.3f  %s" % (total, count, longest, name))
+    return lines
+
+
+def install_accounting_handler(signum=signal.SIGUSR2,
+                               filename=ACCOUNTING_DUMP):
+    """Dump the recorded spawns to filename and log the top commands
+    whenever this process receives signum
+    """
+    def _handler(signum, frame):
+        logger = log.getLogger(__name__)
+        try:
+            accounting_dump(filename)
+        except IOError as e:
+            logger.warning("Failed to dump the subprocesses: %s" % e)
+        logger.info("Top commands by total time:\n%s" %
+                    "\n".join(accounting_top()))
+    signal.signal(signum, _handler)
+
+
+# Invalidation groups of cached_output and cached_call
+BLOCK_DEVICES = "block-devices"
+NETWORK = "network"
+PACKAGES = "packages"
+
+_output_cache = {}
+_output_cache_lock = threading.Lock()
+_output_cache_generations = {}
+_output_cache_stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+
+def cached_output(argv, ttl=10, invalidate_on=(), check=True, **kwargs):
+    """Run a read-only command and memoize its output (and return code)
+    for ttl seconds, by argv and the remaining Popen arguments (e.g. env)
+
+    The results can be dropped early by invalidating one of the groups
+    given in invalidate_on, e.g. when the block devices changed.
+
+    >>> _ = invalidate()
+    >>> stats = cache_stats()
+    >>> cached_output(["date", "+%N"]) == cached_output(["date", "+%N"])
+    True
+    >>> cache_stats()["hits"] - stats["hits"]
+    1
+    >>> out = cached_output(["date", "+%s%N"], invalidate_on=[NETWORK])
+    >>> invalidate(NETWORK)
+    1
+    >>> out == cached_output(["date", "+%s%N"], invalidate_on=[NETWORK])
+    False
+    >>> cached_output(["false"])
+    Traceback (most recent call last):
+    ...
+    CalledProcessError: Command '['false']' returned non-zero exit status 1
+    >>> cached_output(["false"], check=False)
+    u''
+
+    Returns:
+        The stdout of the command
+    """
+    stdout, returncode = _cached_run(argv, ttl, invalidate_on, kwargs)
+    if check and returncode != 0:
+        raise CalledProcessError(returncode, argv, output=stdout)
+    return stdout
+
+
+def cached_call(argv, ttl=10, invalidate_on=(), **kwargs):
+    """Like cached_output, but returns the return code of the command.
+    Both share the cache, so the output of a command can be read after
+    checking its return code without running it again.
+
+    >>> _ = invalidate()
+    >>> cached_call(["false"]), cached_call(["true"])
+    (1, 0)
+    >>> stats = cache_stats()
+    >>> cached_call(["echo", "42"]), cached_output(["echo", "42"])
+    (0, u'42\\n')
+    >>> cache_stats()["misses"] - stats["misses"]
+    1
+
+    Returns:
+        The return code of the command
+    """
+    return _cached_run(argv, ttl, invalidate_on, kwargs)[1]
+
+
+def _cached_run(argv, ttl, invalidate_on, kwargs):
+    assert type(argv) is list, "cached commands require an argv list"
+    key = (tuple(argv),
+           tuple(sorted((k, tuple(sorted(v.items())) if type(v) is dict
+                         else v) for k, v in kwargs.items())))
+    groups = frozenset(invalidate_on)
+
+    with _output_cache_lock:
+        entry = _output_cache.get(key)
+        if entry and entry[0] > time.time():
+            _output_cache_stats["hits"] += 1
+        else:
+            entry = None
+            _output_cache_stats["misses"] += 1
+            generations = [_output_cache_generations.get(g, 0)
+                           for g in [None] + sorted(groups)]
+
+    if entry:
+        return entry[1], entry[2]
+
+    log_call("Caching output of", [argv], kwargs)
+    started = time.time()
+    proc = popen(argv, stdout=PIPE, **kwargs)
+    stdout, stderr = proc.communicate()
+    returncode = proc.returncode
+    stdout = unicode(stdout, encoding=sys.stdin.encoding or "utf-8")
+
+    with _output_cache_lock:
+        # Don't store results which might have been invalidated while
+        # the command was running
+        if generations == [_output_cache_generations.get(g, 0)
+                           for g in [None] + sorted(groups)]:
+            _output_cache[key] = (started + ttl, stdout, returncode, groups)
+    return stdout, returncode
+
+
+def invalidate(group=None):
+    """Drop the cached outputs of the given group, or all if group is None
+
+    Returns:
+        The number of dropped entries
+    """
+    with _output_cache_lock:
+        _output_cache_generations[group] = \
+            _output_cache_generations.get(group, 0) + 1
+        keys = [key for key, entry in _output_cache.items()
+                if group is None or group in entry[3]]
+        for key in keys:
+            del _output_cache[key]
+        _output_cache_stats["invalidations"] += 1
+        return len(keys)
+
+
+def generation(group):
+    """A counter which changes whenever group (or everything) is
+    invalidated, allowing other caches to follow the invalidations
+
+    >>> before = generation(BLOCK_DEVICES)
+    >>> _ = invalidate(BLOCK_DEVICES)
+    >>> generation(BLOCK_DEVICES) == before
+    False
+    """
+    with _output_cache_lock:
+        return (_output_cache_generations.get(None, 0),
+                _output_cache_generations.get(group, 0))
+
+
+def cache_stats():
+    """Returns the hit, miss and invalidation counters of cached_output
+    and cached_call
+    """
+    with _output_cache_lock:
+        return dict(_output_cache_stats)
+
+
 def __update_kwargs(kwargs):
     new_kwargs = dict(COMMON_POPEN_ARGS)
     new_kwargs.update(kwargs)
@@ -103,13 +423,85 @@ def __check_for_problems(args, kwargs):
                            "must be a string. A list otherwise.")
 
 
+def _open_fds():
+    """The open file descriptors of this process, None if they can not
+    be determined
+
+    >>> 0 in _open_fds()
+    True
+    """
+    try:
+        return [int(fd) for fd in os.listdir("/proc/self/fd")]
+    except OSError:
+        return None
+
+
+class AccountedPopen(subprocess.Popen):
+    """A Popen which is accounted once the process was reaped, and which
+    only closes the descriptors which are actually open with close_fds
+
+    >>> r, w = os.pipe()
+    >>> check_output(["ls", "/proc/self/fd"]).split()
+    [u'0', u'1', u'2', u'3']
+    >>> os.close(r), os.close(w)
+    (None, None)
+    """
+    output_size = None
+
+    def __init__(self, *args, **kwargs):
+        self._accounting = (args[0] if args else kwargs.get("args"),
+                            time.time(), _caller())
+        self._communicating = False
+        super(AccountedPopen, self).__init__(*args, **kwargs)
+
+    def wait(self):
+        returncode = super(AccountedPopen, self).wait()
+        if not self._communicating:
+            self._account()
+        return returncode
+
+    def poll(self):
+        returncode = super(AccountedPopen, self).poll()
+        self._account()
+        return returncode
+
+    def communicate(self, input=None):
+        self._communicating = True
+        try:
+            stdout, stderr = super(AccountedPopen, self).communicate(input)
+        finally:
+            self._communicating = False
+        self.output_size = len(stdout or "") + len(stderr or "")
+        self._account()
+        return stdout, stderr
+
+    def _close_fds(self, but):
+        # Called in the child: Only close the descriptors which are open,
+        # instead of all up to the limit of open files
+        fds = _open_fds()
+        if fds is None:
+            return super(AccountedPopen, self)._close_fds(but)
+        for fd in fds:
+            if fd > 2 and fd != but:
+                # Unlike os.close, this ignores already closed descriptors
+                # (like the one used to list them)
+                os.closerange(fd, fd + 1)
+
+    def _account(self):
+        if self.returncode is not None and self._accounting:
+            cmd, started, caller = self._accounting
+            self._accounting = None
+            _record_call(cmd, started, self.returncode, self.output_size,
+                         caller)
+
+
 def popen(*args, **kwargs):
     """subprocess.Popen wrapper to not leak file descriptors
     """
     kwargs = __update_kwargs(kwargs)
     log_call("Popen with", args, kwargs)
     # Intentionally no check for common problems
-    return subprocess.Popen(*args, **kwargs)
+    return AccountedPopen(*args, **kwargs)
 
 
 def call(*args, **kwargs):
@@ -127,7 +519,7 @@ def call(*args, **kwargs):
     kwargs = __update_kwargs(kwargs)
     log_call("Calling with", args, kwargs)
     __check_for_problems(args, kwargs)
-    return int(subprocess.call(*args, **kwargs))
+    return int(AccountedPopen(*args, **kwargs).wait())
 
 
 def check_call(*args, **kwargs):
@@ -136,7 +528,11 @@ def check_call(*args, **kwargs):
     kwargs = __update_kwargs(kwargs)
     log_call("Checking call with", args, kwargs)
     __check_for_problems(args, kwargs)
-    return int(subprocess.check_call(*args, **kwargs))
+    returncode = AccountedPopen(*args, **kwargs).wait()
+    if returncode != 0:
+        raise CalledProcessError(returncode,
+                                 args[0] if args else kwargs.get("args"))
+    return 0
 
 
 def check_output(*args, **kwargs):
@@ -151,19 +547,20 @@ def check_output(*args, **kwargs):
     ...
     CalledProcessError: Command 'false' returned non-zero exit status 1
     """
+    if "stdout" in kwargs:
+        raise ValueError("stdout argument not allowed, it will be "
+                         "overridden.")
     kwargs = __update_kwargs(kwargs)
     log_call("Checking output with", args, kwargs)
     __check_for_problems(args, kwargs)
-    stdout = None
-    try:
-        stdout = subprocess.check_output(*args, **kwargs)
-        stdout = unicode(stdout,
-                         encoding=sys.stdin.encoding or "utf-8")
-    except AttributeError:
-        # We're probably on Python 2.6, which doesn't have check_output
-        # http://docs.python.org/2.6/library/subprocess.html#module-subprocess
-        # Working around by using pipe with it's check feature
-        stdout = pipe(*args, check=True, **kwargs)
+    proc = AccountedPopen(*args, stdout=PIPE, **kwargs)
+    stdout, stderr = proc.communicate()
+    if proc.returncode != 0:
+        raise CalledProcessError(proc.returncode,
+                                 args[0] if args else kwargs.get("args"),
+                                 output=stdout)
+    stdout = unicode(stdout,
+                     encoding=sys.stdin.encoding or "utf-8")
 
     return stdout
 
@@ -228,3 +625,420 @@ def pipe(cmd, stdin=None, check=False, **kwargs):
                      encoding=sys.stdin.encoding or "utf-8")
 
     return stdout
+
+
+class TimeoutExpired(CalledProcessError):
+    """Raised when a command was killed because it ran for too long
+    """
+    def __init__(self, cmd, timeout, output=None):
+        super(TimeoutExpired, self).__init__(-signal.SIGKILL, cmd, output)
+        self.timeout = timeout
+
+    def __str__(self):
+        return "Command '%s' timed out after %s seconds" % (self.cmd,
+                                                            self.timeout)
+
+
+def run_many(commands, max_workers=8, timeout=None, check=False, **kwargs):
+    """Run independent non-interactive commands concurrently
+
+    Like pipe(), stderr is merged into stdout unless it is redirected
+    explicitly. A command which runs longer than timeout seconds is killed.
+
+    >>> run_many([["sh", "-c", "sleep 0.2; echo a"], ["echo", "b"],
+    ...           ["false"]])
+    [(0, u'a\\n'), (0, u'b\\n'), (1, u'')]
+    >>> run_many(["sleep 5"], timeout=0.1, shell=True)
+    [(-9, u'')]
+
+    With check, the first failing command cancels the others and it's
+    error is raised:
+    >>> run_many([["true"], ["false"], ["sleep", "5"]], check=True)
+    Traceback (most recent call last):
+    ...
+    CalledProcessError: Command '['false']' returned non-zero exit status 1
+    >>> run_many([["sleep", "5"]], timeout=0.1, check=True)
+    Traceback (most recent call last):
+    ...
+    TimeoutExpired: Command '['sleep', '5']' timed out after 0.1 seconds
+
+    Args:
+        commands: A list of commands, each as it would be passed to popen()
+        max_workers: The maximum number of commands running at a time
+        timeout: Seconds after which a command is killed
+        check: Raise if a command fails or times out
+
+    Returns:
+        A list of (returncode, stdout) tuples, in the order of commands
+    """
+    kwargs = dict(kwargs)
+    kwargs.setdefault("stderr", STDOUT)
+    kwargs["stdout"] = PIPE
+    for cmd in commands:
+        __check_for_problems([cmd], kwargs)
+
+    results = [None] * len(commands)
+    failures = []
+    running = {}
+    pending = iter(enumerate(commands))
+    lock = threading.Lock()
+    cancelled = threading.Event()
+
+    def kill(proc):
+        try:
+            proc.kill()
+        except OSError:
+            # Already gone
+            pass
+
+    def cancel():
+        # Needs to be called with the lock held
+        cancelled.set()
+        for proc in running.values():
+            kill(proc)
+
+    def run(idx, cmd):
+        proc = popen(cmd, **kwargs)
+        with lock:
+            running[idx] = proc
+            if cancelled.is_set():
+                kill(proc)
+        expired = []
+        timer = None
+        if timeout is not None:
+            def expire():
+                expired.append(True)
+                kill(proc)
+            timer = threading.Timer(timeout, expire)
+            timer.daemon = True
+            timer.start()
+        try:
+            stdout, stderr = proc.communicate()
+        finally:
+            if timer:
+                timer.cancel()
+            with lock:
+                del running[idx]
+        stdout = unicode(stdout or "", encoding=sys.stdin.encoding or "utf-8")
+
+        error = None
+        if expired:
+            error = TimeoutExpired(cmd, timeout, stdout)
+        elif proc.returncode != 0:
+            error = CalledProcessError(proc.returncode, cmd, stdout)
+        return (proc.returncode, stdout), error
+
+    def worker():
+        while not cancelled.is_set():
+            with lock:
+                try:
+                    idx, cmd = next(pending)
+                except StopIteration:
+                    return
+            try:
+                results[idx], error = run(idx, cmd)
+                if not check:
+                    error = None
+            except Exception as e:
+                error = e
+            if error is not None:
+                with lock:
+                    # Commands killed by the cancellation are no failures
+                    if not cancelled.is_set():
+                        failures.append(error)
+                        cancel()
+
+    workers = [threading.Thread(target=worker)
+               for _ in range(min(max_workers, len(commands)))]
+    for thread in workers:
+        thread.daemon = True
+        thread.start()
+    try:
+        for thread in workers:
+            # Join with a timeout to stay responsive to ctrl+c
+            while thread.is_alive():
+                thread.join(0.1)
+    except BaseException:
+        with lock:
+            cancel()
+        raise
+
+    if failures:
+        raise failures[0]
+    return results
+
+
+def stream(cmd, chunk_size=None, max_line=64 * 1024, tee=None, timeout=None,
+           kill_on_cancel=True, check=False, **kwargs):
+    """Run a non-interactive command and yield it's output as it arrives
+
+    Decoded lines (including the line break) are yielded, lines longer than
+    max_line are split. If chunk_size is given, chunks of at most chunk_size
+    bytes are yielded instead. Like pipe(), stderr is merged into stdout
+    unless it is redirected explicitly.
+
+    The output is only read when the next item is requested, a slow
+    consumer blocks the process instead of it's output piling up in memory.
+
+    >>> list(stream(["printf", "a\\nb\\nc"]))
+    [u'a\\n', u'b\\n', u'c']
+    >>> list(stream(["echo", "abcde"], chunk_size=2))
+    [u'ab', u'cd', u'e\\n']
+    >>> list(stream("echo 42 ; exit 3", shell=True, check=True))
+    Traceback (most recent call last):
+    ...
+    CalledProcessError: Command 'echo 42 ; exit 3' returned non-zero exit \
+status 3
+    >>> list(stream(["sleep", "5"], timeout=0.1))
+    Traceback (most recent call last):
+    ...
+    TimeoutExpired: Command '['sleep', '5']' timed out after 0.1 seconds
+
+    Stopping early kills the process:
+    >>> lines = stream(["yes"])
+    >>> next(lines)
+    u'y\\n'
+    >>> lines.close()
+
+    Args:
+        cmd: Cmdline to be run
+        tee: A filename or file receiving a copy of the (raw) output
+        timeout: Seconds after which the process is killed and
+                 TimeoutExpired is raised
+        kill_on_cancel: Kill the process if the consumer stops early,
+                        otherwise wait until it exits
+        check: Raise a CalledProcessError if the cmd fails
+    """
+    kwargs.setdefault("stderr", STDOUT)
+    kwargs.update({"stdin": PIPE,
+                   "stdout": PIPE})
+    __check_for_problems([cmd], kwargs)
+
+    deadline = time.time() + timeout if timeout is not None else None
+    decoder = codecs.getincrementaldecoder(sys.stdin.encoding or "utf-8")(
+        errors="replace")
+    tee_file = open(tee, "ab") if type(tee) in [str, unicode] else tee
+
+    proc = popen(cmd, **kwargs)
+    proc.stdin.close()
+    proc.output_size = 0
+    fd = proc.stdout.fileno()
+    pending = u""
+    finished = False
+    try:
+        while True:
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0 or \
+                   not select.select([fd], [], [], remaining)[0]:
+                    proc.kill()
+                    raise TimeoutExpired(cmd, timeout)
+            data = os.read(fd, chunk_size or 64 * 1024)
+            proc.output_size += len(data)
+            if tee_file and data:
+                tee_file.write(data)
+            text = decoder.decode(data, final=not data)
+
+            if chunk_size:
+                if text:
+                    yield text
+            else:
+                lines = (pending + text).split(u"\n")
+                pending = lines.pop()
+                for line in lines:
+                    while len(line) >= max_line:
+                        yield line[:max_line]
+                        line = line[max_line:]
+                    yield line + u"\n"
+                while len(pending) >= max_line:
+                    yield pending[:max_line]
+                    pending = pending[max_line:]
+
+            if not data:
+                break
+        if pending:
+            yield pending
+        finished = True
+    finally:
+        proc.stdout.close()
+        if not finished and kill_on_cancel and proc.poll() is None:
+            proc.kill()
+        proc.wait()
+        if tee_file is not tee:
+            tee_file.close()
+
+    if check and proc.returncode != 0:
+        raise CalledProcessError(proc.returncode, cmd)
+
+
+class Pipeline(object):
+    """A pipeline of commands which are connected directly, without a
+    shell, and of python filters working on the lines of the output
+
+    Appending a stage returns a new pipeline, so pipelines can be shared.
+
+    >>> Pipeline(["echo", "2 dependencies  : (8, 16) (8, 32)"]) \\
+    ...     .sub("^.*: ", "", count=1).sub(", ", ":").sub("[()]", "").run()
+    u'8:16 8:32\\n'
+    >>> p = Pipeline(["printf", "c\\\\tx\\\\na\\\\ty\\\\nb\\\\tx\\\\n"])
+    >>> p.grep("x").pipe(["sort"]).cut(1).lines()
+    [u'b', u'c']
+    >>> p.grep("x", invert=True).head(1).run()
+    u'a\\ty\\n'
+
+    The return code of the last failing command is kept, like with pipefail
+    >>> p = Pipeline(["false"]).pipe(["cat"])
+    >>> p.run(), p.returncode
+    (u'', 1)
+    >>> p.run(check=True)
+    Traceback (most recent call last):
+    ...
+    CalledProcessError: Command '['false']' returned non-zero exit status 1
+    """
+    returncode = None
+
+    def __init__(self, argv=None, **kwargs):
+        """Args:
+            argv: The first command of the pipeline
+            kwargs: Arguments passed to popen() for all commands, e.g. stderr
+        """
+        self.stages = []
+        self.kwargs = kwargs
+        if argv:
+            assert type(argv) is list, "Pipelines are shell-free, argv " \
+                "expected"
+            self.stages.append(argv)
+
+    def _extended(self, stage):
+        pipeline = Pipeline(**self.kwargs)
+        pipeline.stages = self.stages + [stage]
+        return pipeline
+
+    def pipe(self, argv):
+        """Append a command, reading the output of the previous stage
+        """
+        assert type(argv) is list, "Pipelines are shell-free, argv expected"
+        return self._extended(argv)
+
+    def filter(self, func):
+        """Append a python filter, func receives and returns a list of lines
+        """
+        return self._extended(func)
+
+    def grep(self, pattern, invert=False):
+        """Keep the lines matching the regular expression, like grep
+        """
+        regex = re.compile(pattern)
+        return self.filter(lambda lines: [l for l in lines
+                                          if bool(regex.search(l)) !=
+                                          invert])
+
+    def cut(self, fields, delimiter="\t"):
+        """Keep the given (1-based) fields of each line, like cut -d -f
+        Lines without the delimiter are kept as they are
+        """
+        if type(fields) is int:
+            fields = [fields]
+
+        def _cut(line):
+            if delimiter not in line:
+                return line
+            tokens = line.split(delimiter)
+            return delimiter.join(tokens[f - 1] for f in fields
+                                  if f <= len(tokens))
+        return self.filter(lambda lines: [_cut(l) for l in lines])
+
+    def sub(self, pattern, repl, count=0):
+        """Substitute in each line, like sed s/pattern/repl/g or, with
+        count=1, like sed s/pattern/repl/
+        """
+        regex = re.compile(pattern)
+        return self.filter(lambda lines: [regex.sub(repl, l, count)
+                                          for l in lines])
+
+    def head(self, n):
+        """Keep the first n lines
+        """
+        return self.filter(lambda lines: lines[:n])
+
+    def run(self, stdin=None, check=False):
+        """Run the pipeline
+
+        Args:
+            stdin: (optional) Data passed to the first stage
+            check: Raise a CalledProcessError if a command fails
+
+        Returns:
+            The output of the last stage
+        """
+        self.returncode = 0
+        data = stdin or ""
+        commands = []
+        for stage in self.stages + [None]:
+            if type(stage) is list:
+                commands.append(stage)
+                continue
+            if commands:
+                data = self._run_commands(commands, data, check)
+                commands = []
+            if stage is not None:
+                if type(data) is not unicode:
+                    data = unicode(data,
+                                   encoding=sys.stdin.encoding or "utf-8")
+                lines = stage(data.splitlines())
+                data = "".join(l + "\n" for l in lines)
+        if type(data) is not unicode:
+            data = unicode(data, encoding=sys.stdin.encoding or "utf-8")
+        return data
+
+    def lines(self, stdin=None, check=False):
+        """Run the pipeline and return the lines of the output
+        """
+        return self.run(stdin, check).splitlines()
+
+    def _run_commands(self, commands, data, check):
+        if type(data) is unicode:
+            data = data.encode(sys.stdin.encoding or "utf-8")
+
+        procs = []
+        try:
+            for argv in commands:
+                stdin = procs[-1].stdout if procs else PIPE
+                procs.append(popen(argv, stdin=stdin, stdout=PIPE,
+                                   **self.kwargs))
+                if len(procs) > 1:
+                    # Let the previous command receive a SIGPIPE if this
+                    # one exits early
+                    procs[-2].stdout.close()
+        except:
+            for proc in procs:
+                proc.kill()
+                proc.wait()
+            raise
+
+        if len(procs) > 1:
+            writer = threading.Thread(target=self._feed,
+                                      args=(procs[0].stdin, data))
+            writer.daemon = True
+            writer.start()
+            stdout, stderr = procs[-1].communicate()
+            writer.join()
+        else:
+            stdout, stderr = procs[-1].communicate(data)
+
+        for argv, proc in zip(commands, procs):
+            if proc.wait() != 0:
+                self.returncode = proc.returncode
+                if check:
+                    raise CalledProcessError(proc.returncode, argv, stdout)
+        return stdout
+
+    @staticmethod
+    def _feed(dst, data):
+        try:
+            dst.write(data)
+        except IOError:
+            # The command exited without reading everything
+            pass
+        finally:
+            dst.close()
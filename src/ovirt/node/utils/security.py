@@ -19,8 +19,8 @@
 # MA  02110-1301, USA.  A copy of the GNU General Public License is
 # also available at http://www.gnu.org/copyleft/gpl.html.
 from ovirt.node import base, valid, utils
-from ovirt.node.utils import console, system
-from ovirt.node.utils.fs import File
+from ovirt.node.utils import console
+from ovirt.node.utils.fs import File, Editor
 import PAM as _PAM  # @UnresolvedImport
 import cracklib
 from collections import namedtuple
@@ -110,6 +110,24 @@ class Selinux(base.Base):
         except OSError:
             self._logger.warning('No default label: "%s"', abspath)
 
+    def restorecon_many(self, abspaths):
+        """Restore the context of many paths with a single restorecon
+        call, every path is relabeled only once
+        """
+        abspaths = sorted(set(abspaths))
+        if not abspaths:
+            return
+        try:
+            process.check_call(["restorecon"] +
+                               [abspath.encode("utf-8")
+                                for abspath in abspaths])
+        except (process.CalledProcessError, OSError):
+            # e.g. a path without a default label, relabel one by one
+            self._logger.debug("Failed to restore the contexts at once",
+                               exc_info=True)
+            for abspath in abspaths:
+                self.restorecon(abspath)
+
     def getcon(self, abspath):
         """ Return context of file, symlink or dir """
         try:
@@ -131,25 +149,22 @@ class Ssh(base.Base):
         super(Ssh, self).__init__()
 
     def __update_profile(self, rng_num_bytes=None, disable_aes=False):
-        additional_lines = []
-
         utils.fs.Config().unpersist("/etc/profile")
 
-        process.check_call("sed -ic '/OPENSSL_DISABLE_AES_NI/d' /etc/profile",
-                           shell=True)
+        # Drop the old settings and append the new ones in one pass
+        editor = Editor()
+        editor.delete("OPENSSL_DISABLE_AES_NI")
         if disable_aes:
-            additional_lines += ["export OPENSSL_DISABLE_AES_NI=1"]
+            editor.append("export OPENSSL_DISABLE_AES_NI=1")
 
-        process.check_call("sed -ic '/SSH_USE_STRONG_RNG/d' /etc/profile",
-                           shell=True)
+        editor.delete("SSH_USE_STRONG_RNG")
         if rng_num_bytes:
-            additional_lines += ["export SSH_USE_STRONG_RNG=%s" %
-                                 rng_num_bytes]
+            editor.append("export SSH_USE_STRONG_RNG=%s" % rng_num_bytes)
+
+        self.logger.debug("Updating /etc/profile")
+        File("/etc/profile").edit(editor)
 
-        if additional_lines:
-            self.logger.debug("Updating /etc/profile")
-            lines = "\n" + "\n".join(additional_lines)
-            File("/etc/profile").write(lines, "a")
+        if editor.appended:
             utils.fs.Config().persist("/etc/profile")
 
             self.restart()
@@ -195,8 +210,18 @@ class Ssh(base.Base):
         return rng_status
 
     def restart(self):
+        """Restart sshd, within a transaction this is done once at the end
+        A restart is needed to pick up changes of it's environment
+        """
         self.logger.debug("Restarting SSH")
-        system.service("sshd", "restart")
+        utils.Transaction.ServicePlan.request("sshd", "restart")
+
+    def reload(self):
+        """Reload sshd, within a transaction this is done once at the end
+        sshd re-reads sshd_config on a reload, existing sessions are kept
+        """
+        self.logger.debug("Reloading SSH")
+        utils.Transaction.ServicePlan.request("sshd", "reload")
 
     def password_authentication(self, enable=None):
         """Get or set the ssh password authentication
@@ -214,7 +239,7 @@ class Ssh(base.Base):
                               "%s" % value)
             aug.set(augpath, value)
             utils.fs.Config().persist("/etc/ssh/sshd_config")
-            self.restart()
+            self.reload()
         state = str(aug.get(augpath)).lower()
         if state not in ["yes", "no", "none"]:
             raise RuntimeError("Failed to set SSH password authentication" +
@@ -234,7 +259,7 @@ class Ssh(base.Base):
             if int(port) in range(1024, 65536) or int(port) == 22:
                 self.logger.debug("Setting SSH port to %s" % port)
                 aug.set(augpath, port)
-                self.restart()
+                self.reload()
 
             else:
                 raise RuntimeError("Port must be in the range [1024-65536] \
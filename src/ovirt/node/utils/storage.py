@@ -21,10 +21,10 @@
 
 from ovirt.node import base
 from ovirt.node.utils.fs import File
-from ovirt.node.utils import system
+from ovirt.node.utils import facts, system
 from ovirt.node.utils import process
-import subprocess
 import os
+import threading
 
 
 class iSCSI(base.Base):
@@ -89,7 +89,6 @@ class Devices(base.Base):
     """A class to retrieve available storage devices
     """
     _fake_devices = None
-    _cached_live_disk_name = None
 
     def __init__(self, fake=False, refresh=False):
         super(Devices, self).__init__()
@@ -99,37 +98,38 @@ class Devices(base.Base):
                 args = ["%s%s" % (k, n) for k in "path", "bus", "name", "size",
                         "desc", "serial", "model"]
                 self._fake_devices[args[1]] = Device(*tuple(args))
-        else:
-            if refresh:
-                try:
-                    process.check_call(["udevadm", "trigger",
-                                        "--action=change",
-                                        "--subsystem-match=block"])
-                    process.check_call(["udevadm", "settle", "--timeout=10"])
-                except process.CalledProcessError:
-                    self.logger.error("Couldn't refresh udev block devices")
-
-            import ovirtnode.storage
-            self._storage = ovirtnode.storage.Storage()
+        elif refresh and not BlockDeviceTable.shared().start():
+            # Without following the udev events, all devices need to be
+            # probed again
+            try:
+                process.check_call(["udevadm", "trigger",
+                                    "--action=change",
+                                    "--subsystem-match=block"])
+                process.check_call(["udevadm", "settle", "--timeout=10"])
+                process.invalidate(process.BLOCK_DEVICES)
+            except process.CalledProcessError:
+                self.logger.error("Couldn't refresh udev block devices")
 
     def live_disk_name(self):
         """get the device name of the live-media we are booting from
-        BEWARE: Because querying this is so expensive we cache this result
+        BEWARE: Because querying this is so expensive the result is kept
+                in the boot facts (see utils.facts)
                 Assumption: Live disk name does not change
         """
-        if self._cached_live_disk_name:
-            return self._cached_live_disk_name
+        return facts.get("live_disk_name")
 
+    @staticmethod
+    @facts.provides("live_disk_name")
+    def _live_disk_name():
         if system.is_pxe():
             # We're PXE, don't filter anything
-            name = ""
-        else:
-            from ovirtnode.ovirtfunctions import get_live_disk
-            name = get_live_disk()
-            if "/dev/mapper" not in name:
-                # FIXME explain ...
-                name = "/dev/%s" % name.rstrip('0123456789')
-        self._cached_live_disk_name = name
+            return ""
+
+        from ovirtnode.ovirtfunctions import get_live_disk
+        name = get_live_disk()
+        if "/dev/mapper" not in name:
+            # FIXME explain ...
+            name = "/dev/%s" % name.rstrip('0123456789')
         return name
 
     def get_all(self):
@@ -137,40 +137,17 @@ class Devices(base.Base):
         """
         if self._fake_devices:
             return self._fake_devices
-        from ovirtnode.ovirtfunctions import translate_multipath_device
-        from ovirtnode.ovirtfunctions import subprocess_closefds
-        dev_names, disk_dict = self._storage.get_udev_devices()
         devices = {}
-        for _dev in dev_names:
-            dev = translate_multipath_device(_dev)
-            self.logger.debug("Checking device %s (%s)" % (dev, _dev))
-            disk_type_cmd = ["lsblk", "-ino", "TYPE", dev, "--nodeps"]
-            disk_type_popen = subprocess_closefds(disk_type_cmd,
-                                                  stdout=subprocess.PIPE,
-                                                  stderr=subprocess.STDOUT)
-            dev_type, dev_type_err = disk_type_popen.communicate()
-            if not dev_type.strip() in ("disk", "mpath"):
-                self.logger.warning("Type is %s" % dev_type)
-                self.logger.warning("Device is not disk %s" % dev)
-                continue
-            if dev in devices:
-                self.logger.warning("Device is already in dict: %s" % dev)
-                continue
-            if dev not in disk_dict:
-                self.logger.warning("Device in names but not in dict: " +
-                                    "%s" % dev)
-                continue
-            if dev == self.live_disk_name():
+        table = BlockDeviceTable.shared()
+        if table.running():
+            all_devices = table.devices().values()
+        else:
+            all_devices = BlockInventory().devices()
+        for device in all_devices:
+            if device.path == self.live_disk_name():
                 self.logger.info("Ignoring device " +
-                                 "%s it's the live media" % dev)
+                                 "%s it's the live media" % device.path)
                 continue
-            infos = disk_dict[dev].split(",", 5)
-            device = Device(dev, *infos)
-            device.name = os.path.basename(device.name).replace(" ", "")
-            device.name = translate_multipath_device(device.name)
-            if device.name in devices:
-                self.logger.debug("Device with same name already " +
-                                  "exists: %s" % device.name)
             devices[device.path] = device
         return devices
 
@@ -198,6 +175,516 @@ class Device(base.Base):
             self.__dict__[prop] = val
 
 
+class BlockInventory(base.Base):
+    """An inventory of the block devices, read in one pass from sysfs and
+    the udev database, without spawning a process per device
+
+    >>> import tempfile, shutil
+    >>> root = tempfile.mkdtemp()
+    >>> def fake(name, size, dev, uevent, files={}, udev=None):
+    ...     path = "%s/sys/block/%s" % (root, name)
+    ...     for d in ["holders", "slaves", "dm", "device"]:
+    ...         os.makedirs("%s/%s" % (path, d))
+    ...     files.update({"size": size, "dev": dev, "uevent": uevent})
+    ...     for fn, data in files.items():
+    ...         File("%s/%s" % (path, fn)).write(data)
+    ...     if udev:
+    ...         File("%s/run/udev/data/b%s" % (root, dev)).write(udev)
+    >>> os.makedirs(root + "/run/udev/data")
+    >>> scsi = "E:ID_BUS=scsi\\nE:ID_SERIAL=%s\\nE:ID_MODEL=LUN\\n"
+    >>> fake("sda", "41943040", "8:0", "DEVNAME=sda", udev=scsi % "S1")
+    >>> fake("sdb", "20971520", "8:16", "DEVNAME=sdb", udev=scsi % "S2",
+    ...      files={"holders/dm-0": ""})
+    >>> fake("dm-0", "20971520", "253:0", "DEVNAME=dm-0",
+    ...      files={"dm/name": "mpatha", "dm/uuid": "mpath-S2",
+    ...             "slaves/sdb": ""})
+    >>> fake("sr0", "2097150", "11:0", "DEVNAME=sr0",
+    ...      udev="E:ID_CDROM=1\\n")
+    >>> fake("vda", "0", "252:0", "DEVNAME=vda")
+
+    >>> inventory = BlockInventory()
+    >>> inventory.sysfs_block = root + "/sys/block"
+    >>> inventory.udev_data = root + "/run/udev/data"
+    >>> sorted((e["name"], e["type"]) for e in inventory.entries().values())
+    [('dm-0', 'mpath'), ('sda', 'disk'), ('sdb', 'disk'), ('sr0', 'rom'), \
+('vda', 'disk')]
+    >>> [(d.path, d.name, d.size, d.serial, d.bus.strip())
+    ...  for d in inventory.devices()]
+    [('/dev/mapper/mpatha', 'mpatha', '10', 'S2', 'Local / FibreChannel'), \
+('/dev/sda', 'sda', '20', 'S1', 'Local / FibreChannel')]
+
+    >>> shutil.rmtree(root)
+    """
+    sysfs_block = "/sys/block"
+    udev_data = "/run/udev/data"
+
+    buses = {"usb": "USB Device          ",
+             "ata": "Local / FibreChannel",
+             "scsi": "Local / FibreChannel",
+             "cciss": "CCISS               "}
+
+    def entries(self):
+        """Collect the informations about all block devices
+
+        Returns:
+            A dict mapping the kernel name of each device to a dict with
+            it's name, path, dev (major:minor), type, size (in bytes),
+            holders, slaves, udev properties, dm name and uuid and if it is
+            virtual (has no backing device)
+        """
+        entries = {}
+        for name in os.listdir(self.sysfs_block):
+            try:
+                entries[name] = self._entry(name)
+            except (IOError, OSError) as e:
+                # The device disappeared while reading it
+                self.logger.debug("Skipping block device %s: %s" %
+                                  (name, e))
+        return entries
+
+    def devices(self, entries=None):
+        """The disks and multipath devices which can be installed to,
+        as Device objects, multipath members are represented by their
+        multipath device
+
+        Args:
+            entries: The entries to use, see entries() (the default)
+
+        Returns:
+            A list of Device objects, sorted by their path
+        """
+        entries = self.entries() if entries is None else entries
+        devices = []
+        for entry in entries.values():
+            if entry["type"] == "disk":
+                if entry["virtual"]:
+                    # Like zram or nbd devices
+                    continue
+                if any(entries[h]["type"] == "mpath"
+                       for h in entry["holders"] if h in entries):
+                    continue
+                properties = entry["properties"]
+            elif entry["type"] == "mpath":
+                slaves = [entries[s] for s in sorted(entry["slaves"])
+                          if s in entries]
+                properties = slaves[0]["properties"] if slaves \
+                    else entry["properties"]
+            else:
+                continue
+
+            if not entry["size"]:
+                # No media
+                continue
+            devices.append(self._device(entry, properties))
+        return sorted(devices, key=lambda d: d.path)
+
+    def _device(self, entry, properties):
+        path = entry["path"]
+        bus = properties.get("ID_BUS")
+        serial = properties.get("ID_SERIAL")
+        if bus in self.buses:
+            bus = self.buses[bus]
+        elif "/dev/vd" in path:
+            bus = "Local (Virtio)      "
+        else:
+            bus = " " * 20
+        desc = properties.get("ID_SCSI_COMPAT")
+        if not desc:
+            if "/dev/vd" in path:
+                desc = "virtio disk"
+            elif serial is not None:
+                desc = serial
+            else:
+                desc = "unknown"
+        # The size is given in GB, like the legacy discovery did
+        size = entry["size"] / 1024 / 1024 / 1024
+        return Device(path, bus, os.path.basename(path), str(size), desc,
+                      str(serial), str(properties.get("ID_MODEL")))
+
+    def _entry(self, name):
+        sysfs = os.path.join(self.sysfs_block, name)
+        uevent = dict(line.split("=", 1) for line in
+                      self._read(sysfs, "uevent").splitlines()
+                      if "=" in line)
+        entry = {"name": name,
+                 "path": "/dev/" + uevent.get("DEVNAME",
+                                              name.replace("!", "/")),
+                 "dev": self._read(sysfs, "dev"),
+                 "size": int(self._read(sysfs, "size") or 0) * 512,
+                 "holders": self._list(sysfs, "holders"),
+                 "slaves": self._list(sysfs, "slaves"),
+                 "virtual": not os.path.exists(os.path.join(sysfs,
+                                                            "device")),
+                 "properties": {}}
+        entry["properties"] = self._udev_properties(entry["dev"])
+
+        dm_uuid = self._read(sysfs, "dm/uuid")
+        entry["dm_name"] = self._read(sysfs, "dm/name")
+        entry["dm_uuid"] = dm_uuid
+        if name.startswith("loop"):
+            entry["type"] = "loop"
+        elif name.startswith("dm-"):
+            entry["path"] = "/dev/mapper/" + entry["dm_name"]
+            entry["type"] = "dm"
+            for prefix, dm_type in [("mpath-", "mpath"), ("LVM-", "lvm"),
+                                    ("CRYPT-", "crypt"), ("part", "part")]:
+                if dm_uuid.startswith(prefix):
+                    entry["type"] = dm_type
+        elif name.startswith("md"):
+            entry["type"] = "raid"
+        elif "ID_CDROM" in entry["properties"] or name.startswith("sr") or \
+                self._read(sysfs, "device/type") == "5":
+            entry["type"] = "rom"
+        else:
+            entry["type"] = "disk"
+        return entry
+
+    def _udev_properties(self, dev):
+        """The properties of a device in the udev database
+        """
+        properties = {}
+        dbfile = os.path.join(self.udev_data, "b%s" % dev)
+        if os.path.exists(dbfile):
+            with open(dbfile) as src:
+                for line in src:
+                    if line.startswith("E:") and "=" in line:
+                        key, value = line[2:].rstrip("\n").split("=", 1)
+                        properties[key] = value
+        return properties
+
+    @staticmethod
+    def _read(sysfs, filename):
+        filename = os.path.join(sysfs, filename)
+        if not os.path.exists(filename):
+            return ""
+        with open(filename) as src:
+            return src.read().strip()
+
+    @staticmethod
+    def _list(sysfs, dirname):
+        dirname = os.path.join(sysfs, dirname)
+        return os.listdir(dirname) if os.path.isdir(dirname) else []
+
+
+class BlockDeviceTable(base.Base):
+    """The installable block devices (see BlockInventory.devices), kept up
+    to date by following the udev events of block devices
+
+    Only the devices named in an event and their holders and slaves are
+    read again, and on_change is emitted with the rows which changed: a
+    dict mapping the path to the new Device, or to None if the device
+    vanished. Use BlockDeviceTable.shared() to get the table of the host.
+
+    >>> import tempfile, shutil
+    >>> root = tempfile.mkdtemp()
+    >>> def fake(name, size, dev):
+    ...     path = "%s/%s" % (root, name)
+    ...     for d in ["holders", "slaves", "device"]:
+    ...         os.makedirs("%s/%s" % (path, d))
+    ...     for fn, data in [("size", size), ("dev", dev),
+    ...                      ("uevent", "DEVNAME=%s" % name)]:
+    ...         File("%s/%s" % (path, fn)).write(data)
+    >>> fake("sda", "41943040", "8:0")
+
+    >>> inventory = BlockInventory()
+    >>> inventory.sysfs_block = root
+    >>> inventory.udev_data = root
+    >>> table = BlockDeviceTable(inventory)
+    >>> table.load()
+    >>> sorted(table.devices())
+    ['/dev/sda']
+
+    >>> changes = []
+    >>> _ = table.on_change.connect(lambda t, rows: changes.append(rows))
+    >>> fake("sdb", "20971520", "8:16")
+    >>> table.handle_uevent("add", "sdb")
+    >>> [(path, d.size) for path, d in changes[-1].items()]
+    [('/dev/sdb', '10')]
+
+    Events which don't change a row are not signaled:
+
+    >>> table.handle_uevent("change", "sda")
+    >>> len(changes)
+    1
+
+    >>> shutil.rmtree(root + "/sdb")
+    >>> table.handle_uevent("remove", "sdb")
+    >>> changes[-1], sorted(table.devices())
+    ({'/dev/sdb': None}, ['/dev/sda'])
+
+    >>> shutil.rmtree(root)
+    """
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, inventory=None):
+        super(BlockDeviceTable, self).__init__()
+        self.inventory = inventory or BlockInventory()
+        self.on_change = self.new_signal()
+        self._lock = threading.RLock()
+        self._entries = {}
+        self._devices = {}
+        self._client = None
+
+    @classmethod
+    def shared(cls):
+        """The table shared by all users in this process
+        """
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    def load(self):
+        """Read all devices
+        """
+        with self._lock:
+            self._entries = self.inventory.entries()
+            self._devices = self._rows()
+
+    def start(self):
+        """Follow the udev events of block devices, the events are handled
+        in a thread running a glib main loop
+
+        Returns:
+            True if the events are followed, False if gudev is not available
+        """
+        with self._lock:
+            if self._client:
+                return True
+            try:
+                import gobject
+                import gudev
+            except ImportError:
+                self.logger.debug("Not following udev events", exc_info=True)
+                return False
+
+            gobject.threads_init()
+            self._client = gudev.Client(["block"])
+            self._client.connect("uevent", self._on_uevent)
+            # Read after connecting, to not miss changes in between
+            self.load()
+            _start_glib_main_loop(gobject)
+        return True
+
+    def running(self):
+        """If the events are followed
+        """
+        return self._client is not None
+
+    def devices(self):
+        """A dict mapping the path of each device to it's Device
+        """
+        with self._lock:
+            return dict(self._devices)
+
+    def _on_uevent(self, client, action, device):
+        if device.get_devtype() == "partition":
+            # Partitions are not listed
+            return
+        try:
+            self.handle_uevent(action, device.get_name())
+        except:
+            self.logger.exception("Failed to handle the %s event of %s" %
+                                  (action, device.get_name()))
+
+    def handle_uevent(self, action, name):
+        """Update the table after the udev event action (e.g. add, change,
+        remove) of the device with the kernel name name
+        """
+        process.invalidate(process.BLOCK_DEVICES)
+        with self._lock:
+            old = self._entries.get(name)
+            related = set([name])
+            if old:
+                related.update(old["holders"] + old["slaves"])
+            if action != "remove":
+                try:
+                    self._entries[name] = self.inventory._entry(name)
+                    related.update(self._entries[name]["holders"] +
+                                   self._entries[name]["slaves"])
+                except (IOError, OSError):
+                    action = "remove"
+            if action == "remove":
+                self._entries.pop(name, None)
+
+            # e.g. the holders list of the members of a new multipath
+            for other in related - set([name]):
+                try:
+                    self._entries[other] = self.inventory._entry(other)
+                except (IOError, OSError):
+                    self._entries.pop(other, None)
+
+            devices = self._rows()
+            changes = {}
+            for path in set(devices) | set(self._devices):
+                new = devices.get(path)
+                current = self._devices.get(path)
+                if (new and new.__dict__) != (current and current.__dict__):
+                    changes[path] = new
+            self._devices = devices
+
+        if changes:
+            self.logger.debug("Block devices changed: %s" % changes.keys())
+            self.on_change(changes)
+
+    def _rows(self):
+        return dict((d.path, d) for d in self.inventory.devices(self._entries))
+
+
+def _start_glib_main_loop(gobject):
+    """Dispatch the glib events (e.g. the uevents of gudev) in a thread
+    """
+    global _glib_main_loop_thread
+    with _glib_main_loop_lock:
+        if _glib_main_loop_thread is None:
+            loop = gobject.MainLoop()
+            _glib_main_loop_thread = threading.Thread(target=loop.run)
+            _glib_main_loop_thread.daemon = True
+            _glib_main_loop_thread.start()
+
+
+_glib_main_loop_thread = None
+_glib_main_loop_lock = threading.Lock()
+
+
+class Topology(base.Base):
+    """An index of the relations between block, device-mapper and
+    multipath devices, to resolve them without spawning processes
+
+    >>> import tempfile, shutil
+    >>> root = tempfile.mkdtemp()
+    >>> def fake(name, dev, dm_name=None, uuid=None, slaves=[]):
+    ...     path = "%s/%s" % (root, name)
+    ...     for d in ["holders", "slaves", "dm", "device"]:
+    ...         os.makedirs("%s/%s" % (path, d))
+    ...     File(path + "/dev").write(dev)
+    ...     File(path + "/size").write("2048")
+    ...     File(path + "/uevent").write("DEVNAME=%s" % name)
+    ...     if dm_name:
+    ...         File(path + "/dm/name").write(dm_name)
+    ...         File(path + "/dm/uuid").write(uuid)
+    ...     for slave in slaves:
+    ...         File("%s/slaves/%s" % (path, slave)).touch()
+    ...         File("%s/%s/holders/%s" % (root, slave, name)).touch()
+    >>> fake("sda", "8:0")
+    >>> fake("sdb", "8:16")
+    >>> fake("sdc", "8:32")
+    >>> fake("dm-0", "253:0", "mpatha", "mpath-3600a0b", ["sdb", "sdc"])
+    >>> fake("dm-1", "253:1", "HostVG-Root", "LVM-abc", ["dm-0"])
+
+    >>> inventory = BlockInventory()
+    >>> inventory.sysfs_block = root
+    >>> inventory.udev_data = root
+    >>> t = Topology(inventory)
+    >>> t.multipath_of("/dev/sdb"), t.multipath_of("sda")
+    ('/dev/mapper/mpatha', None)
+    >>> t.multipaths()
+    ['mpatha']
+    >>> t.multipath_members("mpatha"), t.multipath_members("3600a0b")
+    (['sdb', 'sdc'], ['sdb', 'sdc'])
+    >>> t.name_of_dev("8:32"), t.mapper_path("dm-1")
+    ('sdc', '/dev/mapper/HostVG-Root')
+
+    >>> shutil.rmtree(root)
+    """
+    _current = None
+    _lock = threading.Lock()
+
+    def __init__(self, inventory=None):
+        super(Topology, self).__init__()
+        self.entries = (inventory or BlockInventory()).entries()
+        self.by_dev = {}
+        self.by_mapper_name = {}
+        self.by_dm_uuid = {}
+        for name, entry in self.entries.items():
+            self.by_dev[entry["dev"]] = name
+            if entry["dm_name"]:
+                self.by_mapper_name[entry["dm_name"]] = name
+            if entry["dm_uuid"]:
+                self.by_dm_uuid[entry["dm_uuid"]] = name
+
+    @classmethod
+    def current(cls):
+        """The shared index, it is rebuilt when block devices appeared or
+        vanished, udev updated it's database or process.BLOCK_DEVICES was
+        invalidated
+        """
+        inventory = BlockInventory()
+        try:
+            udev_mtime = os.stat(inventory.udev_data).st_mtime
+        except OSError:
+            udev_mtime = None
+        fingerprint = (sorted(os.listdir(inventory.sysfs_block)), udev_mtime,
+                       process.generation(process.BLOCK_DEVICES))
+        with cls._lock:
+            if cls._current is None or \
+                    cls._current.fingerprint != fingerprint:
+                cls._current = cls(inventory)
+                cls._current.fingerprint = fingerprint
+            return cls._current
+
+    def kernel_name(self, dev):
+        """The kernel name of a device given as name, path, mapper path or
+        dm or multipath name, None if it is unknown
+        """
+        if dev in self.entries:
+            return dev
+        if dev in self.by_mapper_name:
+            return self.by_mapper_name[dev]
+        if dev.startswith("/dev/mapper/"):
+            return self.by_mapper_name.get(dev[len("/dev/mapper/"):])
+        path = os.path.realpath(dev) if dev.startswith("/dev/") else dev
+        if path.startswith("/dev/"):
+            path = path[len("/dev/"):]
+        name = path.replace("/", "!")
+        return name if name in self.entries else None
+
+    def multipath_of(self, dev):
+        """The mapper path of the multipath device dev belongs to (or is),
+        None if dev is no multipath device or member
+        """
+        name = self.kernel_name(dev)
+        if name is None:
+            return None
+        entry = self.entries[name]
+        if entry["type"] == "mpath":
+            return entry["path"]
+        for holder in sorted(entry["holders"]):
+            if self.entries.get(holder, {}).get("type") == "mpath":
+                return self.entries[holder]["path"]
+        return None
+
+    def multipaths(self):
+        """The names of all multipath devices
+        """
+        return sorted(e["dm_name"] for e in self.entries.values()
+                      if e["type"] == "mpath")
+
+    def multipath_members(self, mpath):
+        """The kernel names of the paths of a multipath device, given by
+        it's name or WWID
+        """
+        name = self.by_dm_uuid.get("mpath-%s" % mpath) or \
+            self.kernel_name(mpath)
+        if name is None:
+            return []
+        return sorted(self.entries[name]["slaves"])
+
+    def name_of_dev(self, dev):
+        """The kernel name of the device with the number dev (major:minor)
+        """
+        return self.by_dev.get(dev)
+
+    def mapper_path(self, dev):
+        """The /dev/mapper path of a device-mapper device, None for others
+        """
+        name = self.kernel_name(dev)
+        if name is None or not self.entries[name]["dm_name"]:
+            return None
+        return "/dev/mapper/" + self.entries[name]["dm_name"]
+
+
 class Swap(base.Base):
     def calculcate_default_size(self, overcommit):
         from ovirtnode.ovirtfunctions import calculate_swap_size
@@ -23,6 +23,7 @@ A module to access system wide stuff
 e.g. services, reboot ...
 """
 
+import json
 import logging
 import os
 import re
@@ -36,7 +37,7 @@ import rpm
 import system_config_keyboard.keyboard
 
 from ovirt.node import base, utils
-from ovirt.node.utils import process, parse_varfile
+from ovirt.node.utils import facts, process, parse_varfile
 from ovirt.node.utils.fs import File
 from ovirt.node.utils.process import check_call
 
@@ -101,6 +102,11 @@ def is_iscsi():
 def is_pxe():
     """If the system is PXE booted
     """
+    return facts.get("pxe")
+
+
+@facts.provides("pxe")
+def _is_pxe():
     return "BOOTIF" in kernel_cmdline_arguments()
 
 
@@ -219,6 +225,11 @@ def _parse_lscpu(data):
 def cpu_details():
     """Return details for the CPU of this machine
     """
+    return facts.get("cpu_details")
+
+
+@facts.provides("cpu_details")
+def _cpu_details():
     fields = ["Model name", "Architecture", "CPU MHz", "Virtualization",
               "CPU(s)", "Socket(s)",
               "Core(s) per socket", "Thread(s) per core"]
@@ -597,14 +608,22 @@ class ProductInformation(base.Base):
         self.load()
 
     def load(self):
+        # The image we are running doesn't change until the next boot
+        info = facts.get("product")
+        self.PRODUCT_SHORT = info["PRODUCT_SHORT"] or "oVirt"
+        self.VERSION = info["VERSION"]
+        self.RELEASE = info["RELEASE"]
+
+    @staticmethod
+    @facts.provides("product")
+    def _read():
         aug = utils.AugeasWrapper()
-        augg = lambda k: aug.get("\n%s/%s\n" % (self._version_filename, k),
+        augg = lambda k: aug.get("\n%s/%s\n" %
+                                 (ProductInformation._version_filename, k),
                                  strip_quotes=True)
 
-        # read product / version info
-        self.PRODUCT_SHORT = augg("PRODUCT_SHORT") or "oVirt"
-        self.VERSION = augg("VERSION")
-        self.RELEASE = augg("RELEASE")
+        return dict((k, augg(k)) for k in ["PRODUCT_SHORT", "VERSION",
+                                           "RELEASE"])
 
     def __str__(self):
         return "%s %s-%s" % (self.PRODUCT_SHORT, self.VERSION, self.RELEASE)
@@ -656,11 +675,17 @@ class InstallationMedia(base.Base):
             self.load()
 
     def load(self):
-        from ovirtnode.ovirtfunctions import get_media_version_number
-        data = get_media_version_number()
+        data = facts.get("installation_media")
         if data:
             self.version, self.release = data
 
+    @staticmethod
+    @facts.provides("installation_media")
+    def _read():
+        from ovirtnode.ovirtfunctions import get_media_version_number
+        # The media couldn't be mounted, try again next time
+        return get_media_version_number() or None
+
     def __str__(self):
         return self.full_version
 
@@ -952,6 +977,7 @@ class Filesystem(base.Base):
         # Don't litter the screen with output, so get a handle to /dev/null
         with open(os.devnull, 'wb') as DEVNULL:
             process.call(["udevadm", "settle"], stdout=DEVNULL, stderr=DEVNULL)
+        process.invalidate(process.BLOCK_DEVICES)
 
     @staticmethod
     def by_label(label):
@@ -995,7 +1021,8 @@ class Filesystem(base.Base):
         return fs
 
     def _tokens(self):
-        tokens = process.check_output(["blkid", "-o", "export", self.device])
+        tokens = process.cached_output(["blkid", "-o", "export", self.device],
+                                       invalidate_on=[process.BLOCK_DEVICES])
         return parse_varfile(tokens)
 
     def label(self):
@@ -1281,50 +1308,223 @@ class Bootloader(base.Base):
 
 
 class LVM(base.Base):
-    """A convenience class for querying LVM volume groups
-    and their associated attributes
+    """A convenience class for querying the LVM physical volumes, volume
+    groups and logical volumes of the host
+
+    All of them are loaded at once with a single "lvm fullreport" call
+    (a pvs and a lvs call if lvm is too old to provide it). The report
+    is reused until it is ttl seconds old or until it is dropped by
+    LVM.invalidate(), which is needed after LVM was changed.
+
+    >>> data = '''{"report": [
+    ...   {"vg": [{"vg_name": "HostVG", "vg_uuid": "vg-1",
+    ...            "vg_tags": "", "vg_size": "20", "vg_free": "4"}],
+    ...    "pv": [{"pv_name": "/dev/sda3", "pv_uuid": "pv-1",
+    ...            "pv_size": "20"}],
+    ...    "lv": [{"lv_name": "Config", "lv_uuid": "lv-1",
+    ...            "lv_path": "/dev/HostVG/Config", "lv_size": "8",
+    ...            "lv_attr": "-wi-ao----", "lv_tags": ""},
+    ...           {"lv_name": "Data", "lv_uuid": "lv-2",
+    ...            "lv_path": "/dev/HostVG/Data", "lv_size": "8",
+    ...            "lv_attr": "-wi-ao----", "lv_tags": ""}]},
+    ...   {"vg": [{"vg_name": "6a1b", "vg_uuid": "vg-2", "vg_size": "10",
+    ...            "vg_tags": "RHAT_storage_domain,MDT_POOL", "vg_free": "0"}],
+    ...    "pv": [{"pv_name": "/dev/mapper/mpatha", "pv_uuid": "pv-2",
+    ...            "pv_size": "10"}],
+    ...    "lv": []},
+    ...   {"vg": [],
+    ...    "pv": [{"pv_name": "/dev/sdb", "pv_uuid": "pv-3",
+    ...            "pv_size": "30"}],
+    ...    "lv": []}]}'''
+    >>> lvm = LVM(LVM._parse_fullreport(data))
+    >>> [(vg.name, vg.pv_names, vg.tags) for vg in lvm.vgs()]
+    [('HostVG', ['/dev/sda3'], []), \
+('6a1b', ['/dev/mapper/mpatha'], ['RHAT_storage_domain', 'MDT_POOL'])]
+    >>> [lv.path for lv in lvm.vg("HostVG").lvs]
+    ['/dev/HostVG/Config', '/dev/HostVG/Data']
+    >>> [(pv.name, pv.vg_name, pv.size) for pv in lvm.pvs()]
+    [('/dev/sda3', 'HostVG', 20), ('/dev/mapper/mpatha', '6a1b', 10), \
+('/dev/sdb', '', 30)]
+    >>> lvm.vg("AppVG") is None
+    True
     """
+    ttl = 10
+
+    PV_COLUMNS = ["pv_name", "pv_uuid", "pv_size"]
+    VG_COLUMNS = ["vg_name", "vg_uuid", "vg_tags", "vg_size", "vg_free"]
+    LV_COLUMNS = ["lv_name", "lv_uuid", "lv_path", "lv_size", "lv_attr",
+                  "lv_tags"]
+
+    # Cleared if lvm doesn't support fullreport
+    _use_fullreport = True
+
+    def __init__(self, rows=None):
+        """
+        Args:
+            rows: A (pv_rows, vg_rows, lv_rows) tuple of dicts with the
+                  columns, the pv and lv rows also have a vg_name.
+                  Queried from lvm by default.
+        """
+        super(LVM, self).__init__()
+        pv_rows, vg_rows, lv_rows = rows or self._query()
+
+        self._vgs = [LVM.VG(row) for row in vg_rows]
+        by_name = dict((vg.name, vg) for vg in self._vgs)
+        self._pvs = []
+        for row in pv_rows:
+            pv = LVM.PV(row)
+            self._pvs.append(pv)
+            if pv.vg_name in by_name:
+                by_name[pv.vg_name].pvs.append(pv)
+        self._lvs = []
+        for row in lv_rows:
+            lv = LVM.LV(row)
+            self._lvs.append(lv)
+            if lv.vg_name in by_name:
+                by_name[lv.vg_name].lvs.append(lv)
+
+    @staticmethod
+    def invalidate():
+        """Drop the cached report, needs to be called after LVM was changed
+        """
+        process.invalidate(process.BLOCK_DEVICES)
 
     def vgs(self):
         """Return a list of VG instances for each VG on the host
         """
-        return [LVM.VG(n) for n in self._query_vgs("vg_name")]
+        return list(self._vgs)
 
-    class VG(base.Base):
-        """Wrapper around the 'lvm vgs' command
+    def pvs(self):
+        """Return a list of PV instances for each PV on the host, PVs
+        without a VG have an empty vg_name
         """
-        def __init__(self, name):
-            self.name = name
+        return list(self._pvs)
 
-        @property
-        def tags(self):
-            """Retrieve all tags associated to a VG
-            """
-            return LVM._query_vgs("tags", self.name)
+    def lvs(self):
+        """Return a list of LV instances for each LV on the host
+        """
+        return list(self._lvs)
+
+    def vg(self, name):
+        """Return the VG called name, or None
+        """
+        matches = [vg for vg in self._vgs if vg.name == name]
+        return matches[0] if matches else None
+
+    class _Entry(base.Base):
+        prefix = None
+
+        def __init__(self, row):
+            super(LVM._Entry, self).__init__()
+            for key, value in row.items():
+                if key.endswith("_tags"):
+                    value = [t for t in value.split(",") if t]
+                elif key.endswith(("_size", "_free")):
+                    value = int(value or 0)
+                if key.startswith(self.prefix):
+                    key = key[len(self.prefix):]
+                setattr(self, key, value)
+
+        def __str__(self):
+            return self.build_str(["name"])
+
+    class PV(_Entry):
+        """A physical volume, with name, uuid, size and vg_name
+        """
+        prefix = "pv_"
+        vg_name = ""
+
+    class VG(_Entry):
+        """A volume group, with name, uuid, tags, size, free and it's pvs
+        and lvs
+        """
+        prefix = "vg_"
+
+        def __init__(self, row):
+            self.pvs = []
+            self.lvs = []
+            super(LVM.VG, self).__init__(row)
 
         @property
         def pv_names(self):
-            """Rerieve all PV names of a VG
+            """Retrieve all PV names of a VG
             """
-            return LVM._query_vgs("pv_name", self.name)
+            return [pv.name for pv in self.pvs]
+
+    class LV(_Entry):
+        """A logical volume, with name, uuid, path, size, attr, tags and
+        vg_name
+        """
+        prefix = "lv_"
+        vg_name = ""
 
     @classmethod
-    def _query_vgs(self, option, pv=None):
-        cmd = ["lvm", "vgs", "--noheadings", "-o", option]
+    def _lvm(cls, args):
+        cmd = ["lvm"] + args + ["--units", "b", "--nosuffix"]
+        # The warnings on stderr are not needed
+        return process.cached_output(cmd, ttl=cls.ttl, stderr=process.PIPE,
+                                     invalidate_on=[process.BLOCK_DEVICES])
 
-        if pv:
-            cmd.append(pv)
+    @classmethod
+    def _query(cls):
+        if cls._use_fullreport:
+            args = ["fullreport", "--reportformat", "json"]
+            for report, columns in [("pv", cls.PV_COLUMNS),
+                                    ("vg", cls.VG_COLUMNS),
+                                    ("lv", cls.LV_COLUMNS)]:
+                args += ["--configreport", report, "-o", ",".join(columns)]
+            try:
+                return cls._parse_fullreport(cls._lvm(args))
+            except (process.CalledProcessError, ValueError, KeyError) as e:
+                LOGGER.debug("lvm fullreport failed, using pvs and lvs: %s"
+                             % e)
+                cls._use_fullreport = False
+
+        # VGs always have a PV, so the VG columns are taken from the PVs
+        pv_rows = cls._parse_nameprefixes(cls._lvm(
+            ["pvs", "--noheadings", "--nameprefixes", "-o",
+             ",".join(cls.PV_COLUMNS + cls.VG_COLUMNS)]))
+        lv_rows = cls._parse_nameprefixes(cls._lvm(
+            ["lvs", "--noheadings", "--nameprefixes", "-o",
+             ",".join(["vg_name"] + cls.LV_COLUMNS)]))
+        vg_rows = []
+        for row in pv_rows:
+            vg_row = dict((k, row.pop(k)) for k in cls.VG_COLUMNS)
+            if vg_row["vg_name"] and vg_row not in vg_rows:
+                vg_rows.append(vg_row)
+            row["vg_name"] = vg_row["vg_name"]
+        return pv_rows, vg_rows, lv_rows
 
-        out = process.check_output(cmd).strip()
-        vgs = None
+    @staticmethod
+    def _parse_fullreport(data):
+        pv_rows, vg_rows, lv_rows = [], [], []
+        for report in json.loads(data)["report"]:
+            vg_name = report["vg"][0]["vg_name"] if report["vg"] else ""
+            vg_rows.extend(report["vg"])
+            for rows, target in [(report["pv"], pv_rows),
+                                 (report["lv"], lv_rows)]:
+                for row in rows:
+                    row["vg_name"] = vg_name
+                    target.append(row)
+        return [[dict((str(k), str(v)) for k, v in row.items())
+                 for row in rows] for rows in (pv_rows, vg_rows, lv_rows)]
 
-        # If not VGs are found, just simulate an empty list of VGs
-        if "No volume groups found" in out:
-            vgs = []
-        else:
-            vgs = [x.strip() for x in out.split("\n")]
+    @staticmethod
+    def _parse_nameprefixes(data):
+        """Parse the output of the --nameprefixes option
 
-        return vgs
+        >>> rows = LVM._parse_nameprefixes("  LVM2_PV_NAME='/dev/sdb' "
+        ...                                "LVM2_VG_NAME='My VG'\\n")
+        >>> [sorted(row.items()) for row in rows]
+        [[('pv_name', '/dev/sdb'), ('vg_name', 'My VG')]]
+        """
+        rows = []
+        for line in data.splitlines():
+            if not line.strip():
+                continue
+            pairs = (token.split("=", 1) for token in shlex.split(str(line)))
+            rows.append(dict((k[len("LVM2_"):].lower(), v) for k, v in pairs))
+        return rows
 
 
 class Initramfs(base.Base):
@@ -0,0 +1,258 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+#
+# wipe.py - Copyright (C) 2014 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.  A copy of the GNU General Public License is
+# also available at http://www.gnu.org/copyleft/gpl.html.
+
+"""
+Wiping the metadata of block devices without spawning any tools
+
+The MBR, both GPT headers and partition arrays, the LVM label and metadata
+area, md superblocks (0.90, 1.0, 1.1 and 1.2) and the filesystem
+signatures wipefs knows about all live in the first or the last MiB of a
+device. These regions are overwritten with zeros using direct I/O.
+In the "discard" and "zeroout" modes the whole device is discarded
+(BLKDISCARD) or zeroed by the device (BLKZEROOUT) first.
+
+>>> import tempfile
+>>> fd, fn = tempfile.mkstemp()
+>>> _ = os.write(fd, "Woot" * (1 << 20))
+>>> os.close(fd)
+
+>>> progress = []
+>>> wipe_devices([fn], progress=lambda d, done, total: progress.append(done))
+{}
+>>> data = open(fn).read()
+>>> len(data), data[:1 << 20].strip("\\0"), data[-(1 << 20):].strip("\\0")
+(4194304, '', '')
+>>> data[1 << 20:-(1 << 20)] == "Woot" * (1 << 19)
+True
+>>> progress[-1]
+2097152
+
+>>> wipe_devices([fn, "/tmp/ovirt-node-no-such-disk"])
+{'/tmp/ovirt-node-no-such-disk': OSError(2, 'No such file or directory')}
+>>> os.unlink(fn)
+"""
+
+import ctypes
+import errno
+import fcntl
+import logging
+import mmap
+import os
+import stat
+import struct
+import threading
+
+LOGGER = logging.getLogger(__name__)
+
+LIBC = ctypes.CDLL('libc.so.6', use_errno=True)
+
+BLKRRPART = 0x125f  # _IO(0x12, 95)
+BLKSSZGET = 0x1268  # _IO(0x12, 104)
+BLKDISCARD = 0x1277  # _IO(0x12, 119)
+BLKZEROOUT = 0x127f  # _IO(0x12, 127)
+
+MODES = ["signatures", "discard", "zeroout"]
+
+# The size of the regions at the start and the end of a device which
+# hold the metadata
+REGION_SIZE = 1 << 20
+# The largest write, progress is reported after each
+CHUNK_SIZE = 1 << 20
+
+# Errors indicating that an ioctl or direct I/O is not supported
+_UNSUPPORTED = (errno.ENOTTY, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOSYS)
+
+
+def signature_regions(size, sector_size=512, region_size=REGION_SIZE):
+    """The (offset, length) of the regions of a device of size bytes which
+    hold metadata
+
+    >>> signature_regions(4 << 20)
+    [(0, 1048576), (3145728, 1048576)]
+    >>> signature_regions(1536 << 10)
+    [(0, 1572864)]
+
+    The regions start at sector boundaries:
+
+    >>> signature_regions((4 << 20) + 1000)
+    [(0, 1048576), (3146240, 1049064)]
+    """
+    tail = max(size - region_size, 0) // sector_size * sector_size
+    if tail <= region_size:
+        return [(0, size)]
+    return [(0, region_size), (tail, size - tail)]
+
+
+def wipe_device(path, mode="signatures", progress=None):
+    """Wipe the metadata of the device (or file) path
+
+    Args:
+        path: The device to wipe
+        mode: One of MODES
+        progress: Called with (path, done, total) bytes after each write
+    """
+    assert mode in MODES, "Unknown mode: %s" % mode
+    fd = os.open(path, os.O_WRONLY)
+    try:
+        size = os.lseek(fd, 0, os.SEEK_END)
+        sector_size = _sector_size(fd)
+
+        regions = signature_regions(size, sector_size)
+        if mode != "signatures" and _whole_device(fd, mode, size):
+            LOGGER.debug("Issued %s for all of %s" % (mode, path))
+            if mode == "zeroout":
+                # The device already returns zeros everywhere
+                regions = []
+        fd = _reopen_direct(fd, path, size, sector_size)
+
+        total = sum(length for _, length in regions)
+        done = 0
+        zeros = mmap.mmap(-1, CHUNK_SIZE)
+        try:
+            # An anonymous mapping is page aligned, as needed for O_DIRECT
+            addr = ctypes.addressof(ctypes.c_char.from_buffer(zeros))
+            for offset, length in regions:
+                end = offset + length
+                while offset < end:
+                    count = _pwrite_all(fd, addr, min(CHUNK_SIZE,
+                                                      end - offset), offset)
+                    offset += count
+                    done += count
+                    if progress:
+                        progress(path, done, total)
+        finally:
+            zeros.close()
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    _reread_partitions(path)
+
+
+def wipe_devices(paths, mode="signatures", progress=None):
+    """Wipe the metadata of all paths concurrently, see wipe_device
+    progress is called from the thread wiping the device.
+
+    Returns:
+        A dict with the exception of each device which could not be wiped
+    """
+    errors = {}
+    lock = threading.Lock()
+
+    def wipe(path):
+        try:
+            wipe_device(path, mode, progress)
+            LOGGER.info("Wiped %s" % path)
+        except EnvironmentError as e:
+            LOGGER.error("Failed to wipe %s: %s" % (path, e))
+            with lock:
+                errors[path] = e
+
+    threads = []
+    for path in sorted(set(paths), key=paths.index):
+        thread = threading.Thread(target=wipe, args=(path,))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    return errors
+
+
+def _sector_size(fd):
+    """The logical sector size, 512 for files
+    """
+    try:
+        buf = fcntl.ioctl(fd, BLKSSZGET, struct.pack("i", 0))
+        return struct.unpack("i", buf)[0]
+    except IOError as e:
+        if e.errno not in _UNSUPPORTED:
+            raise
+        return 512
+
+
+def _whole_device(fd, mode, size):
+    """Discard or zero the whole device
+
+    Returns:
+        False if the device doesn't support it
+    """
+    request = BLKDISCARD if mode == "discard" else BLKZEROOUT
+    try:
+        fcntl.ioctl(fd, request, struct.pack("QQ", 0, size))
+        return True
+    except IOError as e:
+        if e.errno not in _UNSUPPORTED:
+            raise
+        LOGGER.info("%s is not supported, only wiping the metadata: %s" %
+                    (mode, e))
+        return False
+
+
+def _reopen_direct(fd, path, size, sector_size):
+    """Returns a descriptor of path opened for direct I/O, or fd if direct
+    I/O can not be used (e.g. on tmpfs, or if the size is not aligned)
+    """
+    if size % sector_size:
+        return fd
+    try:
+        direct = os.open(path, os.O_WRONLY | os.O_DIRECT)
+    except OSError as e:
+        if e.errno not in _UNSUPPORTED:
+            raise
+        return fd
+    os.close(fd)
+    return direct
+
+
+def _pwrite_all(fd, addr, count, offset):
+    written = 0
+    while written < count:
+        ret = _pwrite(fd, addr, count - written, offset + written)
+        if ret == -1:
+            e = ctypes.get_errno()
+            if e == errno.EINTR:
+                continue
+            raise OSError(e, os.strerror(e))
+        written += ret
+    return written
+
+
+def _reread_partitions(path):
+    """Let the kernel drop the partitions of the wiped device
+    """
+    if not stat.S_ISBLK(os.stat(path).st_mode):
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        fcntl.ioctl(fd, BLKRRPART)
+    except IOError as e:
+        # e.g. busy or a device-mapper device, which has no partitions
+        LOGGER.debug("Failed to reread the partitions of %s: %s" %
+                     (path, e))
+    finally:
+        os.close(fd)
+
+
+_pwrite = LIBC.pwrite64
+_pwrite.restype = ctypes.c_ssize_t
+_pwrite.argtypes = [ctypes.c_int,  # fd
+                    ctypes.c_void_p,  # buf
+                    ctypes.c_size_t,  # count
+                    ctypes.c_int64]  # offset
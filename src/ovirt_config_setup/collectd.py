@@ -23,7 +23,8 @@
 import os
 import sys
 from ovirtnode.ovirtfunctions import *
-from subprocess import Popen, PIPE, STDOUT
+from ovirt.node.utils import Transaction
+from ovirt.node.utils.fs import Editor
 from snack import *
 import _snack
 
@@ -32,13 +33,12 @@ collectd_conf = "/etc/collectd.conf"
 
 def write_collectd_config(server, port):
     if os.path.exists(collectd_conf + ".in"):
-        sed_cmd = "sed -e \"s/@COLLECTD_SERVER@/%s/\" \
-            -e \"s/@COLLECTD_PORT@/%s/\" %s.in \
-            > %s" % (server, port, collectd_conf, collectd_conf)
-        sed = subprocess_closefds(sed_cmd, shell=True, stdout=PIPE,
-              stderr=STDOUT)
-    system_closefds("chkconfig collectd on &> /dev/null")
-    system_closefds("service collectd restart &> /dev/null")
+        editor = Editor()
+        editor.sub("@COLLECTD_SERVER@", str(server), 1)
+        editor.sub("@COLLECTD_PORT@", str(port), 1)
+        editor.edit(collectd_conf, source=collectd_conf + ".in")
+    Transaction.ServicePlan.request("collectd", "enable", do_raise=False)
+    Transaction.ServicePlan.request("collectd", "restart", do_raise=False)
     return True
 
 
@@ -19,6 +19,7 @@
 
 import ovirtnode.ovirtfunctions as _functions
 import ovirt.node.utils.system as _system
+from ovirt.node.utils.fs import fastcopy
 import ovirtnode.iscsi as _iscsi
 import shutil
 import traceback
@@ -340,8 +341,8 @@ search --no-floppy --label RootBackup --set root
                 logger.error("efibootmgr setup failed")
                 return False
             else:
-                shutil.copy("/boot/efi/%s/shim.efi" % self.efi_path,
-                            "/liveos/efi/%s/shim.efi" % self.efi_path)
+                fastcopy.copy("/boot/efi/%s/shim.efi" % self.efi_path,
+                              "/liveos/efi/%s/shim.efi" % self.efi_path)
         logger.debug("Generating Grub2 Templates")
         if _functions.is_efi_boot():
             if not os.path.exists("/liveos/efi/%s" % self.efi_path):
@@ -384,9 +385,10 @@ search --no-floppy --label RootBackup --set root
             if "OVIRT_ISCSI_INSTALL" in OVIRT_VARS:
                 _functions.system("umount /boot")
             if os.path.isfile("/boot/efi/%s/grubx64.efi" % self.efi_path):
-                shutil.copy("/boot/efi/%s/grubx64.efi" % self.efi_path, "/tmp")
+                fastcopy.copy("/boot/efi/%s/grubx64.efi" % self.efi_path,
+                              "/tmp")
             else:
-                shutil.copy("/boot/efi/%s/grub.efi" % self.efi_path, "/tmp")
+                fastcopy.copy("/boot/efi/%s/grub.efi" % self.efi_path, "/tmp")
             _functions.mount_boot()
         if "OVIRT_ROOT_INSTALL" in OVIRT_VARS:
             if OVIRT_VARS["OVIRT_ROOT_INSTALL"] == "n":
@@ -561,18 +563,19 @@ search --no-floppy --label RootBackup --set root
                 _functions.system("mkdir -p /liveos/efi/%s" % self.efi_path)
                 if _functions.is_iscsi_install() or _functions.is_efi_boot():
                     if os.path.isfile("/tmp/grubx64.efi"):
-                        shutil.copy("/tmp/grubx64.efi",
-                                    "/liveos/efi/%s/grubx64.efi" %
-                                    self.efi_path)
+                        fastcopy.copy("/tmp/grubx64.efi",
+                                      "/liveos/efi/%s/grubx64.efi" %
+                                      self.efi_path)
                     else:
-                        shutil.copy("/tmp/grub.efi",
-                                    "/liveos/efi/%s/grub.efi" % self.efi_path)
+                        fastcopy.copy("/tmp/grub.efi",
+                                      "/liveos/efi/%s/grub.efi" %
+                                      self.efi_path)
                 elif os.path.isfile("/boot/efi/%s/grubx64.efi" %
                         self.efi_path):
-                    shutil.copy("/boot/efi/%s/grubx64.efi" % self.efi_path,
+                    fastcopy.copy("/boot/efi/%s/grubx64.efi" % self.efi_path,
                           "/liveos/efi/%s/grubx64.efi" % self.efi_path)
                 else:
-                    shutil.copy("/boot/efi/%s/grub.efi" % self.efi_path,
+                    fastcopy.copy("/boot/efi/%s/grub.efi" % self.efi_path,
                           "/liveos/efi/%s/grub.efi" % self.efi_path)
                 if _functions.is_iscsi_install() or _functions.findfs("BootNew"):
                     self.disk = _functions.findfs("BootNew")
@@ -713,7 +716,7 @@ search --no-floppy --label RootBackup --set root
 
         if _functions.is_iscsi_install() or _functions.findfs("BootNew"):
             # copy default for when Root/HostVG is inaccessible(iscsi upgrade)
-            shutil.copy(_functions.OVIRT_DEFAULTS, "/boot")
+            fastcopy.copy(_functions.OVIRT_DEFAULTS, "/boot")
             # mark new Boot ready to go, reboot() in ovirt-function switches it
             # to active
             e2label_cmd = "e2label \"%s\" BootUpdate" % boot_candidate_dev
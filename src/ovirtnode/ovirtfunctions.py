@@ -29,7 +29,6 @@ import socket
 import fcntl
 import struct
 import hashlib
-import shutil
 import re
 import gudev
 import cracklib
@@ -37,9 +36,11 @@ import libvirt
 import logging
 import grp
 import pwd
+import threading
 import time
 from ovirt.node.config import defaults
-from ovirt.node.utils import process, hooks
+from ovirt.node.utils import process, hooks, wipe
+from ovirt.node.utils.fs import Config, Editor, PathEntries, fastcopy
 import ovirt.node.utils.system as osystem
 from ovirt.node.utils.console import TransactionProgress, Transaction
 from ovirtnode.network import *
@@ -54,6 +55,8 @@ OVIRT_LABEL="OVIRT"
 # 2. /etc/default/ovirt is loaded to override defaults with karg values
 OVIRT_DEFAULTS="/etc/default/ovirt"
 aug = augeas.Augeas()
+# The handle is not thread-safe, augtool() and augtool_get() hold this lock
+aug_lock = threading.RLock()
 #   workaround for bind-mounted files
 #   see https://fedorahosted.org/augeas/ticket/32
 aug.set("/augeas/save/copy_if_rename_fails", "")
@@ -131,47 +134,55 @@ def log(log_entry):
     log_file.close()
 
 def augtool(oper, key, value):
-    if oper == "set":
-        aug.set(key, value)
-        aug.save()
-        return
-    elif oper == "rm":
-        aug.remove(key)
-        aug.save()
-        return
-    elif oper == "get":
-        value = aug.get(key)
-        return value
-    elif oper == "match":
-        value = aug.match(key)
-        return value
+    with aug_lock:
+        if oper == "set":
+            aug.set(key, value)
+            aug.save()
+            return
+        elif oper == "rm":
+            aug.remove(key)
+            aug.save()
+            return
+        elif oper == "get":
+            value = aug.get(key)
+            return value
+        elif oper == "match":
+            value = aug.match(key)
+            return value
 
 def augtool_get(key):
-    value = aug.get(key)
+    with aug_lock:
+        value = aug.get(key)
     return value
 
+
+@process.accounting_wrapper
 def subprocess_closefds(*args, **kwargs):
     kwargs.update({
         "close_fds": True
     })
     #logger.debug("Running in subprocess: %s" % ((args, kwargs),))
-    return subprocess.Popen(*args, **kwargs)
+    return process.AccountedPopen(*args, **kwargs)
+
 
+@process.accounting_wrapper
 def system_closefds(cmd):
     proc = subprocess_closefds(cmd, shell=True)
     return proc.wait()
 
+
 class passthrough(object):
     proc = None
     retval = None
     stdout = None
 
+    @process.accounting_wrapper
     def __init__(self, cmd, log_func=None):
         import subprocess as sp
         if log_func is not None:
             log_func("Running: %s" % cmd)
-        self.proc = sp.Popen(cmd, shell=True, stdout=sp.PIPE, \
-                             stderr=sp.STDOUT)
+        self.proc = process.AccountedPopen(cmd, shell=True, stdout=sp.PIPE,
+                                           stderr=sp.STDOUT)
         self.stdout = self.proc.stdout.read()
         self.retval = self.proc.wait()
 
@@ -377,10 +388,12 @@ def disable_firstboot():
 # Destroys a particular volume group and its logical volumes.
 # The input (vg) is accepted as either the vg_name or vg_uuid
 def wipe_volume_group(vg):
-    vg_name_cmd = "vgs -o vg_name,vg_uuid --noheadings 2>/dev/null | grep -w \"" + vg + "\" | awk '{print $1}'"
-    vg_name = subprocess_closefds(vg_name_cmd, shell=True, stdout=PIPE, stderr=STDOUT)
-    vg, err = vg_name.communicate()
-    vg = vg.strip()
+    # vg can be the name or the uuid of the VG
+    names = [v.name for v in osystem.LVM().vgs() if vg in (v.name, v.uuid)]
+    if not names:
+        logger.warning("No volume group '%s' found to wipe" % vg)
+        return
+    vg = names[0]
     files_cmd = "grep '%s' /proc/mounts|awk '{print $2}'|sort -r" % vg
     files = subprocess_closefds(files_cmd, shell=True, stdout=PIPE, stderr=STDOUT)
     files_output, err = files.communicate()
@@ -404,6 +417,7 @@ def wipe_volume_group(vg):
         vgremove_proc = passthrough(vgremove_cmd, logger.debug)
         ret = vgremove_proc.retval
         i -= 1
+    osystem.LVM.invalidate()
 
 # find_srv SERVICE PROTO
 #
@@ -419,8 +433,10 @@ def find_srv(srv, proto):
     # FIXME dig +search does not seem to work with -t srv
     # dnsreply=$(dig +short +search -t srv _$1._$2)
     # This is workaround:
-    search = subprocess_closefds("grep search /etc/resolv.conf", shell=True, stdout=PIPE, stderr=STDOUT)
-    search_output, err = search.communicate()
+    search_output = ""
+    if os.path.exists("/etc/resolv.conf"):
+        with open("/etc/resolv.conf") as resolv_conf:
+            search_output = "".join(l for l in resolv_conf if "search" in l)
     search = search_output.replace("search ","")
     domain_search = domain_output + search_output
     for d in domain_search.split():
@@ -442,14 +458,18 @@ def ovirt_setup_libvirtd(self):
     system_closefds("touch /etc/resolv.conf")
 
     # make libvirtd listen on the external interfaces
-    system_closefds("sed -i -e 's/^#\(LIBVIRTD_ARGS=\"--listen\"\).*/\1/' /etc/sysconfig/libvirtd")
-
-    # set up qemu daemon to allow outside VNC connections
-    system_closefds("sed -i -e 's/^[[:space:]]*#[[:space:]]*\(vnc_listen = \"0.0.0.0\"\).*/\1/' /etc/libvirt/qemu.conf")
-    # set up libvirtd to listen on TCP (for kerberos)
-    system_closefds('sed -i -e "s/^[[:space:]]*#[[:space:]]*\(listen_tcp\)\>.*/\1 = 1/" \
-       -e "s/^[[:space:]]*#[[:space:]]*\(listen_tls\)\>.*/\1 = 0/" \
-       /etc/libvirt/libvirtd.conf')
+    edits = [("/etc/sysconfig/libvirtd",
+              Editor().sub(r'^#(LIBVIRTD_ARGS="--listen").*', r"\1")),
+             # set up qemu daemon to allow outside VNC connections
+             ("/etc/libvirt/qemu.conf",
+              Editor().sub(r'^\s*#\s*(vnc_listen = "0.0.0.0").*', r"\1")),
+             # set up libvirtd to listen on TCP (for kerberos)
+             ("/etc/libvirt/libvirtd.conf",
+              Editor().sub(r"^\s*#\s*(listen_tcp)\b.*", r"\1 = 1")
+                      .sub(r"^\s*#\s*(listen_tls)\b.*", r"\1 = 0"))]
+    for filename, editor in edits:
+        if os.path.exists(filename):
+            editor.edit(filename)
 
 def ovirt_setup_anyterm():
     # configure anyterm
@@ -578,7 +598,8 @@ def mount_config():
         filelist, err = filelist.communicate()
         for f in filelist.split():
             logger.debug("Bind Mounting: " + f)
-            if os.path.isfile(f) and f != "/config/files":
+            if os.path.isfile(f) and f not in ["/config/files",
+                                               Config.checksum_cache]:
                 target = string.replace(f, "/config", "")
                 mounted_cmd = "grep -q " + target + " /proc/mounts"
                 mounted = system_closefds(mounted_cmd)
@@ -778,19 +799,22 @@ def mount_data2():
 
 def cksum(filename):
     try:
-        m = hashlib.md5()
+        hashlib.md5()
+        algo = "md5"
     except:
-	m = hashlib.sha1()
+        algo = "sha1"
 
-    with open(filename) as f:
-        data = f.read(4096)
-        while data:
-            m.update(data)
-            data = f.read(4096)
-        return m.hexdigest()
+    # cached by (dev, inode, size, mtime), see ovirt.node.utils.fs
+    return Config().checksum(filename, algo)
 
 
 STRING_TYPE=(str,unicode)
+
+
+# the registry of persisted files in /config/files used by rc.sysinit
+def config_files():
+    return PathEntries.of("/config/files")
+
 # persist configuration to /config
 #   ovirt_store_config /etc/config /etc/config2 ...
 #   copy to /config and bind-mount back
@@ -807,66 +831,20 @@ def ovirt_store_config(files):
         files_list.append(files)
     else:
         files_list=files
+    # copy, bind mount and register all files at once
+    results = Config().persist_many(files_list)
     for f in files_list:
-        filename = os.path.abspath(f)
-        persist_it=True
-
-        if os.path.isdir(filename):
-            # ensure that, if this is a directory
-            # that it's not already persisted
-            if os.path.isdir("/config/" + filename):
-                logger.warn("Directory already persisted: " + filename)
-                logger.warn("You need to unpersist its child directories " +
-                            "and/or files and try again.")
-                persist_it=False
-        elif os.path.isfile(filename):
-            # if it's a file then make sure it's not already persisted
-            if os.path.isfile("/config/" + filename):
-                cksumroot=cksum(filename)
-                cksumstored=cksum("/config" + filename)
-                if cksumroot == cksumstored:
-                    logger.warn("File already persisted: " + filename)
-                    persist_it=False
-                else:
-                    # persistent copy needs refresh
-                    if system("umount -n " + filename + " 2> /dev/null"):
-                        system("rm -f /config"+ filename)
-        else:
+        if results[f] is True:
+            logger.info("Successfully persisted: " + os.path.abspath(f))
+        elif results[f] == -1:
+            logger.error("Failed to persist: " + os.path.abspath(f))
+            rc = False
+        elif not os.path.exists(f):
             # skip if file does not exist
-            logger.warn("Skipping, file '" + filename + "' does not exist")
-            continue
-
-        if persist_it:
-            # skip if already bind-mounted
-            if not check_bind_mount(filename):
-                dirname = os.path.dirname(filename)
-                system("mkdir -p /config/" + dirname)
-                if system("cp -a " + filename + " /config"+filename):
-                    if not system("mount -n --bind /config"+filename+ " " + \
-                                  filename):
-                        logger.error("Failed to persist: " + filename)
-                        rc = False
-                    else:
-                        logger.info("File: " + filename + " persisted")
-                        rc = rc and True
-            # register in /config/files used by rc.sysinit
-            ret = system_closefds("grep -q \"^" + filename +"$\" " + \
-                                  " /config/files 2> /dev/null")
-            if ret > 0:
-                system_closefds("echo "+filename+" >> /config/files")
-                logger.info("Successfully persisted: " + filename)
-                rc = rc and True
+            logger.warn("Skipping, file '" + f + "' does not exist")
         else:
-            logger.warn(filename + " Already persisted")
-
-            # Even if persisted, make sure it's mounted
-            if not check_bind_mount(filename):
-                if not system("mount -n --bind /config/" + filename + \
-                              " " + filename):
-                    logger.error("Failed to mount unchanged file %r" %
-                                 filename)
-
-            rc = rc and True
+            logger.error("Failed to persist: " + os.path.abspath(f))
+            rc = False
 
     return rc
 
@@ -916,10 +894,7 @@ def ovirt_store_config_retnum(filename):
             else:
                 logger.info("File: " + filename + " persisted")
     # register in /config/files used by rc.sysinit
-    ret = system_closefds("grep -q \"^$" + filename +"$\" " + \
-                          " /config/files 2> /dev/null")
-    if ret > 0:
-        system_closefds("echo "+filename+" >> /config/files")
+    if config_files().add(filename):
         logger.info("Successfully persisted: " + filename)
 
 
@@ -966,12 +941,8 @@ def ovirt_store_config_atomic(filename, source=None):
             if not os.path.exists(os.path.join(OVIRT_CONFIG,  dirname)):
                 os.makedirs(os.path.join(OVIRT_CONFIG,  dirname))
             logger.debug("Copying: %s to %s" % (source, tmp_destination))
-            shutil.copyfile(source, tmp_destination)
-            shutil.copymode(source, tmp_destination)
-            f_stat = os.stat(source)
-            uid = f_stat.st_uid
-            gid = f_stat.st_gid
-            os.chown(tmp_destination, uid, gid)
+            # preserves mode, owner and xattrs
+            fastcopy.copy2(source, tmp_destination)
             logger.debug("Moving %s to %s" %
                         (tmp_destination, final_destination))
             os.rename(tmp_destination, final_destination)
@@ -979,10 +950,8 @@ def ovirt_store_config_atomic(filename, source=None):
             # handle non-existent files that need to be created
             if source is not None:
                 open(filename, 'a+').close()
-            if not filename in open('/config/files','r').read():
-                with open('/config/files', 'a+') as f:
-                    f.write("%s\n" % filename)
-                    logger.info("Successfully persisted: " + filename)
+            if config_files().add(filename):
+                logger.info("Successfully persisted: " + filename)
         except:
             if tmp_destination is not None and os.path.exists(tmp_destination):
                 os.remove(tmp_destination)
@@ -1044,7 +1013,7 @@ def remove_config(files):
         return True
     # if there are no persisted files then just exit
     if os.path.exists("/config/files"):
-        if os.path.getsize('/config/files') == 0:
+        if len(config_files()) == 0:
             print "There are currently no persisted files."
             return True
     if os.path.ismount("/config"):
@@ -1053,38 +1022,23 @@ def remove_config(files):
             files_list.append(files)
         else:
             files_list=files
+        registered = []
         for f in files_list:
             filename = os.path.abspath(f)
-            ret = system_closefds('grep "^%s$" /config/files > /dev/null 2>&1' % filename)
-            if ret == 0:
-                if check_bind_mount(filename):
-                    ret = system_closefds('umount -n "%s" &>/dev/null' % filename)
-                    if ret == 0:
-                        if os.path.isdir(filename):
-                            ret = system_closefds('cp -ar /config/"%s"/* "%s"' % (filename,filename))
-                            if ret > 0:
-                                logger.error(" Failed to unpersist %s" % filename)
-                                return False
-                            else:
-                                logger.info("%s successully unpersisted" % filename)
-                                return True
-                        else:
-                            if os.path.isfile(filename):
-                                # refresh the file in rootfs if it was mounted over
-                                ret = system_closefds('cp -a /config"%s" "%s"' % (filename,filename))
-                                if ret > 0:
-                                    logger.error("Failed to unpersist %s" % filename)
-                                    return False
-                                else:
-                                    logger.info("%s successully unpersisted" % filename)
-                    # clean up the persistent store
-                    system('rm -Rf /config"%s"' % filename)
-                    # unregister in /config/files used by rc.sysinit
-                    system('sed --copy -i "\|^%s$|d" /config/files' % filename)
-                else:
-                    logger.warn("%s is not a persisted file." % filename)
+            if filename in config_files():
+                registered.append(filename)
             else:
                 logger.warn("File not explicitly persisted: %s" % filename)
+        # unmount, restore and unregister all files at once
+        rc = True
+        results = Config().unpersist_many(registered)
+        for filename in registered:
+            if results[filename] is True:
+                logger.info("%s successully unpersisted" % filename)
+            else:
+                logger.error("Failed to unpersist %s" % filename)
+                rc = False
+        return rc
 
 # ovirt_safe_delete_config
 #       ovirt_safe_delete_config /etc/config /etc/config2 ...
@@ -1103,7 +1057,7 @@ def ovirt_safe_delete_config(files):
         if check_bind_mount(filename):
             system_closefds('umount -n "%s" &>/dev/null' % filename)
 
-        system('sed --copy -i "\|%s$|d" /config/files' % filename)
+        config_files().remove(filename)
 
         if os.path.isdir(filename):
             ls_cmd = subprocess_closefds("ls -d '%s'" % filename, shell=True, stdout=PIPE, stderr=STDOUT)
@@ -1375,8 +1329,14 @@ def is_valid_port(port_number):
 
 # Cleans partition tables
 def wipe_partitions(_drive):
-    drive = translate_multipath_device(_drive)
-    logger.info("Wiping partitions on: %s->%s" % (_drive, drive))
+    wipe_drives([_drive])
+
+
+def wipe_drives(_drives):
+    """Wipe the partition tables and metadata of all drives concurrently
+    """
+    drives = [translate_multipath_device(d) for d in _drives]
+    logger.info("Wiping partitions on: %s->%s" % (_drives, drives))
     logger.info("Removing HostVG")
     if os.path.exists("/dev/mapper/HostVG-Swap"):
         system_closefds("swapoff -a")
@@ -1384,99 +1344,51 @@ def wipe_partitions(_drive):
     for lv in os.listdir("/dev/mapper/"):
         if "HostVG" in lv:
             system_closefds("dmsetup remove " +lv + " &>>" + OVIRT_TMP_LOGFILE)
-    logger.info("Wiping old boot sector")
-    system_closefds("parted -s \""+ drive +"\" mklabel msdos &>>" + OVIRT_TMP_LOGFILE)
-    system_closefds("parted -s \""+ drive +"\" mklabel gpt &>>" + OVIRT_TMP_LOGFILE)
-    system_closefds("parted -s \""+ drive +"\" mklabel loop &>>" + OVIRT_TMP_LOGFILE)
-    system_closefds("which systemctl 2>/dev/null >&2 && wipefs -af \""+ drive +"\" >>" + OVIRT_TMP_LOGFILE + "2>&1")
-    system_closefds("which systemctl 2>/dev/null >&2 || wipefs -a \""+ drive +"\"  >>" + OVIRT_TMP_LOGFILE + "2>&1")
-    system_closefds("dd if=/dev/zero of=\""+ drive +"\" bs=1024K count=1 &>>" + OVIRT_TMP_LOGFILE)
-    ## zero out the GPT secondary header
-    logger.info("Wiping secondary gpt header")
-    disk_kb = subprocess_closefds("sfdisk -s \""+ drive +"\" 2>/dev/null", shell=True, stdout=PIPE, stderr=STDOUT)
-    disk_kb_count = disk_kb.stdout.read()
-    system_closefds("dd if=/dev/zero of=\"" +drive +"\" bs=1024 seek=$(("+ disk_kb_count+" - 1)) count=1 &>>" + OVIRT_TMP_LOGFILE)
-
-    # Potentially wipe out new GPT header locations
-    logger.info("Wiping GPT header")
-    system_closefds("dd if=/dev/zero of=\"" + drive +
-                    "\" bs=4096 count=35 &>>" + OVIRT_TMP_LOGFILE)
-    logger.info("Wiping secondary gpt header")
-    disk_kb = subprocess_closefds("blockdev --getsz \"" + drive +
-                                  "\" 2>/dev/null", shell=True, stdout=PIPE,
-                                  stderr=STDOUT)
-    disk_kb_count = disk_kb.stdout.read()
-    system_closefds("dd if=/dev/zero of=\"" + drive +
-                    "\" bs=4096 seek=$((" + disk_kb_count +
-                    " * 512/4096 - 35)) count=35 &>>" + OVIRT_TMP_LOGFILE)
-    system_closefds("sync")
+    # The labels, GPT headers and LVM/md metadata at the start and the end
+    mode = get_wipe_mode()
+    logger.info("Wiping old boot sectors and GPT headers (%s)" % mode)
+
+    def progress(drive, done, total):
+        logger.debug("Wiping %s: %d of %d bytes" % (drive, done, total))
+    failed = wipe.wipe_devices(drives, mode, progress)
+    for drive, e in failed.items():
+        logger.error("Failed to wipe %s: %s" % (drive, e))
+    process.invalidate(process.BLOCK_DEVICES)
 
 def get_dm_device(device):
-    dev_major_cmd="stat -c '%t' " + "\"/dev/" + device + "\""
-    dev_minor_cmd="stat -c '%T' " + "\"/dev/" + device + "\""
-    major_lookup_cmd = subprocess_closefds(dev_major_cmd, shell=True, stdout=PIPE, stderr=STDOUT)
-    minor_lookup_cmd = subprocess_closefds(dev_minor_cmd, shell=True, stdout=PIPE, stderr=STDOUT)
-    major_lookup, err = major_lookup_cmd.communicate()
-    major_lookup = major_lookup.strip()
-    minor_lookup, err = minor_lookup_cmd.communicate()
-    minor_lookup = minor_lookup.strip()
-    dm_cmd = "ls /dev/mapper"
-    dm_cmd = subprocess_closefds(dm_cmd, shell=True, stdout=PIPE, stderr=STDOUT)
-    devices = dm_cmd.stdout.read().strip()
-    for dm in devices.split("\n"):
-        dm_major_cmd="stat -c '%t' " + "\"/dev/mapper/" + dm + "\""
-        dm_minor_cmd="stat -c '%T' " + "\"/dev/mapper/" + dm + "\""
-        dm_major_lookup_cmd = subprocess_closefds(dm_major_cmd, shell=True, stdout=PIPE, stderr=STDOUT)
-        dm_minor_lookup_cmd = subprocess_closefds(dm_minor_cmd, shell=True, stdout=PIPE, stderr=STDOUT)
-        dm_major_lookup, err = dm_major_lookup_cmd.communicate()
-        dm_major_lookup = dm_major_lookup.strip()
-        dm_minor_lookup, err = dm_minor_lookup_cmd.communicate()
-        dm_minor_lookup = dm_minor_lookup.strip()
-        if dm_major_lookup == major_lookup and minor_lookup == dm_minor_lookup:
-            dm = "/dev/mapper/" + dm
-            return dm
+    from ovirt.node.utils.storage import Topology
+    return Topology.current().mapper_path(device)
 
 def check_existing_hostvg(install_dev, vg_name=None):
     if vg_name == None:
         vg_name = "HostVG"
-    if install_dev is "":
-        devices_cmd = "pvs --separator=\":\" -o pv_name,vg_name --noheadings 2>/dev/null| grep %s |awk -F \":\" {'print $1'}" % vg_name
-    else:
-        devices_cmd="pvs --separator=: -o pv_name,vg_name --noheadings 2>/dev/null| grep -v '%s' | grep %s | awk -F: {'print $1'}" % (install_dev, vg_name)
-    devices_cmd = subprocess_closefds(devices_cmd, shell=True, stdout=PIPE, stderr=STDOUT)
-    devices, err = devices_cmd.communicate()
-    devices = devices.strip()
+    devices = [pv.name for pv in osystem.LVM().pvs()
+               if vg_name in pv.vg_name and
+               (not install_dev or install_dev not in pv.name)]
     if len(devices) > 0:
         logger.error("There appears to already be an installation on another device:")
-        for device in devices.split(":"):
+        for device in devices:
             logger.error(device)
         logger.error("The installation cannot proceed until the device is removed")
         logger.error("from the system of the %s volume group is removed" % vg_name)
-        return devices
+        return "\n".join(devices)
     else:
         return False
 
 def translate_multipath_device(dev):
     #trim so that only sdX is stored, but support passing /dev/sdX
     logger.debug("Translating: %s" % dev)
-    multipath_dev = dev
     if dev is None:
         return False
     if "/dev/mapper" in dev:
         return dev
-    if "/dev/cciss" in dev:
-        cciss_dev_cmd = "cciss_id " + dev
-        cciss_dev = subprocess_closefds(cciss_dev_cmd, shell=True, stdout=PIPE, stderr=STDOUT)
-        output, err = cciss_dev.communicate()
-        multipath_dev = "/dev/mapper/" + output.strip()
-    dm_dev_cmd = "multipath -ll '%s' | egrep dm-[0-9]+" % multipath_dev
-    dm_dev = subprocess_closefds(dm_dev_cmd, shell=True, stdout=PIPE, stderr=STDOUT)
-    (dm_dev_output, dummy) = dm_dev.communicate()
-    if dm_dev.returncode > 0:
+    from ovirt.node.utils.storage import Topology
+    multipath_dev = Topology.current().multipath_of(dev)
+    if multipath_dev is None:
         return dev
     else:
-        logger.debug("Translated to: /dev/mapper/" + dm_dev_output.split()[0])
-        return "/dev/mapper/"+dm_dev_output.split()[0]
+        logger.debug("Translated to: " + multipath_dev)
+        return multipath_dev
 
 def pwd_lock_check(user):
     passwd_cmd = "passwd -S %s" % user
@@ -1570,6 +1482,8 @@ def findfs(label):
     blkid_output = blkid_output.strip()
     return blkid_output
 
+
+@process.accounting_wrapper
 def system(command):
     system_cmd = subprocess_closefds(command, shell=True, stdout=PIPE, stderr=PIPE)
     output, err = system_cmd.communicate()
@@ -1689,6 +1603,17 @@ def set_wipe_fakeraid(value):
     OVIRT_VARS = parse_defaults()
 
 
+def get_wipe_mode():
+    """How drives are wiped before partitioning them, see wipe.MODES
+    """
+    OVIRT_VARS = parse_defaults()
+    mode = OVIRT_VARS.get("OVIRT_STORAGE_WIPE") or "signatures"
+    if mode not in wipe.MODES:
+        logger.warning("Unknown storage_wipe mode '%s'" % mode)
+        mode = "signatures"
+    return mode
+
+
 def pad_or_trim(length, string):
     to_rem = len(string) - length
     # if negative pad name space
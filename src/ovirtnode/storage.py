@@ -25,9 +25,11 @@ import re
 import gudev
 import logging
 import subprocess
-import shlex
 from ovirtnode.iscsi import set_iscsi_initiator
 from ovirt.node import presets
+from ovirt.node.utils import process
+from ovirt.node.utils.storage import Topology
+from ovirt.node.utils.system import LVM
 
 logger = logging.getLogger(__name__)
 
@@ -37,6 +39,7 @@ class Storage:
         logger.propagate = False
         OVIRT_VARS = _functions.parse_defaults()
         self.overcommit = 0.5
+        self.wiped_drives = set()
         self.BOOT_SIZE = presets.BOOT_SIZE_MB
         self.ROOT_SIZE = presets.ROOT_SIZE_MB
         self.CONFIG_SIZE = 5
@@ -176,11 +179,9 @@ class Storage:
 
     def get_drive_size(self, drive):
         logger.debug("Getting Drive Size For: %s" % drive)
-        size_cmd = "lsblk -bn -o SIZE " + drive + " 2>/dev/null | head -n1"
-        size_popen = _functions.subprocess_closefds(size_cmd, shell=True,
-                                   stdout=subprocess.PIPE,
-                                   stderr=subprocess.STDOUT)
-        size, size_err = size_popen.communicate()
+        with open(os.devnull, "wb") as DEVNULL:
+            size = process.Pipeline(["lsblk", "-bn", "-o", "SIZE", drive],
+                                    stderr=DEVNULL).head(1).run()
         size = size.strip()
         try:
             # Size is bytes, calculate MB
@@ -193,58 +194,68 @@ class Storage:
         logger.debug(size)
         return size
 
-    def _lvm_name_for_disk(self, disk):
-        name = None
-        cmd = "lvm pvs --noheadings --nameprefixes --unquoted -o pv_name,vg_name '%s' 2> /dev/null" % disk
-        lines = str(_functions.passthrough(cmd)).strip().split("\n")
-        if len(lines) > 1:
-            logger.warning("More than one PV for disk '%s' found: %s" % (disk,
-                                                                         lines))
-        for line in lines:
-            lvm2_vars = dict([tuple(e.split("=", 1)) for e \
-                              in shlex.split(line)])
-            if "LVM2_PV_NAME" in lvm2_vars:
-                name = lvm2_vars["LVM2_PV_NAME"]
-            else:
-                logger.debug("Found line '%s' but no LVM2_PV_NAME" % line)
-        return name
+    def _pv_on_disk(self, pv, disk):
+        """If the PV pv is the disk or one of it's partitions
+        """
+        part_delim = "p"
+        # FIXME this should be more intelligent
+        if "/dev/sd" in disk or "dev/vd" in disk:
+            part_delim = ""
+        if re.match("^%s(%s[0-9]+)?$" % (re.escape(disk), part_delim), pv):
+            return True
+        # LVM might know the disk by a different name
+        return os.path.realpath(pv) == os.path.realpath(disk)
 
     def wipe_lvm_on_disk(self, _devs):
+        LVM.invalidate()
         devs = set(_devs.split(","))
         logger.debug("Considering to wipe LVM on: %s / %s" % (_devs, devs))
+        vgs = LVM().vgs()
         for dev in devs:
             logger.debug("Considering device '%s'" % dev)
             if not os.path.exists(dev):
                 logger.info("'%s' is no device, let's try the next one." % dev)
                 continue
-            part_delim = "p"
-            # FIXME this should be more intelligent
-            if "/dev/sd" in dev or "dev/vd" in dev:
-                part_delim = ""
-            vg_cmd = ("pvs -o vg_uuid --noheadings \"%s\" \"%s%s\"[0-9]* " +
-                      "2>/dev/null | sort -u") % (dev, dev, part_delim)
-            vg_proc = _functions.passthrough(vg_cmd, log_func=logger.debug)
-            vgs_on_dev = vg_proc.stdout.split()
-            for vg in vgs_on_dev:
-                name = self._lvm_name_for_disk(dev)
-                pvs_cmd = ("pvs -o pv_name,vg_uuid --noheadings | " +
-                           "grep \"%s\" | egrep -v -q \"%s" % (vg, name))
-                for fdev in devs:
-                    pvs_cmd += "|%s%s[0-9]+|%s" % (fdev, part_delim, fdev)
-                    name = self._lvm_name_for_disk(fdev)
-                    pvs_cmd += "|%s%s[0-9]+|%s" % (name, part_delim, name)
-                pvs_cmd += "\""
-                remaining_pvs = _functions.system(pvs_cmd)
+            for vg in [vg for vg in vgs
+                       if any(self._pv_on_disk(pv, dev)
+                              for pv in vg.pv_names)]:
+                remaining_pvs = [pv for pv in vg.pv_names
+                                 if not any(self._pv_on_disk(pv, fdev)
+                                            for fdev in devs)]
                 if remaining_pvs:
-                    logger.error("The volume group \"%s\" spans multiple " +
-                                 "disks.") % vg
+                    logger.error(("The volume group \"%s\" spans multiple " +
+                                  "disks.") % vg.name)
                     logger.error("This operation cannot complete.  " +
                                  "Please manually cleanup the storage using " +
                                  "standard disk tools.")
                     return False
-                _functions.wipe_volume_group(vg)
+                _functions.wipe_volume_group(vg.uuid)
+                vgs.remove(vg)
         return True
 
+    def wipe_drives(self, drives):
+        """Wipe the partition tables of all drives at once, drives which
+        were already wiped by this instance are skipped
+        """
+        drives = [drv for drv in drives
+                  if drv and drv not in self.wiped_drives]
+        if drives:
+            _functions.wipe_drives(drives)
+            self.wiped_drives.update(drives)
+
+    def wipe_before_partitioning(self, drives):
+        """Wipe the given drives, the HostVG drives which are labeled from
+        scratch by create_hostvg and the AppVG drives in one call
+        """
+        drives = list(drives)
+        for drv in self.HOSTVGDRIVE.strip(",").split(","):
+            if drv:
+                drv = _functions.translate_multipath_device(drv)
+            # The root, boot and iSCSI root drives keep their partitions
+            if drv not in (self.ROOTDRIVE, self.BOOTDRIVE, self.ISCSIDRIVE):
+                drives.append(drv)
+        self.wipe_drives(drives + list(self.APPVGDRIVE))
+
     def reread_partitions(self, drive):
         logger.debug("Rereading pt")
         _functions.system("sync")
@@ -267,30 +278,14 @@ class Storage:
                                    logger.debug)
 
     def get_sd_name(self, id):
-        device_sys_cmd = "grep -H \"^%s$\" /sys/block/*/dev | cut -d: -f1" % id
-        device_sys = _functions.subprocess_closefds(device_sys_cmd, shell=True,
-                                         stdout=subprocess.PIPE,
-                                         stderr=subprocess.STDOUT)
-        device_sys_output, device_sys_err = device_sys.communicate()
-        device_sys_output = device_sys_output.strip()
-        if not device_sys_output is "":
-            device = os.path.basename(os.path.dirname(device_sys_output))
-            return device
+        return Topology.current().name_of_dev(id)
 
     # gets the dependent block devices for multipath devices
     def get_multipath_deps(self, mpath_device):
         deplist = ""
         #get dependencies for multipath device
-        deps_cmd = "dmsetup deps -u mpath-%s | sed 's/^.*: //' \
-        | sed 's/, /:/g' | sed 's/[\(\)]//g'" % mpath_device
-        deps = _functions.subprocess_closefds(deps_cmd, shell=True,
-                                   stdout=subprocess.PIPE,
-                                   stderr=subprocess.STDOUT)
-        deps_output, deps_err = deps.communicate()
-        for dep in deps_output.split():
-            device = self.get_sd_name(dep)
-            if device is not None:
-                deplist = "%s %s" % (device, deplist)
+        for device in Topology.current().multipath_members(mpath_device):
+            deplist = "%s %s" % (device, deplist)
         return deplist
 
     # Find a usable/selected storage device.
@@ -306,19 +301,25 @@ class Storage:
         for d in os.listdir("/sys/block/"):
             if re.match("^[hsv]+d", d):
                 devices.append("/dev/%s" % d)
-            byid_list_cmd = ("find /dev/disk/by-id -mindepth 1 -not -name " +
-                            "'*-part*' 2>/dev/null")
-            byid_list = _functions.subprocess_closefds(byid_list_cmd,
-                                            shell=True,
-                                            stdout=subprocess.PIPE,
-                                            stderr=subprocess.STDOUT)
-            byid_list_output, byid_list_err = byid_list.communicate()
-        for d in byid_list_output.split():
-            d = os.readlink(d)
-            d_basename = os.path.basename(d)
-            udev_cmd = ("udevadm info --name=/dev/" + d_basename +
-                        " --query=property | grep -q ^ID_BUS: &>>/dev/null")
-            if _functions.system_closefds(udev_cmd):
+        byid_list_cmd = ("find /dev/disk/by-id -mindepth 1 -not -name " +
+                         "'*-part*' 2>/dev/null")
+        byid_list = _functions.subprocess_closefds(byid_list_cmd,
+                                                   shell=True,
+                                                   stdout=subprocess.PIPE,
+                                                   stderr=subprocess.STDOUT)
+        byid_list_output, byid_list_err = byid_list.communicate()
+        byid_basenames = [os.path.basename(os.readlink(d))
+                          for d in byid_list_output.split()]
+        # Query udev for all links at once, this is slow with many LUNs
+        with open(os.devnull, "wb") as DEVNULL:
+            udev_infos = process.run_many([["udevadm", "info",
+                                            "--name=/dev/" + d_basename,
+                                            "--query=property"]
+                                           for d_basename in byid_basenames],
+                                          stderr=DEVNULL)
+        for d_basename, (retval, udev_info) in zip(byid_basenames,
+                                                   udev_infos):
+            if not re.search("^ID_BUS:", udev_info, re.MULTILINE):
                 devices.append("/dev/%s" % d_basename)
         # FIXME: workaround for detecting cciss devices
         if os.path.exists("/dev/cciss"):
@@ -329,24 +330,13 @@ class Storage:
         # include multipath devices
         mpath_sets = ""
         devs_to_remove = {}
-        multipath_list_cmd = "dmsetup ls --target=multipath | cut -f1"
-        multipath_list = _functions.subprocess_closefds(multipath_list_cmd,
-                                             shell=True,
-                                             stdout=subprocess.PIPE,
-                                             stderr=subprocess.STDOUT)
-        multipath_list_output, multipath_list_err = multipath_list.communicate()
-
-        for d in multipath_list_output.split():
+        topology = Topology.current()
+        for d in topology.multipaths():
             devices.append("/dev/mapper/%s" % d)
             sd_devs = ""
             sd_devs = self.get_multipath_deps(d)
 
-            dm_dev_cmd = ("multipath -ll \"%s\" | grep \"%s\" | " +
-                          "sed -r 's/^.*(dm-[0-9]+ ).*$/\\1/'") % (d, d)
-            dm_dev = _functions.subprocess_closefds(dm_dev_cmd, shell=True,
-                                         stdout=subprocess.PIPE,
-                                         stderr=subprocess.STDOUT)
-            dm_dev_output, dm_dev_err = dm_dev.communicate()
+            dm_dev_output = "%s " % topology.kernel_name(d)
             [devs_to_remove.update({d: True}) for d in sd_devs.split()]
             mpath_sets = ("%s %s %s" % (mpath_sets, sd_devs,
                                         dm_dev_output))
@@ -368,16 +358,20 @@ class Storage:
     def get_udev_devices(self):
         self.disk_dict = {}
         client = gudev.Client(['block'])
-        for device in client.query_by_subsystem("block"):
+        block_devices = client.query_by_subsystem("block")
+        # Query the sizes of all devices at once, this is slow with many LUNs
+        with open(os.devnull, "wb") as DEVNULL:
+            dev_sizes = process.run_many([["sfdisk", "-s",
+                                           device.get_property("DEVNAME")]
+                                          for device in block_devices],
+                                         stderr=DEVNULL)
+        for device, (retval, dev_size) in zip(block_devices, dev_sizes):
             dev_name = device.get_property("DEVNAME")
             dev_bus = device.get_property("ID_BUS")
             dev_model = device.get_property("ID_MODEL")
             dev_serial = device.get_property("ID_SERIAL")
             dev_desc = device.get_property("ID_SCSI_COMPAT")
-            dev_size_cmd = "sfdisk -s %s 2>/dev/null" % dev_name
-            dev_size_popen = _functions.subprocess_closefds(dev_size_cmd, shell=True,
-                       stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-            dev_size, dev_size_err = dev_size_popen.communicate()
+            dev_size = str(dev_size)
             size_failed = 0
             if not device.get_property("ID_CDROM"):
                 try:
@@ -594,7 +588,6 @@ class Storage:
 
     def create_iscsiroot(self):
         logger.info("Partitioning iscsi root drive: " + self.ISCSIDRIVE)
-        _functions.wipe_partitions(self.ISCSIDRIVE)
         self.reread_partitions(self.ISCSIDRIVE)
         logger.info("Labeling Drive: " + self.ISCSIDRIVE)
         parted_cmd = ("parted \"" + self.ISCSIDRIVE +
@@ -639,7 +632,6 @@ class Storage:
         logger.debug("SWAP2_SIZE: " + str(self.SWAP2_SIZE))
         logger.debug("DATA2_SIZE: " + str(self.DATA2_SIZE))
         for drv in self.APPVGDRIVE:
-            _functions.wipe_partitions(drv)
             self.reread_partitions(drv)
             logger.info("Labeling Drive: " + drv)
             appvgpart = "1"
@@ -717,6 +709,7 @@ class Storage:
             return True
 
     def perform_partitioning(self):
+        process.invalidate(process.BLOCK_DEVICES)
         if self.HOSTVGDRIVE is None and not _functions.is_iscsi_install():
             logger.error("\nNo storage device selected.")
             return False
@@ -744,15 +737,12 @@ class Storage:
         # Check for still remaining HostVGs this can be the case when
         # Node was installed on a disk not given in storage_init
         # rhbz#872114
-        existing_vgs = str(_functions.passthrough("vgs"))
-        for vg in existing_vgs.split("\n"):
-            vg = vg.strip()
-            if "HostVG" in str(vg):
-                logger.error("An existing installation was found or not " +
-                     "all VGs could be removed.  " +
-                     "Please manually cleanup the storage using " +
-                     "standard disk tools.")
-                return False
+        if any("HostVG" in vg.name for vg in LVM().vgs()):
+            logger.error("An existing installation was found or not " +
+                         "all VGs could be removed.  " +
+                         "Please manually cleanup the storage using " +
+                         "standard disk tools.")
+            return False
 
         logger.info("Removing old LVM partitions")
         # HostVG must not exist at this point
@@ -770,7 +760,9 @@ class Storage:
             logger.error("Wiping LVM on %s Failed" % self.BOOTDRIVE)
             return False
         logger.debug("Old LVM partitions should be gone.")
-        logger.debug(_functions.passthrough("vgdisplay -v"))
+        logger.debug("Remaining VGs: %s" % ", ".join(
+            "%s (%s)" % (vg.name, ", ".join(vg.pv_names))
+            for vg in LVM().vgs()))
 
         self.boot_size_si = self.BOOT_SIZE * (1024 * 1024) / (1000 * 1000)
         if _functions.is_iscsi_install():
@@ -794,7 +786,11 @@ class Storage:
             logger.debug(after_login_drvs)
             logger.info("iSCSI enabled, partitioning boot drive: %s" %
                         self.BOOTDRIVE)
-            _functions.wipe_partitions(self.BOOTDRIVE)
+            self.ISCSIDRIVE = _functions.translate_multipath_device(
+                _functions.OVIRT_VARS["OVIRT_ISCSI_INIT"])
+            logger.debug(self.ISCSIDRIVE)
+            # All drives are wiped concurrently before partitioning them
+            self.wipe_before_partitioning([self.BOOTDRIVE, self.ISCSIDRIVE])
             self.reread_partitions(self.BOOTDRIVE)
             logger.info("Creating boot partition")
             parted_cmd = "parted %s -s \"mklabel %s\"" % (self.BOOTDRIVE,
@@ -832,9 +828,6 @@ class Storage:
                               str(partbootbackup) + "\"")
             _functions.system("ln -snf \"" + partbootbackup +
                    "\" /dev/disk/by-label/BootBackup")
-            self.ISCSIDRIVE = _functions.translate_multipath_device(
-                               _functions.OVIRT_VARS["OVIRT_ISCSI_INIT"])
-            logger.debug(self.ISCSIDRIVE)
             if self.create_iscsiroot():
                 logger.info("iSCSI Root Partitions Created")
                 if self.create_hostvg():
@@ -843,11 +836,15 @@ class Storage:
                     logger.info("Completed!")
                     return True
 
-        if ("OVIRT_ROOT_INSTALL" in _functions.OVIRT_VARS and
-                  _functions.OVIRT_VARS["OVIRT_ROOT_INSTALL"] == "y" and not \
-                      _functions.is_iscsi_install()):
+        root_install = ("OVIRT_ROOT_INSTALL" in _functions.OVIRT_VARS and
+                        _functions.OVIRT_VARS["OVIRT_ROOT_INSTALL"] == "y")
+        if not _functions.is_iscsi_install():
+            # All drives are wiped concurrently before partitioning them
+            root_drives = [self.ROOTDRIVE] if root_install else []
+            self.wipe_before_partitioning(root_drives)
+
+        if root_install and not _functions.is_iscsi_install():
             logger.info("Partitioning root drive: " + self.ROOTDRIVE)
-            _functions.wipe_partitions(self.ROOTDRIVE)
             self.reread_partitions(self.ROOTDRIVE)
             logger.info("Labeling Drive: " + self.ROOTDRIVE)
             parted_cmd = ("parted \"" + self.ROOTDRIVE + "\" -s \"mklabel " +
@@ -19,12 +19,19 @@
 # MA  02110-1301, USA.  A copy of the GNU General Public License is
 # also available at http://www.gnu.org/copyleft/gpl.html.
 import logging
+import os
+import subprocess
+import tempfile
+import threading
+import time
 
-from mock import patch
+from mock import call, patch
 
-from ovirt.node.config.defaults import NodeConfigFileSection
+from ovirt.node.config import defaults
+from ovirt.node.config.defaults import NodeConfigFile, NodeConfigFileSection
+from ovirt.node.exceptions import TransactionError
 from ovirt.node.utils import Transaction
-from ovirt.node.utils.fs import FakeFs
+from ovirt.node.utils.fs import Editor, FakeFs
 
 
 class DummyNodeConfigFileSection(NodeConfigFileSection):
@@ -80,3 +87,347 @@ class TestSanity():
         assert cfg.txe_counter == 2
         assert cfg.secret == "baz"
         assert self.defaults_file.read() == 'DUMMY_KEY="default"\n'
+
+
+@patch("ovirt.node.utils.fs.File", FakeFs.File)
+class TestBatch():
+    """Test that ConfigBatch defers, merges and drops the writes
+    """
+
+    defaults_file = FakeFs.File("/etc/default/ovirt")
+
+    def setUp(self):
+        FakeFs.erase()
+        self.defaults_file.touch()
+
+    def test_flush_once(self):
+        with defaults.batch() as batch:
+            DummyNodeConfigFileSection().update("a")
+            DummyNodeConfigFileSection().update("b")
+            assert self.defaults_file.read() == ""
+            assert DummyNodeConfigFileSection().retrieve() == {"key": "b"}
+        assert self.defaults_file.read() == 'DUMMY_KEY="b"\n'
+        assert batch.saved_writes == 1
+
+    def test_nested(self):
+        with defaults.batch() as outer:
+            with defaults.batch() as inner:
+                DummyNodeConfigFileSection().update("a")
+            assert defaults.ConfigBatch.current() is outer
+            assert self.defaults_file.read() == ""
+            DummyNodeConfigFileSection().update("b")
+        assert defaults.ConfigBatch.current() is None
+        assert self.defaults_file.read() == 'DUMMY_KEY="b"\n'
+        assert outer.saved_writes == 1
+        assert inner.saved_writes == 0
+
+    def test_keep_foreign_changes(self):
+        self.defaults_file.write('DUMMY_KEY="a"\nOTHER_KEY="x"\n')
+        with defaults.batch():
+            DummyNodeConfigFileSection().update(None)
+            self.defaults_file.write('DUMMY_KEY="a"\nOTHER_KEY="y"\n')
+        assert self.defaults_file.read() == 'OTHER_KEY="y"\n'
+
+    def test_discard_on_error(self):
+        try:
+            with defaults.batch():
+                DummyNodeConfigFileSection().update("a")
+                raise RuntimeError("Failed")
+        except RuntimeError:
+            pass
+        assert self.defaults_file.read() == ""
+        assert defaults.ConfigBatch.current() is None
+
+    def test_flush_on_error(self):
+        try:
+            with defaults.batch(discard_on_error=False):
+                DummyNodeConfigFileSection().update("a")
+                raise RuntimeError("Failed")
+        except RuntimeError:
+            pass
+        assert self.defaults_file.read() == 'DUMMY_KEY="a"\n'
+
+
+class TestSnapshot():
+    """Test that the shared snapshot of NodeConfigFile is invalidated
+    """
+
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp()
+        os.close(fd)
+        NodeConfigFile(self.filename).write({"OVIRT_A": "a"})
+        NodeConfigFile.reset_snapshot_stats()
+
+    def tearDown(self):
+        NodeConfigFile(self.filename).invalidate_snapshot()
+        os.unlink(self.filename)
+
+    def test_shared(self):
+        assert NodeConfigFile(self.filename).get_dict() == {"OVIRT_A": "a"}
+        assert NodeConfigFile(self.filename).get_dict() == {"OVIRT_A": "a"}
+        assert NodeConfigFile.snapshot_stats() == {"hits": 1, "misses": 1}
+
+    def test_copy(self):
+        cfg = NodeConfigFile(self.filename).get_dict()
+        cfg["OVIRT_A"] = "b"
+        assert NodeConfigFile(self.filename).get_dict() == {"OVIRT_A": "a"}
+
+    def test_own_write(self):
+        cfgfile = NodeConfigFile(self.filename)
+        cfgfile.get_dict()
+        cfgfile.update({"OVIRT_A": "b"}, True)
+        assert NodeConfigFile(self.filename).get_dict() == {"OVIRT_A": "b"}
+
+    def test_external_write(self):
+        NodeConfigFile(self.filename).get_dict()
+        with open(self.filename, "a") as dst:
+            dst.write("OVIRT_B=b\n")
+        assert NodeConfigFile(self.filename).get_dict() == {"OVIRT_A": "a",
+                                                            "OVIRT_B": "b"}
+
+    def test_replaced(self):
+        NodeConfigFile(self.filename).get_dict()
+        fd, other = tempfile.mkstemp()
+        with os.fdopen(fd, "w") as dst:
+            dst.write("OVIRT_A=c\n")
+        os.rename(other, self.filename)
+        assert NodeConfigFile(self.filename).get_dict() == {"OVIRT_A": "c"}
+
+
+@patch.object(Transaction.ServicePlan, "_run_action")
+class TestServicePlan():
+    """Test that the service actions of a transaction are merged and run
+    once after all elements were committed
+    """
+
+    def setUp(self):
+        self.events = []
+
+    def _element(self, title, *requests, **kwargs):
+        events = self.events
+
+        class ServiceTXE(Transaction.Element):
+            def commit(self):
+                events.append(title)
+                for name, action in requests:
+                    self.request_service(name, action, **kwargs)
+        return ServiceTXE()
+
+    def _transaction(self, *elements):
+        tx = Transaction("Service TX")
+        tx.extend(elements)
+        return tx
+
+    def test_merge(self, run_action):
+        run_action.side_effect = lambda n, a: self.events.append((n, a))
+        self._transaction(self._element("a", ("sshd", "reload"),
+                                        ("collectd", "restart")),
+                          self._element("b", ("sshd", "restart"),
+                                        ("rsyslog", "enable"),
+                                        ("collectd", "restart"))).run()
+        assert self.events == ["a", "b",
+                               ("rsyslog", "enable"),
+                               ("sshd", "restart"),
+                               ("collectd", "restart")]
+
+    def test_reload(self, run_action):
+        self._transaction(self._element("a", ("sshd", "reload")),
+                          self._element("b", ("sshd", "reload"))).run()
+        assert run_action.call_args_list == [call("sshd", "reload")]
+
+    def test_nested_plan(self, run_action):
+        run_action.side_effect = lambda n, a: self.events.append((n, a))
+        sub = self._element("b", ("sshd", "restart"))
+
+        class SubTXE(Transaction.Element):
+            def commit(self):
+                with Transaction.ServicePlan():
+                    sub.commit()
+
+        self._transaction(self._element("a", ("sshd", "restart")),
+                          SubTXE(),
+                          self._element("c")).run()
+        assert self.events == ["a", "b", "c", ("sshd", "restart")]
+
+    def test_without_plan(self, run_action):
+        run_action.side_effect = lambda n, a: self.events.append((n, a))
+        self._element("a", ("sshd", "restart")).commit()
+        assert self.events == ["a", ("sshd", "restart")]
+
+    def test_failure(self, run_action):
+        run_action.side_effect = RuntimeError("Failed")
+        fails = []
+
+        def on_failure():
+            fails.append(list(self.events))
+            raise RuntimeError("Check the sshd configuration")
+
+        tx = self._transaction(self._element("a", ("sshd", "restart"),
+                                             on_failure=on_failure),
+                               self._element("b"))
+        try:
+            tx.run()
+            assert False, "The failure was not raised"
+        except TransactionError as e:
+            assert "Check the sshd configuration" in str(e)
+        # Called once the action failed, after all elements were committed
+        assert fails == [["a", "b"]]
+
+    def test_failure_ignored(self, run_action):
+        run_action.side_effect = RuntimeError("Failed")
+        self._transaction(self._element("a", ("sshd", "restart"),
+                                        do_raise=False)).run()
+        assert run_action.call_args_list == [call("sshd", "restart")]
+
+
+class TestParallelCommit():
+    """Test the dependencies of transaction elements and the error handling
+    of parallel commits
+    """
+
+    def setUp(self):
+        self.events = []
+
+    def _element(self, title, parallel=True, resources=(), delay=0,
+                 fail=False):
+        events = self.events
+
+        class ParallelTXE(Transaction.Element):
+            def commit(self):
+                time.sleep(delay)
+                if fail:
+                    raise RuntimeError("%s failed" % title)
+                events.append(title)
+
+        txe = ParallelTXE()
+        txe.title = title
+        txe.parallel = parallel
+        txe.resources = resources
+        return txe
+
+    def _transaction(self, *elements):
+        tx = Transaction("Parallel TX", list(elements))
+        tx.max_workers = 4
+        return tx
+
+    def test_dependencies(self):
+        class First(Transaction.Element):
+            parallel = True
+
+        class Second(Transaction.Element):
+            parallel = True
+            requires = (First, )
+
+        tx = self._transaction(self._element("a"),
+                               self._element("b", resources=["sshd"]),
+                               self._element("c", resources=["sshd"]),
+                               self._element("d", parallel=False),
+                               self._element("e"),
+                               Second(), First())
+        assert tx.dependencies() == [set(), set(), set([1]),
+                                     set([0, 1, 2]), set([3]),
+                                     set([3]), set([3, 5])]
+
+    def test_order(self):
+        tx = self._transaction(self._element("a", delay=0.1),
+                               self._element("b"),
+                               self._element("c", parallel=False))
+        assert [e.title for idx, e in tx.commit_steps()] == ["a", "b", "c"]
+        # b did not wait for a, but c waited for both
+        assert self.events == ["b", "a", "c"]
+
+    def test_failure(self):
+        tx = self._transaction(self._element("a", delay=0.1),
+                               self._element("b", fail=True),
+                               self._element("c", parallel=False))
+        committed = []
+        try:
+            for idx, e in tx.commit_steps():
+                committed.append(e.title)
+            assert False, "The failure was not raised"
+        except RuntimeError as e:
+            assert str(e) == "b failed"
+        # The running element was waited for, the dependent one not started
+        assert self.events == ["a"]
+        assert committed == ["a"]
+
+    def test_first_failure(self):
+        tx = self._transaction(self._element("a", delay=0.1, fail=True),
+                               self._element("b", fail=True))
+        try:
+            tx.commit()
+            assert False, "The failure was not raised"
+        except RuntimeError as e:
+            assert str(e) == "b failed"
+
+    def test_service_plan(self):
+        names = []
+
+        class ServiceTXE(Transaction.Element):
+            parallel = True
+
+            def commit(self):
+                names.append(threading.current_thread().name)
+                self.request_service("sshd", "restart")
+
+        tx = self._transaction(ServiceTXE(), ServiceTXE())
+        with patch.object(Transaction.ServicePlan, "_run_action") as run:
+            with Transaction.ServicePlan():
+                tx.commit()
+                assert run.call_args_list == []
+        assert threading.current_thread().name not in names
+        assert run.call_args_list == [call("sshd", "restart")]
+
+
+class TestEditor():
+    """Test the translation of sed scripts by Editor.from_sed
+    """
+
+    text = ("# listen_tcp = 0\n"
+            "#listen_tcp=1\n"
+            "listen_tcps = 1\n"
+            "(a+b) = aab a+b?\n"
+            "vnc_listen = 127.0.0.1\n"
+            "\tKEY\tvalue\n")
+
+    scripts = [r"s/^#\s*\(listen_tcp\)\>.*/\1 = 1/",
+               r"s/^[[:space:]]*#[[:space:]]*\(listen_tcp\).*/\1 = 1/",
+               r"s/\(a\+\)b/[\1]/g",
+               r"s/(a+b)/literal/",
+               r"s/a+b?/literal/",
+               r"s/b\?)/B)/",
+               r"s/listen\|KEY/X/g",
+               r"s/l\{1,2\}/L/g",
+               r"s/[0-9]\{1,3\}\./&&/g",
+               r"s/tcp/\&/",
+               r"s/LISTEN/x/gI",
+               r"s|127\.0\.0\.1|0.0.0.0|",
+               r"s/[^[:alnum:]_ ]//g",
+               r"/^#/d",
+               r"\%^vnc%d; s/a/b/",
+               r"/^[[:blank:]]/d",
+               "/listen_tcps/d\ns/#/;/"]
+
+    def _sed(self, script):
+        proc = subprocess.Popen(["sed", "-e", script], stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE)
+        return proc.communicate(self.text)[0]
+
+    def test_sed_equivalence(self):
+        for script in self.scripts:
+            edited = Editor.from_sed(script).apply(self.text)
+            assert edited == self._sed(script), script
+
+    def test_cached(self):
+        editor = Editor.from_sed("s/a/b/")
+        editor.append("c")
+        assert Editor.from_sed("s/a/b/").apply("a\n") == "b\n"
+
+    def test_unsupported(self):
+        for script in [r"/^#/,/^$/d", r"1,3d", r"s/a/b/w out", r"y/ab/ba/",
+                       r"/a/p", r"s/a/b"]:
+            try:
+                Editor.from_sed(script)
+                assert False, "%s was not rejected" % script
+            except ValueError:
+                pass